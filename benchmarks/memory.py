@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+"""
+Memory benchmark of the read, analyze, and write stages on synthetic
+TetML documents of increasing page counts and densities.
+
+Each document is converted in a fresh process. Each stage runs under
+tracemalloc, which counts the memory allocated by Python and numpy,
+and the process's RSS is sampled alongside it. For each stage:
+
+* peak: the most memory allocated during the stage
+* retained: the memory allocated during the stage and still held
+  after it (e.g., the parsed pages after reading)
+* overhead: peak - retained, the memory the stage needs only while
+  it runs
+* rss: the growth of the RSS during the stage, as a cross-check
+
+Retained memory grows with the number of pages, as it holds the
+document. The overhead should only depend on the page being worked on,
+so the benchmark fails (exit status 1) if a stage's overhead grows
+with the number of pages, or if a stage exceeds its budget in BUDGETS.
+
+tracemalloc slows the stages down several times, so the timings are
+only useful to compare documents with each other.
+
+usage: python3 benchmarks/memory.py [--pages 1,4,16] [--quick]
+"""
+
+import gc
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from freki.readers.tetml import TetmlReader
+from freki.analyzers.xycut import XYCutAnalyzer
+from freki.main import write_output
+from pages import dense_page, tetml
+
+MB = 2**20
+
+DENSITIES = [
+    # (label, columns, font size)
+    ('sparse', 2, 11),
+    ('normal', 3, 8),
+    ('dense', 4, 6),
+]
+STAGES = ('read', 'analyze', 'write')
+
+# per stage, the maximum overhead (MiB, for letter pages) and the
+# maximum retained memory per token (bytes), plus SLACK for either
+BUDGETS = {
+    'read': {'overhead': 12, 'retained': 1000},
+    'analyze': {'overhead': 8, 'retained': 800},
+    'write': {'overhead': 3, 'retained': 64},
+}
+SLACK = 1 * MB
+# the overhead of the largest document may exceed that of the smallest
+# by this factor plus SLACK before it counts as growing with the pages
+GROWTH = 1.5
+
+
+class RSSSampler(object):
+    """
+    Sample the RSS of this process every *interval* seconds on a
+    thread, keeping the highest value since the last :meth:`reset`.
+    RSS is read from /proc, so it is `None` where that is missing.
+    """
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.start_rss = self.peak = rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def reset(self):
+        self.start_rss = self.peak = rss()
+
+    def growth(self):
+        current = rss()
+        if current is None:
+            return None
+        return max(self.peak, current) - self.start_rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            current = rss()
+            if current is not None and current > self.peak:
+                self.peak = current
+
+
+def rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def measure(path, outpath):
+    """
+    Convert the TetML file at *path* to *outpath* and return the
+    memory use of each stage as `{stage: {key: bytes}}`.
+    """
+    sampler = RSSSampler()
+    sampler.start()
+    results = {}
+    try:
+        reader = _stage(results, 'read', sampler, TetmlReader, path)
+        doc = _stage(results, 'analyze', sampler,
+                     XYCutAnalyzer().analyze, reader)
+        _stage(results, 'write', sampler, write_output, doc, outpath)
+    finally:
+        sampler.stop()
+    return results
+
+
+def _stage(results, name, sampler, func, *args):
+    sampler.reset()
+    tracemalloc.start()
+    start = time.time()
+    value = func(*args)
+    seconds = time.time() - start
+    gc.collect()  # garbage is not retained, though it counts for peak
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results[name] = {
+        'peak': peak, 'retained': retained, 'overhead': peak - retained,
+        'rss': sampler.growth(), 'seconds': seconds
+    }
+    return value
+
+
+def run_document(path, outpath):
+    # a fresh process per document, so no memory is left over from
+    # earlier documents
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        return pool.apply(measure, (path, outpath))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def check(rows):
+    """
+    Return the list of budget violations in *rows* of
+    `(density, pages, tokens, results)`.
+    """
+    failures = []
+    for density, pages, tokens, results in rows:
+        for stage in STAGES:
+            r = results[stage]
+            budget = BUDGETS[stage]
+            if r['overhead'] > budget['overhead'] * MB + SLACK:
+                failures.append(
+                    '{} {}p {}: overhead {:.1f} MiB > {} MiB'.format(
+                        density, pages, stage, r['overhead'] / MB,
+                        budget['overhead']
+                    )
+                )
+            if r['retained'] > budget['retained'] * tokens + SLACK:
+                per_token = r['retained'] / max(1, tokens)
+                failures.append(
+                    '{} {}p {}: retained {:.0f} B/token > {} B/token'.format(
+                        density, pages, stage, per_token, budget['retained']
+                    )
+                )
+    for density, _, _ in DENSITIES:
+        doc_rows = sorted(
+            (r for r in rows if r[0] == density), key=lambda r: r[1]
+        )
+        if len(doc_rows) < 2:
+            continue
+        _, small_pages, _, small = doc_rows[0]
+        _, large_pages, _, large = doc_rows[-1]
+        for stage in STAGES:
+            limit = small[stage]['overhead'] * GROWTH + SLACK
+            if large[stage]['overhead'] > limit:
+                failures.append(
+                    '{} {}: overhead grows with the document: {:.1f} MiB '
+                    'for {} pages, {:.1f} MiB for {} pages'.format(
+                        density, stage, small[stage]['overhead'] / MB,
+                        small_pages, large[stage]['overhead'] / MB,
+                        large_pages
+                    )
+                )
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        '--pages', default='1,4,16',
+        help='comma-separated page counts (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--quick', action='store_true',
+        help='only use documents of up to 4 pages'
+    )
+    args = parser.parse_args()
+    page_counts = sorted(int(n) for n in args.pages.split(','))
+    if args.quick:
+        page_counts = [n for n in page_counts if n <= 4]
+
+    print('{:<7} {:>5} {:>7} {:<8} {:>9} {:>9} {:>9} {:>9} {:>7}'.format(
+        'density', 'pages', 'tokens', 'stage', 'peak MiB', 'retained',
+        'overhead', 'rss', 'seconds'
+    ))
+    tmpdir = tempfile.mkdtemp()
+    rows = []
+    try:
+        for density, columns, font_size in DENSITIES:
+            for n in page_counts:
+                pages = [
+                    dense_page(id=i+1, columns=columns, font_size=font_size,
+                               seed=i)
+                    for i in range(n)
+                ]
+                tokens = sum(len(p.tokens) for p in pages)
+                path = os.path.join(tmpdir, 'doc.tetml')
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(tetml(pages))
+                del pages
+                results = run_document(
+                    path, os.path.join(tmpdir, 'doc.freki')
+                )
+                rows.append((density, n, tokens, results))
+                for stage in STAGES:
+                    r = results[stage]
+                    print('{:<7} {:>5} {:>7} {:<8} {:>9.1f} {:>9.1f} '
+                          '{:>9.1f} {:>9} {:>7.2f}'.format(
+                              density, n, tokens, stage, r['peak'] / MB,
+                              r['retained'] / MB, r['overhead'] / MB,
+                              '-' if r['rss'] is None
+                              else '{:.1f}'.format(r['rss'] / MB),
+                              r['seconds']
+                          ))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    failures = check(rows)
+    for failure in failures:
+        print('FAIL: ' + failure)
+    if failures:
+        sys.exit(1)
+    print('OK: all stages within their budgets')
+
+
+if __name__ == '__main__':
+    main()
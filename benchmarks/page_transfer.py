@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark sending pages to worker processes as packed arrays in
+shared memory (`freki.packing.SharedPages`) against plain pickling,
+and check that the pages come back unchanged.
+
+The first table compares encoding and decoding the pages in one
+process: `pickle.dumps`/`pickle.loads` against `pack_pages` and
+`to_buffer`/`from_buffer` and `unpack_pages`. The second compares a
+process pool that gets each page to analyze as a pickled `Page`
+against one that attaches to the shared pages once per worker and
+gets only page ids.
+
+usage: python3 benchmarks/page_transfer.py [--pages N] [--repeat N]
+"""
+
+import os
+import sys
+import time
+import pickle
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from freki.packing import (
+    pack_pages, unpack_pages, to_buffer, from_buffer, SharedPages
+)
+from pages import dense_page, table_page
+
+LAYOUTS = [
+    # (label, function, keyword arguments)
+    ('letter, 3 columns, 8pt', dense_page, {'columns': 3, 'font_size': 8}),
+    ('letter, 4 columns, 6pt', dense_page, {'columns': 4, 'font_size': 6}),
+    ('tabloid table, 6pt', table_page,
+     {'width': 1224, 'height': 1584, 'columns': 6, 'font_size': 6}),
+]
+
+_shared = None  # the SharedPages of a pool worker
+
+
+def state(obj):
+    """
+    Return the attributes of *obj* and the objects it contains, for
+    comparing pages.
+    """
+    if isinstance(obj, list):
+        return [state(x) for x in obj]
+    if hasattr(obj, '__dict__'):
+        return dict((k, state(v)) for k, v in vars(obj).items())
+    return obj
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        t = time.perf_counter() - start
+        best = t if best is None else min(best, t)
+    return best, result
+
+
+def _count_tokens(page):
+    # stands in for analyzing the page
+    return len(page.tokens)
+
+
+def _init_worker(shared):
+    global _shared
+    _shared = shared
+
+
+def _count_shared(page_id):
+    return _count_tokens(_shared.pages(page_id)[0])
+
+
+def pickled_pool(pages, processes):
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(_count_tokens, pages, chunksize=1)
+
+
+def shared_pool(pages, processes):
+    shared = SharedPages(pages)
+    try:
+        with multiprocessing.Pool(processes, initializer=_init_worker,
+                                  initargs=(shared,)) as pool:
+            return pool.map(_count_shared, shared.page_ids, chunksize=1)
+    finally:
+        shared.unlink()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--processes', type=int, default=2)
+    args = parser.parse_args()
+
+    docs = []
+    for label, make_page, kwargs in LAYOUTS:
+        pages = [make_page(id=i+1, seed=i, **kwargs)
+                 for i in range(args.pages)]
+        docs.append((label, pages))
+
+    print('{:<24} {:>7} {:>9} {:>9} {:>8} {:>8} {:>8} {:>8}  {}'.format(
+        'layout', 'tokens', 'pickle kB', 'packed kB', 'dumps', 'loads',
+        'pack', 'unpack', 'result'
+    ))
+    failed = False
+    for label, pages in docs:
+        tokens = sum(len(p.tokens) for p in pages)
+        t_dumps, data = best_time(
+            lambda: pickle.dumps(pages, pickle.HIGHEST_PROTOCOL),
+            args.repeat
+        )
+        t_loads, _ = best_time(lambda: pickle.loads(data), args.repeat)
+        t_pack, buf = best_time(
+            lambda: to_buffer(pack_pages(pages)), args.repeat
+        )
+        t_unpack, unpacked = best_time(
+            lambda: unpack_pages(from_buffer(buf)), args.repeat
+        )
+        same = state(unpacked) == state(pages)
+        failed = failed or not same
+        print('{:<24} {:>7} {:>9.0f} {:>9.0f} {:>8.3f} {:>8.3f} {:>8.3f} '
+              '{:>8.3f}  {}'.format(
+                  label, tokens, len(data) / 1024, len(buf) / 1024,
+                  t_dumps, t_loads, t_pack, t_unpack,
+                  'same' if same else 'DIFFERENT'
+              ))
+
+    print()
+    print('{:<24} {:>9} {:>9} {:>8}  {}'.format(
+        'layout', 'pickled', 'shared', 'speedup', 'result'
+    ))
+    for label, pages in docs:
+        t_pickled, a = best_time(
+            lambda: pickled_pool(pages, args.processes), args.repeat
+        )
+        t_shared, b = best_time(
+            lambda: shared_pool(pages, args.processes), args.repeat
+        )
+        same = a == b
+        failed = failed or not same
+        print('{:<24} {:>9.3f} {:>9.3f} {:>7.1f}x  {}'.format(
+            label, t_pickled, t_shared, t_pickled / t_shared,
+            'same' if same else 'DIFFERENT'
+        ))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
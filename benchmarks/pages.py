@@ -0,0 +1,156 @@
+"""
+Synthetic pages for benchmarks.
+"""
+
+import random
+
+from freki.structures import Token, Line, Block, Page
+
+
+def dense_page(id=1, width=612, height=792, columns=3, font_size=8,
+               margin=36, column_gap=18, seed=None, layout_seed=None):
+    """
+    Return a page filled with *columns* columns of justified-looking
+    text lines of random words, with a paragraph break every few lines.
+    If *layout_seed* is given, the paragraph breaks depend only on it,
+    so pages with the same *layout_seed* share their layout.
+    """
+    rnd = random.Random(seed)
+    breaks = rnd if layout_seed is None else random.Random(layout_seed)
+    colwidth = (width - 2 * margin - (columns - 1) * column_gap) / columns
+    leading = font_size * 1.25
+    charw = font_size * 0.5
+    blocks = []
+    for c in range(columns):
+        left = margin + c * (colwidth + column_gap)
+        lines = []
+        y = height - margin
+        while y - font_size > margin:
+            if breaks.random() < 0.15:  # paragraph break
+                y -= leading
+                continue
+            tokens = []
+            x = left
+            while True:
+                w = rnd.randint(1, 10) * charw
+                if x + w > left + colwidth:
+                    break
+                tokens.append(Token(
+                    'x' * int(w / charw), (x, y - font_size, x + w, y),
+                    font='Times'
+                ))
+                x += w + charw
+            lines.append(Line(tokens))
+            y -= leading
+        blocks.append(Block(lines, id=c+1))
+    return Page(blocks, id=id, page_width=width, page_height=height)
+
+
+def table_page(id=1, width=612, height=792, columns=4, font_size=6,
+               margin=36, seed=None):
+    """
+    Return a page with one dense table, like a lexicon, whose columns
+    are too close together to be cut apart.
+    """
+    rnd = random.Random(seed)
+    leading = font_size * 1.2
+    charw = font_size * 0.5
+    colwidth = (width - 2 * margin) / columns
+    lines = []
+    y = height - margin
+    while y - font_size > margin:
+        tokens = []
+        for c in range(columns):
+            x = margin + c * colwidth
+            right = x + colwidth - charw  # narrower than the minimum gap
+            while x < right:
+                w = min(rnd.randint(1, 8) * charw, right - x)
+                tokens.append(Token(
+                    'x' * max(1, int(w / charw)),
+                    (x, y - font_size, x + w, y), font='Times'
+                ))
+                x += w + charw
+        lines.append(Line(tokens))
+        y -= leading
+    return Page([Block(lines, id=1)], id=id, page_width=width,
+                page_height=height)
+
+
+def tetml(pages):
+    """
+    Return a TetML document (as a string) with the tokens of *pages*,
+    one `Para` per block and one `Glyph` per character, as written by
+    TET with `glyphdetails={all}`.
+    """
+    out = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<TET xmlns="http://www.pdflib.com/XML/TET5/TET-5.0" '
+        'version="5.0">\n<Document filename="synthetic.pdf" '
+        'pageCount="{}">\n<Pages>\n'.format(len(pages))
+    ]
+    for page in pages:
+        out.append('<Page number="{}" width="{:.2f}" height="{:.2f}">\n'
+                   '<Content granularity="word">\n'
+                   .format(page.id, page.page_width, page.page_height))
+        for block in page.blocks:
+            out.append('<Para>\n')
+            for token in (t for line in block.lines for t in line.tokens):
+                size = token.ury - token.lly
+                charw = token.width / max(1, len(token.text))
+                out.append(
+                    '<Word><Text>{t.text}</Text><Box llx="{t.llx:.2f}" '
+                    'lly="{t.lly:.2f}" urx="{t.urx:.2f}" ury="{t.ury:.2f}">'
+                    .format(t=token)
+                )
+                for i, c in enumerate(token.text):
+                    out.append(
+                        '<Glyph font="{}" size="{:.2f}" x="{:.2f}" '
+                        'y="{:.2f}" width="{:.2f}">{}</Glyph>'.format(
+                            token.font, size, token.llx + i * charw,
+                            token.lly, charw, c
+                        )
+                    )
+                out.append('</Box></Word>\n')
+            out.append('</Para>\n')
+        out.append('</Content>\n</Page>\n')
+    out.append('</Pages>\n</Document>\n</TET>\n')
+    return ''.join(out)
+
+
+def pdfminer(pages):
+    """
+    Return a PDFMiner XML document (as a string) with the tokens of
+    *pages*, one `textbox` per block and one `text` element per
+    character, as written by `pdf2txt.py -t xml`.
+    """
+    out = ['<?xml version="1.0" encoding="utf-8" ?>\n<pages>\n']
+    for page in pages:
+        out.append('<page id="{}" bbox="0.000,0.000,{:.3f},{:.3f}" '
+                   'rotate="0">\n'.format(page.id, page.page_width,
+                                          page.page_height))
+        for i, block in enumerate(page.blocks):
+            out.append('<textbox id="{}" bbox="{b.llx:.3f},{b.lly:.3f},'
+                       '{b.urx:.3f},{b.ury:.3f}">\n'.format(i, b=block))
+            for line in block.lines:
+                out.append('<textline bbox="{l.llx:.3f},{l.lly:.3f},'
+                           '{l.urx:.3f},{l.ury:.3f}">\n'.format(l=line))
+                for j, token in enumerate(line.tokens):
+                    size = token.ury - token.lly
+                    charw = token.width / max(1, len(token.text))
+                    chars = list(token.text)
+                    if j < len(line.tokens) - 1:
+                        chars.append(' ')
+                    for k, c in enumerate(chars):
+                        x = token.llx + k * charw
+                        out.append(
+                            '<text font="{}" bbox="{:.3f},{:.3f},{:.3f},'
+                            '{:.3f}" size="{:.3f}">{}</text>\n'.format(
+                                token.font, x, token.lly, x + charw,
+                                token.ury, size, c
+                            )
+                        )
+                out.append('<text>\n</text>\n</textline>\n')
+            out.append('</textbox>\n')
+        out.append('</page>\n')
+    out.append('</pages>\n')
+    return ''.join(out)
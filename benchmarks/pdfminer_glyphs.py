@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark grouping the glyphs of PDFMiner XML pages into tokens
+(`freki.readers.pdfminer._read_page`) against the previous
+implementation, which handled one glyph at a time, and check that both
+give the same tokens.
+
+The XML is parsed before timing, so only building the pages is timed.
+
+usage: python3 benchmarks/pdfminer_glyphs.py [--pages N] [--repeat N]
+"""
+
+import os
+import sys
+import time
+import argparse
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from freki.readers.pdfminer import _read_page, max_char_dx
+from freki.structures import Token, Line, Block, Page
+from pages import dense_page, table_page, pdfminer
+
+LAYOUTS = [
+    # (label, function, keyword arguments)
+    ('letter, 2 columns, 11pt', dense_page, {'columns': 2, 'font_size': 11}),
+    ('letter, 3 columns, 8pt', dense_page, {'columns': 3, 'font_size': 8}),
+    ('letter, 4 columns, 6pt', dense_page, {'columns': 4, 'font_size': 6}),
+    ('letter table, 6pt', table_page, {}),
+]
+
+
+def per_glyph_read_page(elem):
+    # the previous implementation: one glyph at a time
+    blocks = []
+    p_llx, p_lly, p_urx, p_ury = map(float, elem.get('bbox').split(','))
+    for textbox in elem.findall('textbox'):
+        lines = []
+        for textline in textbox.findall('textline'):
+            tokens, glyphs, features = [], [], {}
+            last_urx = last_fontspec = last_width = last_isalnum = None
+            for glyph in textline.findall('text'):
+                text = glyph.text
+                if text.isspace():
+                    continue
+                fontspec = (glyph.get('font'), float(glyph.get('size')))
+                bbox = tuple(map(float, glyph.get('bbox').split(',')))
+                llx, lly, urx, ury = bbox
+                dx = 0 if last_urx is None else llx - last_urx
+                width = urx - llx
+                avg_width = width if not last_width else (last_width+width)/2
+                isalnum = text.isalnum()
+                if last_isalnum is None:
+                    last_isalnum = isalnum
+                if (not glyphs or
+                    (fontspec == last_fontspec
+                        and (dx / avg_width) <= max_char_dx
+                        and last_isalnum == isalnum)):
+                    glyphs.append((text, fontspec, bbox, features))
+                else:
+                    tokens.append((glyphs, features))
+                    glyphs = [(text, fontspec, bbox, features)]
+                    features = {}
+                last_urx, last_width = urx, width
+                last_fontspec, last_isalnum = fontspec, isalnum
+            if glyphs:
+                tokens.append((glyphs, features))
+            lines.append(Line([
+                Token(
+                    ''.join(g[0] for g in glyphs),
+                    (min(g[2][0] for g in glyphs),
+                     min(g[2][1] for g in glyphs),
+                     max(g[2][2] for g in glyphs),
+                     max(g[2][3] for g in glyphs)),
+                    glyphs[0][1][0], features
+                )
+                for glyphs, features in tokens
+            ]))
+        blocks.append(Block(lines, id=int(textbox.get('id'))))
+    return Page(blocks=blocks, id=int(elem.get('id')),
+                page_width=p_urx - p_llx, page_height=p_ury - p_lly)
+
+
+def dump(pages):
+    return [
+        (b.id, [[(t.text, t.font, t.llx, t.lly, t.urx, t.ury)
+                 for t in l.tokens] for l in b.lines])
+        for p in pages for b in p.blocks
+    ]
+
+
+def best_time(func, elems, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pages = [func(elem) for elem in elems]
+        t = time.perf_counter() - start
+        best = t if best is None else min(best, t)
+    return best, pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('{:<24} {:>7} {:>7} {:>10} {:>9} {:>8}  {}'.format(
+        'layout', 'glyphs', 'tokens', 'glyph (s)', 'arrays', 'speedup',
+        'result'
+    ))
+    for label, make_page, kwargs in LAYOUTS:
+        pages = [make_page(id=i+1, seed=i, **kwargs)
+                 for i in range(args.pages)]
+        elems = ET.fromstring(pdfminer(pages)).findall('page')
+        glyphs = sum(len(e.findall('.//text')) for e in elems)
+        old_t, old = best_time(per_glyph_read_page, elems, args.repeat)
+        new_t, new = best_time(_read_page, elems, args.repeat)
+        print('{:<24} {:>7} {:>7} {:>10.3f} {:>9.3f} {:>7.1f}x  {}'.format(
+            label, glyphs, sum(len(p.tokens) for p in new), old_t, new_t,
+            old_t / new_t, 'same' if dump(old) == dump(new) else 'different'
+        ))
+
+
+if __name__ == '__main__':
+    main()
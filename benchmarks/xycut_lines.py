@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the XY-cut line segmentation (`_zone_lines`) on dense table
+pages against the previous implementation, which scanned the zone's
+tokens once per line, and check that both give the same lines.
+
+usage: python3 benchmarks/xycut_lines.py [--repeat N]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from freki.analyzers.xycut import (
+    _make_bitmap, _parameters, _zones, _zone_lines, _token_geometry, _gaps
+)
+from pages import table_page
+
+LAYOUTS = [
+    # (label, width, height, columns, font size)
+    ('letter, 4 columns, 8pt', 612, 792, 4, 8),
+    ('letter, 4 columns, 6pt', 612, 792, 4, 6),
+    ('tabloid, 6 columns, 6pt', 1224, 1584, 6, 6),
+    ('poster, 8 columns, 6pt', 2448, 3168, 8, 6),
+]
+
+
+def bbox_filter(llx, lly, urx, ury):
+    def bbox_filter(t):
+        # +- 1 for rounding problems in the bitmap
+        return (
+            t.llx >= llx - 1 and
+            t.lly >= lly - 1 and
+            t.urx <= urx + 1 and
+            t.ury <= ury + 1
+        )
+    return bbox_filter
+
+
+def scan_zone_lines(tokens, bitmap, bbox):
+    # the previous implementation: one pass over the tokens per line
+    llx, lly, urx, ury = bbox
+    in_zone = bbox_filter(llx, lly, urx, ury)
+    idxs = [i for i, t in enumerate(tokens) if in_zone(t)]
+    lines = []
+    btm, y_gaps, top = _gaps(bitmap[lly:ury, llx:urx].max(axis=1), 0, 0, lly)
+    mids = [sum(gap)/2 for gap in y_gaps]
+    for btm, top in zip([lly] + mids, mids + [ury]):
+        in_line = bbox_filter(llx, btm, urx, top)
+        line = [i for i in idxs if in_line(tokens[i])]
+        if line:
+            lines.append(line)
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('{:<26} {:>6} {:>6} {:>6} {:>9} {:>9} {:>8}  {}'.format(
+        'layout', 'tokens', 'zones', 'lines', 'scan (s)', 'vector',
+        'speedup', 'result'
+    ))
+    for label, width, height, columns, size in LAYOUTS:
+        page = table_page(1, width, height, columns, font_size=size, seed=0)
+        tokens = page.tokens
+        bitmap = _make_bitmap(page)
+        zones = [bbox for bbox, _ in
+                 _zones(bitmap, _parameters([(page, bitmap)]))]
+        scan_t = vec_t = float('inf')
+        for _ in range(args.repeat):
+            start = time.time()
+            scanned = [scan_zone_lines(tokens, bitmap, z) for z in zones]
+            scan_t = min(scan_t, time.time() - start)
+            start = time.time()
+            geometry = _token_geometry(tokens)
+            vector = [_zone_lines(tokens, bitmap, z, geometry) for z in zones]
+            vec_t = min(vec_t, time.time() - start)
+        print('{:<26} {:>6} {:>6} {:>6} {:>9.3f} {:>9.3f} {:>7.1f}x  {}'
+              .format(label, len(tokens), len(zones),
+                      sum(len(ls) for ls in vector), scan_t, vec_t,
+                      scan_t / vec_t,
+                      'same' if scanned == vector else 'different'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the coarse-to-fine (`pyramid`) XY-cut zone search against
+the full-resolution search on dense multi-column pages of increasing
+size, and check whether both find the same zones.
+
+usage: python3 benchmarks/xycut_pyramid.py [--repeat N] [--tolerance PTS]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from freki.analyzers.xycut import _make_bitmap, _parameters, _zones, _Pyramid
+from pages import dense_page
+
+LAYOUTS = [
+    # (label, width, height, columns)
+    ('letter, 2 columns', 612, 792, 2),
+    ('letter, 4 columns', 612, 792, 4),
+    ('tabloid, 4 columns', 1224, 1584, 4),
+    ('A1, 5 columns', 1684, 2384, 5),
+    ('poster, 5 columns', 2448, 3168, 5),
+    ('large poster, 5 columns', 4896, 6336, 5),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--tolerance', type=float, default=0)
+    args = parser.parse_args()
+
+    print('{:<24} {:>6} {:>6} {:>9} {:>9} {:>8}  {}'.format(
+        'layout', 'tokens', 'zones', 'full (s)', 'pyramid', 'speedup',
+        'result'
+    ))
+    for label, width, height, columns in LAYOUTS:
+        page = dense_page(1, width, height, columns, seed=0)
+        bitmap = _make_bitmap(page)
+        params = _parameters([(page, bitmap)])
+        full_t = pyr_t = float('inf')
+        for _ in range(args.repeat):
+            start = time.time()
+            full = list(_zones(bitmap, params))
+            full_t = min(full_t, time.time() - start)
+            start = time.time()  # building the pyramid is included
+            pyramid = _Pyramid.for_params(bitmap, params, args.tolerance)
+            pyr = list(_zones(bitmap, params, pyramid=pyramid))
+            pyr_t = min(pyr_t, time.time() - start)
+        print('{:<24} {:>6} {:>6} {:>9.3f} {:>9.3f} {:>7.1f}x  {}'.format(
+            label, len(page.tokens), len(full), full_t, pyr_t,
+            full_t / pyr_t, 'same' if full == pyr else 'different'
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark reusing the XY-cuts of earlier pages of a document (layout
+templates) against searching every page from scratch, and check
+whether both find the same zones.
+
+Each document is a run of pages with the same layout but different
+text. Table pages and text pages with the same paragraph breaks have
+the same cuts on every page; other text pages share their column
+cuts, but the paragraph breaks within the columns differ from page to
+page, so the zones within the columns are searched again.
+
+usage: python3 benchmarks/xycut_templates.py [--pages N] [--repeat N]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from freki.analyzers.templates import LayoutTemplates
+from freki.analyzers.xycut import (
+    _make_bitmap, _parameters, _zones, _template_zones, _cut_tree
+)
+from pages import dense_page, table_page
+
+DOCUMENTS = [
+    # (label, function, keyword arguments)
+    ('letter, 4 column tables', table_page, {}),
+    ('letter, 2 columns', dense_page, {'columns': 2}),
+    ('letter, 3 columns', dense_page, {'columns': 3}),
+    ('letter, 3 columns, same', dense_page,
+     {'columns': 3, 'layout_seed': 0}),
+    ('tabloid, 4 columns', dense_page,
+     {'width': 1224, 'height': 1584, 'columns': 4}),
+    ('tabloid, 4 columns, same', dense_page,
+     {'width': 1224, 'height': 1584, 'columns': 4, 'layout_seed': 0}),
+]
+
+
+def search(bitmaps, params, templates=None):
+    zones = []
+    if templates is not None:
+        templates.reset()
+    for bitmap in bitmaps:
+        page_zones = None
+        if templates is not None:
+            page_zones = _template_zones(bitmap, params, templates)
+        if page_zones is None:
+            page_zones = list(_zones(bitmap, params))
+        if templates is not None:
+            templates.add(bitmap.shape, _cut_tree(page_zones))
+        zones.append(page_zones)
+    return zones
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('{:<24} {:>6} {:>9} {:>9} {:>8} {:>8} {:>8}  {}'.format(
+        'document', 'zones', 'full (s)', 'template', 'speedup', 'hits',
+        'reused', 'result'
+    ))
+    for label, make_page, kwargs in DOCUMENTS:
+        pages = [make_page(id=i+1, seed=i, **kwargs)
+                 for i in range(args.pages)]
+        bitmaps = [_make_bitmap(page) for page in pages]
+        params = _parameters([(page, None) for page in pages])
+        full_t = tmpl_t = float('inf')
+        for _ in range(args.repeat):
+            templates = LayoutTemplates()
+            start = time.time()
+            full = search(bitmaps, params)
+            full_t = min(full_t, time.time() - start)
+            start = time.time()
+            tmpl = search(bitmaps, params, templates)
+            tmpl_t = min(tmpl_t, time.time() - start)
+        print('{:<24} {:>6} {:>9.3f} {:>9.3f} {:>7.1f}x {:>8.0%} {:>8.0%}  '
+              '{}'.format(
+                  label, sum(len(z) for z in full), full_t, tmpl_t,
+                  full_t / tmpl_t, templates.hit_rate, templates.reuse_rate,
+                  'same' if full == tmpl else 'different'
+              ))
+
+
+if __name__ == '__main__':
+    main()
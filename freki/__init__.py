@@ -0,0 +1,19 @@
+
+def convert(source, reader='tetml', analyzer='xycut', **options):
+    """
+    Convert *source*, a TetML or PDFMiner XML file given as a path, an
+    open file, or bytes, to a :class:`freki.serialize.FrekiDoc` without
+    writing any files. See :func:`freki.main.analyze` for the options.
+    """
+    # imported here so `import freki.serialize` does not need numpy
+    from freki.main import convert
+    return convert(source, reader=reader, analyzer=analyzer, **options)
+
+
+def iter_blocks(source, reader='tetml', analyzer='xycut', **options):
+    """
+    Like :func:`convert`, but yield the document's FrekiBlocks one at
+    a time.
+    """
+    from freki.main import iter_blocks
+    return iter_blocks(source, reader=reader, analyzer=analyzer, **options)
@@ -0,0 +1,116 @@
+"""
+Memoization of page analyses.
+
+Many documents share near-identical pages (repeated front matter,
+reprinted sections, duplicate uploads). A :class:`PageMemo` stores the
+result of analyzing a page under a fingerprint of the page's token
+geometry and the analysis parameters, so an analyzer can reuse it when
+it sees a page with the same fingerprint. Only token positions are
+stored, never tokens, so a stored result is replayed with the new
+page's own tokens.
+"""
+
+import json
+import shelve
+import hashlib
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_MAXSIZE = 1024
+
+
+class PageMemo(object):
+    """
+    Bounded LRU memo of page analyses, optionally backed by a
+    persistent store at *path*.
+
+    At most *maxsize* results are kept in memory. If *path* is given,
+    results are also written to a :mod:`shelve` database there and
+    looked up in it when they are not in memory.
+    """
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, path=None):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._store = shelve.open(path) if path is not None else None
+
+    def get(self, key):
+        """
+        Return the result stored for *key*, or `None` if there is none.
+        """
+        value = self._cache.get(key)
+        if value is not None:
+            self._cache.move_to_end(key)
+        elif self._store is not None:
+            value = self._store.get(key)
+            if value is not None:
+                self._remember(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Store *value* for *key*.
+        """
+        self._remember(key, value)
+        if self._store is not None:
+            self._store[key] = value
+
+    def _remember(self, key, value):
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        """
+        Return a dict of lookup statistics.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+            'size': len(self._cache),
+        }
+
+    def log_stats(self):
+        logging.info(
+            'Page memo: {hits} hits, {misses} misses ({rate:.1%} hit rate)'
+            .format(rate=self.hit_rate, **self.stats())
+        )
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+
+def fingerprint(page, params):
+    """
+    Return a key for analyzing *page* with *params*.
+
+    The key covers everything the analysis depends on: the page size,
+    the bounding box and height of each token in page order, and the
+    parameter values.
+    """
+    geometry = np.array(
+        [(t.llx, t.lly, t.urx, t.ury, t.height) for t in page.tokens],
+        dtype=np.float64
+    )
+    meta = json.dumps(
+        [page.page_width, page.page_height, params], sort_keys=True
+    )
+    h = hashlib.sha1(meta.encode('utf-8'))
+    h.update(geometry.tobytes())
+    return h.hexdigest()
@@ -0,0 +1,280 @@
+"""
+Parameter sweeps for the XY-cut analyzer.
+
+Tuning the XY-cut parameters by re-running `freki` for each setting
+parses the XML and rasterizes every page again each time. A sweep
+instead parses each document and builds its page bitmaps once
+(:func:`load_document`), then evaluates many parameter sets against
+them over a process pool (:func:`sweep`). Each parameter set is a dict
+of overrides for :func:`freki.analyzers.xycut._parameters`, and is
+reported with its zone and line counts and, if reference Freki files
+are given, how well its blocks agree with the reference blocks.
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+import itertools
+from collections import Counter
+
+from freki import batch
+from freki.analyzers.xycut import (
+    _make_bitmap, _parameters, _zones, _zone_lines, _make_block,
+    _token_geometry
+)
+from freki.serialize import FrekiDoc
+
+# minimum intersection-over-union for a block to match a reference block
+MATCH_IOU = 0.9
+
+_docs = None  # documents shared with pool workers; see _init_worker()
+
+
+class SweepDocument(object):
+    """
+    A document prepared for evaluating parameter sets.
+
+    *reference* maps page numbers to lists of reference block bboxes.
+    """
+    def __init__(self, id, pages, reference=None):
+        self.id = id
+        self.bit_pages = [(p, _make_bitmap(p)) for p in pages]
+        self.reference = reference
+
+
+def load_document(reader, id=None, reference=None):
+    """
+    Read the pages from *reader* and build their bitmaps.
+
+    If *reference* is the path of a Freki file, its blocks are used
+    as the reference for evaluating parameter sets.
+    """
+    ref_blocks = None
+    if reference is not None:
+        fd = FrekiDoc.read(reference)
+        ref_blocks = dict(
+            (page, [b.bbox for b in fd.blocks_by_page(page) if b.lines])
+            for page in fd.pages
+        )
+    return SweepDocument(id, reader.pages(), reference=ref_blocks)
+
+
+def grid(settings):
+    """
+    Return the parameter sets for all combinations of *settings*, a
+    dict mapping parameter names to lists of values.
+    """
+    keys = sorted(settings)
+    return [
+        dict(zip(keys, values))
+        for values in itertools.product(*(settings[k] for k in keys))
+    ]
+
+
+def evaluate(doc, overrides):
+    """
+    Analyze the pages of *doc* with parameter *overrides* and return
+    a Counter of zone, line, and token counts and, if *doc* has a
+    reference, the numbers of predicted, reference, and matched blocks.
+    """
+    params = _parameters(doc.bit_pages, overrides)
+    counts = Counter()
+    for page, bitmap in doc.bit_pages:
+        tokens = page.tokens
+        counts['pages'] += 1
+        counts['tokens'] += len(tokens)
+        blocks = []
+        if tokens:
+            geometry = _token_geometry(tokens)
+            for i, (bbox, path) in enumerate(_zones(bitmap, params)):
+                lines = _zone_lines(tokens, bitmap, bbox, geometry)
+                blocks.append(_make_block(tokens, lines, i+1, path))
+        counts['zones'] += len(blocks)
+        counts['lines'] += sum(len(b.lines) for b in blocks)
+        counts['lost_tokens'] += len(tokens) - sum(
+            len(l.tokens) for b in blocks for l in b.lines
+        )
+        if doc.reference is not None:
+            predicted = [
+                (b.llx, b.lly, b.urx, b.ury) for b in blocks if b.lines
+            ]
+            reference = doc.reference.get(page.id, [])
+            counts['predicted'] += len(predicted)
+            counts['reference'] += len(reference)
+            counts['matched'] += _match_blocks(predicted, reference)
+    return counts
+
+
+def _match_blocks(predicted, reference):
+    """
+    Return the number of *reference* bboxes matched one-to-one by a
+    *predicted* bbox with an IoU of at least MATCH_IOU.
+    """
+    unmatched = list(predicted)
+    matched = 0
+    for ref in reference:
+        scores = [(_iou(ref, p), i) for i, p in enumerate(unmatched)]
+        if scores:
+            score, i = max(scores)
+            if score >= MATCH_IOU:
+                del unmatched[i]
+                matched += 1
+    return matched
+
+
+def _iou(a, b):
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w * h
+    union = ((a[2]-a[0]) * (a[3]-a[1])) + ((b[2]-b[0]) * (b[3]-b[1])) - inter
+    return inter / union
+
+
+def sweep(docs, configs, processes=None):
+    """
+    Evaluate each parameter set in *configs* against all of *docs*.
+
+    Yields one result per parameter set, as it finishes, in the form
+    returned by :func:`freki.batch.run_jobs`, where `info` holds the
+    summed counts of :func:`evaluate` and, with references, the block
+    `precision`, `recall`, and `f1`. The documents are given to each
+    worker once, not once per parameter set.
+    """
+    jobs = [(json.dumps(config, sort_keys=True), config) for config in configs]
+    return batch.run_jobs(
+        _evaluate_job, jobs, processes=processes,
+        initializer=_init_worker, initargs=(docs,)
+    )
+
+
+def _init_worker(docs):
+    global _docs
+    _docs = docs
+
+
+def _evaluate_job(job):
+    _, config = job
+    counts = Counter()
+    for doc in _docs:
+        counts.update(evaluate(doc, config))
+    info = dict(counts)
+    if any(doc.reference is not None for doc in _docs):
+        matched = counts['matched']
+        p = matched / counts['predicted'] if counts['predicted'] else 0.0
+        r = matched / counts['reference'] if counts['reference'] else 0.0
+        info['precision'] = round(p, 4)
+        info['recall'] = round(r, 4)
+        info['f1'] = round((2 * p * r / (p + r)) if p + r else 0.0, 4)
+    return info
+
+
+def _reference_path(refdir, doc_id):
+    for ext in ('.freki', '.freki.gz'):
+        path = os.path.join(refdir, doc_id + ext)
+        if os.path.exists(path):
+            return path
+    logging.warning('No reference file for {}'.format(doc_id))
+    return None
+
+
+def _parse_setting(s):
+    key, sep, values = s.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError('expected KEY=VALUES: ' + s)
+    try:
+        values = json.loads(values)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid JSON values: ' + values)
+    if not isinstance(values, list):
+        values = [values]
+    return key, values
+
+
+def main(arglist=None):
+    from freki.main import readers, _doc_id_from_path
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='Evaluate XY-cut parameter sets on a set of documents',
+        prog='freki sweep',
+        epilog='examples:\n'
+               '    freki sweep --set x_gap_scale=[0.5,1,2] \\\n'
+               '                --set max_y_density=[0,0.01] a.xml b.xml'
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='count', dest='verbosity', default=2,
+        help='increase the verbosity (can be repeated: -vvv)'
+    )
+    parser.add_argument(
+        '-r', '--reader',
+        choices=('tetml', 'pdfminer'), default='tetml'
+    )
+    parser.add_argument(
+        '--set',
+        metavar='KEY=VALUES', dest='settings', action='append',
+        type=_parse_setting,
+        help='sweep parameter KEY over a JSON list of VALUES; a list '
+             'value must be nested, e.g. min_vcut_size=[[0.05,0.2]] '
+             '(repeatable)'
+    )
+    parser.add_argument(
+        '--configs',
+        metavar='FILE',
+        help='read parameter sets from a JSON list of objects in FILE'
+    )
+    parser.add_argument(
+        '--reference',
+        metavar='DIR',
+        help='compare blocks to the Freki file DIR/<doc_id>.freki[.gz]'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar='N', type=int,
+        help='number of worker processes (default: one per CPU)'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        metavar='FILE',
+        help='write the results table to FILE instead of stdout'
+    )
+    parser.add_argument('infiles', nargs='+')
+    args = parser.parse_args(arglist)
+    logging.basicConfig(level=50-(args.verbosity*10))
+
+    configs = grid(dict(args.settings or []))
+    if args.configs is not None:
+        with open(args.configs, encoding='utf-8') as f:
+            configs.extend(json.load(f))
+
+    docs = []
+    for infile in args.infiles:
+        doc_id = _doc_id_from_path(infile)
+        logging.info('Loading {}'.format(infile))
+        reference = None
+        if args.reference is not None:
+            reference = _reference_path(args.reference, doc_id)
+        reader = readers[args.reader](infile)
+        docs.append(load_document(reader, id=doc_id, reference=reference))
+
+    results = list(sweep(docs, configs, processes=args.jobs))
+    failures = batch.report(results)
+    ok = [r for r in results if r['status'] == 'ok']
+    ok.sort(key=lambda r: (-r['info'].get('f1', 0), r['path']))
+    keys = sorted(set(k for r in ok for k in r['info']))
+    lines = ['\t'.join(['params'] + keys)]
+    for r in ok:
+        lines.append('\t'.join(
+            [r['path']] + [str(r['info'].get(k, '')) for k in keys]
+        ))
+    if args.output is None:
+        print('\n'.join(lines))
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+    if failures:
+        sys.exit(1)
@@ -0,0 +1,111 @@
+"""
+Layout templates for the pages of a document.
+
+The pages of most documents after the first share one layout (e.g.,
+two columns with a running header), but the XY-cut analyzer finds the
+cuts of each page from scratch. :class:`LayoutTemplates` remembers the
+cut trees of the most recent pages of a document, so the analyzer can
+try one on a new page: each cut of the template is checked against
+the new page and kept if the full search would make the same cut
+there, and only the parts of the page where a cut is not kept are
+searched again. The zones are always the same as those of the full
+search.
+"""
+
+import logging
+
+DEFAULT_MAXSIZE = 4
+
+
+class LayoutTemplates(object):
+    """
+    The cut trees of the last *maxsize* distinct layouts of a document,
+    with statistics of how often they are reused.
+
+    A template is a dict mapping the path of each cut zone (as in the
+    zone labels, e.g. `'lt'`) to its cut `(axis, position)`; zones not
+    in the dict are not cut. Call :meth:`reset` before each document,
+    as templates are only tried within a document; the statistics are
+    kept across documents.
+    """
+    def __init__(self, maxsize=DEFAULT_MAXSIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.partial = 0
+        self.misses = 0
+        self.zones_reused = 0
+        self.zones_checked = 0
+        self._templates = []  # (shape, cuts), most recent first
+
+    def reset(self):
+        """
+        Forget the templates of the previous document.
+        """
+        self._templates = []
+
+    def candidates(self, shape):
+        """
+        Return the templates for pages with bitmaps of *shape*, most
+        recently used first.
+        """
+        return [cuts for s, cuts in self._templates if s == shape]
+
+    def add(self, shape, cuts):
+        """
+        Remember the template *cuts* of a page with a bitmap of *shape*
+        as the most recent one.
+        """
+        entry = (shape, cuts)
+        if entry in self._templates:
+            self._templates.remove(entry)
+        self._templates.insert(0, entry)
+        del self._templates[self.maxsize:]
+
+    def record(self, reused, checked):
+        """
+        Count a page on which the template was kept for *reused* of the
+        *checked* zones (i.e., the full search would have made the same
+        cut, or no cut, in them).
+        """
+        if reused == 0:
+            self.misses += 1
+        elif reused == checked:
+            self.hits += 1
+        else:
+            self.partial += 1
+        self.zones_reused += reused
+        self.zones_checked += checked
+
+    @property
+    def hit_rate(self):
+        pages = self.hits + self.partial + self.misses
+        return self.hits / pages if pages else 0.0
+
+    @property
+    def reuse_rate(self):
+        if not self.zones_checked:
+            return 0.0
+        return self.zones_reused / self.zones_checked
+
+    def stats(self):
+        """
+        Return a dict of template statistics.
+        """
+        return {
+            'hits': self.hits,
+            'partial': self.partial,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+            'zones_reused': self.zones_reused,
+            'zones_checked': self.zones_checked,
+            'reuse_rate': self.reuse_rate,
+        }
+
+    def log_stats(self):
+        logging.info(
+            'Layout templates: {hits} hits, {partial} partial, {misses} '
+            'misses ({rate:.1%} hit rate, {reuse:.1%} of checked zones '
+            'reused)'.format(
+                rate=self.hit_rate, reuse=self.reuse_rate, **self.stats()
+            )
+        )
@@ -8,6 +8,7 @@ import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
 
 from freki.analyzers import base
+from freki.analyzers.memo import fingerprint
 from freki.structures import Line, Block, Document
 
 
@@ -15,25 +16,37 @@ class XYCutAnalyzer(base.FrekiAnalyzer):
     """
     Analyze PDF pages using a modified XY-cut algorithm.
     """
+    def __init__(self, debug=False, memo=None, params=None,
+                 pyramid=False, tolerance=0, templates=None):
+        base.FrekiAnalyzer.__init__(self, debug=debug)
+        self.memo = memo
+        self.params = params
+        self.pyramid = pyramid
+        self.tolerance = tolerance
+        self.templates = templates
+
     def analyze(self, reader, id=None):
         doc = Document(id=id)
+        if self.templates is not None:
+            self.templates.reset()
 
-        bit_pages = [(p, _make_bitmap(p)) for p in reader.pages()]
-        params = _parameters(bit_pages)
+        pages = reader.pages()
+        # the parameters only need the tokens, so each page's bitmap
+        # is made when the page is analyzed and dropped after it
+        params = _parameters([(p, None) for p in pages], self.params)
 
-        for page, bitmap in bit_pages:
+        for page in pages:
             logging.debug('Analyzing page id={}'.format(page.id))
-            blocks = []
             tokens = page.tokens
             numtoks = len(tokens)
 
-            if tokens:
-                for i, zone in enumerate(_zones(bitmap, params, self._debug)):
-                    bbox, path = zone
-                    block = _zone_to_block(
-                        tokens, bitmap, bbox, i+1, path, debug=self._debug
-                    )
-                    blocks.append(block)
+            bitmap = _make_bitmap(page)
+            zones = self._page_zones(page, bitmap, params)
+            del bitmap
+            blocks = [
+                _make_block(tokens, lines, i+1, path)
+                for i, (bbox, path, lines) in enumerate(zones)
+            ]
         
             numtoks_b = sum(len(l.tokens) for b in blocks for l in b.lines)
             if numtoks_b != numtoks:
@@ -47,6 +60,46 @@ class XYCutAnalyzer(base.FrekiAnalyzer):
 
         return doc
 
+    def _page_zones(self, page, bitmap, params):
+        """
+        Return the zones of *page* as a list of `(bbox, path, lines)`,
+        where *lines* lists the token indices of each line in the zone.
+        """
+        memo = None if self._debug else self.memo
+        templates = None if self._debug else self.templates
+        if memo is not None:
+            key_params = params
+            if self.pyramid and self.tolerance:
+                key_params = dict(params, pyramid_tolerance=self.tolerance)
+            key = fingerprint(page, key_params)
+            zones = memo.get(key)
+            if zones is not None:
+                if templates is not None and zones:
+                    templates.add(bitmap.shape, _cut_tree(zones))
+                return zones
+
+        zones = []
+        tokens = page.tokens
+        if tokens:
+            pyramid = None
+            if self.pyramid:
+                pyramid = _Pyramid.for_params(bitmap, params, self.tolerance)
+            geometry = _token_geometry(tokens)
+            boxes = None
+            if templates is not None:
+                boxes = _template_zones(bitmap, params, templates, pyramid)
+            if boxes is None:
+                boxes = _zones(bitmap, params, self._debug, pyramid)
+            for bbox, path in boxes:
+                lines = _zone_lines(tokens, bitmap, bbox, geometry)
+                zones.append((bbox, path, lines))
+
+        if memo is not None:
+            memo.put(key, zones)
+        if templates is not None and zones:
+            templates.add(bitmap.shape, _cut_tree(zones))
+        return zones
+
 
 def _make_bitmap(page):
     w, h = int(page.page_width), int(page.page_height)
@@ -79,7 +132,7 @@ def _make_bitmap(page):
 #     return bitmap
 
 
-def _zones(bitmap, params, debug=False):
+def _zones(bitmap, params, debug=False, pyramid=None):
     
     # try to clump nearby blocks through filters    
     # bitmap = ndimage.filters.maximum_filter(bitmap, size=(3,5))
@@ -95,7 +148,8 @@ def _zones(bitmap, params, debug=False):
 
     h, w = bitmap.shape
     bbox = (0, 0, w, h)
-    for bbox, path in _find_zones(bitmap, bbox, '', params, ax=ax):
+    for bbox, path in _find_zones(bitmap, bbox, '', params, ax=ax,
+                                  pyramid=pyramid):
         
         llx, lly, urx, ury = bbox
         logging.debug(
@@ -114,7 +168,14 @@ def _zones(bitmap, params, debug=False):
         plt.show()
 
 
-def _parameters(bit_pages):
+def _parameters(bit_pages, overrides=None):
+    """
+    Return the XY-cut parameters for the pages in *bit_pages*.
+
+    Values in *overrides* replace the defaults. The token-height-based
+    gap sizes can also be scaled with `x_gap_scale` and `y_gap_scale`.
+    """
+    overrides = dict(overrides or {})
     params = {
         # min sizes are minimum (height, width) ratios of resulting cuts
         'min_vcut_size': (1/32, 1/6),
@@ -128,8 +189,8 @@ def _parameters(bit_pages):
     for page, bitmap in bit_pages:
         tok_heights.extend(t.height for t in page.tokens)
     h = (sum(tok_heights) / len(tok_heights)) if len(tok_heights) else 1
-    params['min_x_gap'] = h
-    params['min_y_gap'] = h
+    params['min_x_gap'] = h * overrides.pop('x_gap_scale', 1)
+    params['min_y_gap'] = h * overrides.pop('y_gap_scale', 1)
 
     # # infer minimum x and y gap by taking a histogram of page contents
     # # (this more sophisticated method unfortunately didn't work as well
@@ -145,6 +206,13 @@ def _parameters(bit_pages):
     # ds = np.array([b-a for a, b in ygaps])
     # params['min_y_gap'] = np.histogram(ds, bins='sqrt')[1][1]
 
+    unknown = set(overrides).difference(params)
+    if unknown:
+        raise ValueError(
+            'Unknown XY-cut parameters: {}'.format(', '.join(sorted(unknown)))
+        )
+    params.update(overrides)
+
     logging.debug(
         ''.join('\n  {} = {}'.format(k, v) for k, v in params.items())
     )
@@ -152,24 +220,40 @@ def _parameters(bit_pages):
     return params
 
 
-def _find_zones(bitmap, bbox, path, params, ax=None):
+def _find_zones(bitmap, bbox, path, params, ax=None, pyramid=None):
     """
     This is a modified implementation of the XY-Cut method of layout
     analysis. https://en.wikipedia.org/wiki/Recursive_XY-cut
+
+    If *pyramid* is given, gaps are found with its coarse level where
+    possible instead of summing over the full-resolution area.
     """
     
     # possible optimization: check if area size is enough for any cut
 
     llx, lly, urx, ury = bbox
-    area = bitmap[lly:ury, llx:urx]
-    x_vec, y_vec = area.sum(axis=0), area.sum(axis=1)
-
-    lft, x_gaps, rgt = _gaps(
-        x_vec, params['min_x_gap'], params['max_x_density'], llx
-    )
-    btm, y_gaps, top = _gaps(
-        y_vec, params['min_y_gap'], params['max_y_density'], lly
-    )
+    x_result = y_result = None
+    if pyramid is not None:
+        x_result = pyramid.gaps(
+            bbox, 0, params['min_x_gap'], params['max_x_density']
+        )
+        y_result = pyramid.gaps(
+            bbox, 1, params['min_y_gap'], params['max_y_density']
+        )
+    if x_result is None or y_result is None:
+        area = bitmap[lly:ury, llx:urx]
+    if x_result is None:
+        x_result = _gaps(
+            area.sum(axis=0), params['min_x_gap'], params['max_x_density'],
+            llx
+        )
+    if y_result is None:
+        y_result = _gaps(
+            area.sum(axis=1), params['min_y_gap'], params['max_y_density'],
+            lly
+        )
+    lft, x_gaps, rgt = x_result
+    btm, y_gaps, top = y_result
 
     # debugging
     if ax is not None:
@@ -191,44 +275,305 @@ def _find_zones(bitmap, bbox, path, params, ax=None):
         x_gaps, y_gaps, (lft, btm, rgt, top), bitmap.shape,
         params['min_vcut_size'], params['min_hcut_size']
     )
-    if cut_axis == 0:  # cut horizontally
-        inner_bbox = (llx, mid, urx, ury)
-        for zone in _find_zones(bitmap, inner_bbox, path+'t', params, ax=ax):
-            yield zone
-        inner_bbox = (llx, lly, urx, mid)
-        for zone in _find_zones(bitmap, inner_bbox, path+'b', params, ax=ax):
-            yield zone
-
-    elif cut_axis == 1:  # cut vertically
-        inner_bbox = (llx, lly, mid, ury)
-        for zone in _find_zones(bitmap, inner_bbox, path+'l', params, ax=ax):
-            yield zone
-        inner_bbox = (mid, lly, urx, ury)
-        for zone in _find_zones(bitmap, inner_bbox, path+'r', params, ax=ax):
-            yield zone
+    if cut_axis is None:
+        yield bbox, path
+    else:
+        for inner_bbox, inner_path in _children(bbox, path, cut_axis, mid):
+            for zone in _find_zones(bitmap, inner_bbox, inner_path, params,
+                                    ax=ax, pyramid=pyramid):
+                yield zone
+
 
+def _children(bbox, path, axis, mid):
+    """
+    Return the bboxes and paths of the two zones made by cutting zone
+    *bbox* at *mid* along *axis*, in the order they are searched.
+    """
+    llx, lly, urx, ury = bbox
+    if axis == 0:  # cut horizontally
+        return [((llx, mid, urx, ury), path+'t'),
+                ((llx, lly, urx, mid), path+'b')]
+    else:  # cut vertically
+        return [((llx, lly, mid, ury), path+'l'),
+                ((mid, lly, urx, ury), path+'r')]
+
+
+def _template_zones(bitmap, params, templates, pyramid=None):
+    """
+    Return the zones of *bitmap* like :func:`_zones`, but reusing a
+    template from *templates* (a LayoutTemplates) where it gives the
+    same zones, or `None` if no template can be used.
+
+    A zone of the template is kept if the gaps of the zone on this
+    bitmap give the same cut (or no cut) as the template, and zones
+    where they do not are searched with :func:`_find_zones`, so the
+    result is the same as that of a full search. The projections of
+    the zones of the template are summed from those of their children,
+    so each part of the bitmap is only summed once. This only works if
+    gaps must be empty (the default densities of 0): otherwise the
+    order of summation could change which gaps are found.
+    """
+    if params['max_x_density'] != 0 or params['max_y_density'] != 0:
+        return None
+    h, w = bitmap.shape
+    root = (0, 0, w, h)
+    best = None
+    for cuts in templates.candidates(bitmap.shape):
+        # prefer the template with the most cuts that are still empty
+        clear = _clear_cuts(bitmap, root, '', cuts, params)
+        if best is None or len(clear) > len(best[1]):
+            best = (cuts, clear)
+    if best is None or ('' in best[0] and '' not in best[1]):
+        templates.record(0, 0)
+        return None
+    cuts, clear = best
+    sums = {}
+    _template_sums(bitmap, root, '', cuts, clear, sums)
+    zones = []
+    counts = [0, 0]  # zones reused, zones checked
+    _check_template(bitmap, root, '', params, cuts, sums, pyramid, zones,
+                    counts)
+    templates.record(*counts)
+    return zones
+
+
+def _clear_cuts(bitmap, bbox, path, cuts, params):
+    """
+    Return the paths of the zones of template *cuts* whose cut is
+    still clear on *bitmap*, descending only through such zones.
+
+    A cut is made in the middle of a gap of at least the minimum gap
+    size, so the band of about half that size on either side of the
+    cut must be empty for it to be made again. This is a cheap
+    necessary condition for a cut to be reused.
+    """
+    cut = cuts.get(path)
+    if cut is None:
+        return set()
+    axis, mid = cut
+    llx, lly, urx, ury = bbox
+    if axis == 0:
+        r = max(0, int(params['min_y_gap'] / 2) - 1)
+        band = bitmap[max(lly, mid - r):min(ury, mid + r + 1), llx:urx]
     else:
-        yield bbox, path
+        r = max(0, int(params['min_x_gap'] / 2) - 1)
+        band = bitmap[lly:ury, max(llx, mid - r):min(urx, mid + r + 1)]
+    if band.size == 0 or band.any():
+        return set()
+    clear = set([path])
+    for inner_bbox, inner_path in _children(bbox, path, axis, mid):
+        clear.update(
+            _clear_cuts(bitmap, inner_bbox, inner_path, cuts, params)
+        )
+    return clear
+
+
+def _template_sums(bitmap, bbox, path, cuts, clear, sums):
+    """
+    Put the column and row sums of zone *bbox* and the zones of the
+    template under it in *sums*, and return those of *bbox*.
+    """
+    if path in clear:
+        axis, mid = cuts[path]
+        (a_x, a_y), (b_x, b_y) = [
+            _template_sums(bitmap, inner_bbox, inner_path, cuts, clear, sums)
+            for inner_bbox, inner_path in _children(bbox, path, axis, mid)
+        ]
+        if axis == 0:  # top, bottom
+            x, y = a_x + b_x, np.concatenate((b_y, a_y))
+        else:  # left, right
+            x, y = np.concatenate((a_x, b_x)), a_y + b_y
+    else:
+        llx, lly, urx, ury = bbox
+        area = bitmap[lly:ury, llx:urx]
+        x, y = area.sum(axis=0), area.sum(axis=1)
+    sums[path] = (x, y)
+    return x, y
+
+
+def _check_template(bitmap, bbox, path, params, cuts, sums, pyramid, zones,
+                    counts):
+    # find the cut of zone *bbox* as _find_zones() does, but with the
+    # sums of the template; keep the template's zones if it is the same
+    llx, lly, urx, ury = bbox
+    x_result = y_result = None
+    if pyramid is not None:
+        x_result = pyramid.gaps(
+            bbox, 0, params['min_x_gap'], params['max_x_density']
+        )
+        y_result = pyramid.gaps(
+            bbox, 1, params['min_y_gap'], params['max_y_density']
+        )
+    if x_result is None or y_result is None:
+        x, y = sums.get(path) or _template_sums(bitmap, bbox, path, cuts,
+                                                set(), sums)
+    if x_result is None:
+        x_result = _gaps(
+            x, params['min_x_gap'], params['max_x_density'], llx
+        )
+    if y_result is None:
+        y_result = _gaps(
+            y, params['min_y_gap'], params['max_y_density'], lly
+        )
+    lft, x_gaps, rgt = x_result
+    btm, y_gaps, top = y_result
+    cut = _best_cut_axis(
+        x_gaps, y_gaps, (lft, btm, rgt, top), bitmap.shape,
+        params['min_vcut_size'], params['min_hcut_size']
+    )
+    counts[1] += 1
+    axis, mid = cut
+    if cut != cuts.get(path, (None, None)):
+        # the cut is already known, so only the zones it makes are
+        # searched from scratch
+        if axis is None:
+            zones.append((bbox, path))
+            return
+        for inner_bbox, inner_path in _children(bbox, path, axis, mid):
+            zones.extend(_find_zones(bitmap, inner_bbox, inner_path,
+                                     params, pyramid=pyramid))
+        return
+    counts[0] += 1
+    if axis is None:
+        zones.append((bbox, path))
+        return
+    for inner_bbox, inner_path in _children(bbox, path, axis, mid):
+        _check_template(bitmap, inner_bbox, inner_path, params, cuts, sums,
+                        pyramid, zones, counts)
+
+
+def _cut_tree(zones):
+    """
+    Return the template (see :class:`LayoutTemplates`) of the *zones*
+    of a page, a list of `(bbox, path, ...)` as from
+    :meth:`XYCutAnalyzer._page_zones`.
+    """
+    # the zones under a path cover its zone, so its bbox is their union
+    boxes = {}
+    for zone in zones:
+        bbox, path = zone[0], zone[1]
+        for i in range(len(path) + 1):
+            box = boxes.get(path[:i], bbox)
+            boxes[path[:i]] = (min(box[0], bbox[0]), min(box[1], bbox[1]),
+                               max(box[2], bbox[2]), max(box[3], bbox[3]))
+    cuts = {}
+    for path, box in boxes.items():
+        if path.endswith('t'):
+            cuts[path[:-1]] = (0, int(box[1]))
+        elif path.endswith('r'):
+            cuts[path[:-1]] = (1, int(box[0]))
+    return cuts
 
 
 def _gaps(vec, min_gap, max_density, offset):
+    mask = np.zeros(0, dtype=bool)
+    if len(vec):
+        mask = vec/(vec.max() or 1) <= max_density
+    return _mask_gaps(mask, min_gap, offset, pad=(1 <= max_density))
+
+
+def _mask_gaps(mask, min_gap, offset, pad=False):
+    """
+    Return the start, the gaps of at least *min_gap*, and the end of
+    the runs of True values in *mask*, offset by *offset*.
+    """
     gaps = []
 
-    start, end = offset, len(vec) + offset
+    start, end = offset, len(mask) + offset
     if end > start:
-        vec = np.pad(vec/(vec.max() or 1), ((1,1)),
-                     'constant', constant_values=1)
-        gaps = np.reshape(np.where(np.diff(vec <= max_density)), (-1,2))
+        mask = np.pad(mask, ((1,1)), 'constant', constant_values=pad)
+        gaps = np.reshape(np.where(np.diff(mask)), (-1,2))
         gaps += offset
     if len(gaps) and gaps[0][0] == start:
         start, gaps = gaps[0][1], gaps[1:]
     if len(gaps) and gaps[-1][1] == end:
         end, gaps = gaps[-1][0], gaps[:-1]
     if len(gaps):
-        gaps = [(a, b) for a, b in gaps if b-a >= min_gap]
+        # most gaps (e.g., between words) are too small, so they are
+        # dropped before making the list
+        gaps = gaps[gaps[:, 1] - gaps[:, 0] >= min_gap]
+        gaps = [(a, b) for a, b in gaps]
     return start, gaps, end
 
 
+class _Pyramid(object):
+    """
+    A bitmap with a coarse level of sums over *factor* x *factor*
+    cells.
+
+    Empty columns (or rows) of a zone are found on the coarse level,
+    and only the cells next to an empty cell or the zone's edge are
+    examined at full resolution. Empty runs narrower than
+    `2 * factor - 1` can be missed when they lie between non-empty
+    cells, so gaps are exact if that is no wider than the minimum gap
+    size.
+    """
+    # zones smaller than this are faster to sum at full resolution
+    min_area = 1 << 16
+
+    def __init__(self, bitmap, factor):
+        self.bitmap = bitmap
+        self.factor = f = factor
+        # only whole cells are used, so partial cells at the edges of
+        # the page are left out
+        h, w = bitmap.shape[0] // f, bitmap.shape[1] // f
+        rows = bitmap[:h*f].reshape(h, f, bitmap.shape[1]).sum(axis=1)
+        self.coarse = rows[:, :w*f].reshape(h, w, f).sum(axis=2)
+
+    @classmethod
+    def for_params(cls, bitmap, params, tolerance=0):
+        """
+        Return a pyramid with the largest factor for which gaps up to
+        *tolerance* points wider than the minimum gap sizes in *params*
+        are found, or `None` if no factor above 1 is possible.
+        """
+        min_gap = min(params['min_x_gap'], params['min_y_gap'])
+        factor = int((min_gap + tolerance + 1) // 2)
+        if factor < 2:
+            return None
+        return cls(bitmap, factor)
+
+    def gaps(self, bbox, axis, min_gap, max_density):
+        """
+        Return the gaps of zone *bbox* along *axis* (0 for columns, 1
+        for rows) like :func:`_gaps`, or `None` if the zone is too
+        small to benefit or *max_density* is not 0.
+        """
+        llx, lly, urx, ury = bbox
+        if max_density != 0 or (urx - llx) * (ury - lly) < self.min_area:
+            return None
+        bitmap, coarse = self.bitmap, self.coarse
+        if axis == 1:  # work on the transpose so columns become rows
+            bitmap, coarse = bitmap.T, coarse.T
+            llx, lly, urx, ury = lly, llx, ury, urx
+        f = self.factor
+        r0, r1 = -(-lly // f), ury // f  # coarse rows within the zone
+        c0, c1 = -(-llx // f), urx // f  # coarse columns within the zone
+        if r1 <= r0 or c1 <= c0:
+            return None
+        rows = bitmap[lly:ury]
+        x0, x1 = c0 * f, c1 * f
+
+        cells = coarse[r0:r1, c0:c1].sum(axis=0)
+        for a, b in ((lly, r0 * f), (r1 * f, ury)):  # partial rows
+            if b > a:
+                cells += bitmap[a:b, x0:x1].sum(axis=0).reshape(-1, f).sum(1)
+        empty = cells == 0
+
+        mask = np.zeros(urx - llx, dtype=bool)
+        mask[x0 - llx:x1 - llx] = np.repeat(empty, f)
+        for a, b in ((llx, x0), (x1, urx)):  # partial columns
+            if b > a:
+                mask[a - llx:b - llx] = rows[:, a:b].sum(axis=0) == 0
+        # refine non-empty cells next to empty cells or the zone's edges
+        edges = np.pad(empty, 1, 'constant', constant_values=True)
+        check = np.flatnonzero(~empty & (edges[:-2] | edges[2:]))
+        if len(check):
+            cols = (x0 + check[:, None] * f + np.arange(f)).ravel()
+            mask[cols - llx] = rows[:, cols].sum(axis=0) == 0
+        return _mask_gaps(mask, min_gap, llx)
+
+
 def _best_cut_axis(x_gaps, y_gaps, bbox, shape, min_vcut_size, min_hcut_size):
     cuts = []  # (size, axis, mid)
     lft, btm, rgt, top = bbox
@@ -247,33 +592,64 @@ def _best_cut_axis(x_gaps, y_gaps, bbox, shape, min_vcut_size, min_hcut_size):
     else:
         return (None, None)
 
-def _zone_to_block(tokens, bitmap, bbox, id, path, debug):
+
+def _zone_lines(tokens, bitmap, bbox, geometry=None):
+    """
+    Segment the zone *bbox* into lines and return the indices in
+    *tokens* of the tokens in each line.
+
+    Lines are bands between the middles of the empty rows of the zone.
+    Like the zone, each band includes tokens within 1pt of it, so a
+    token straddling two bands is in neither, and a very short token
+    can be in two. *geometry* is the :func:`_token_geometry` of
+    *tokens*, if already computed.
+    """
+    if geometry is None:
+        geometry = _token_geometry(tokens)
     llx, lly, urx, ury = bbox
-    tokens = list(filter(_bbox_filter(llx, lly, urx, ury), tokens))
-    block = Block(id=id, label=path)
+    t_llx, t_lly, t_urx, t_ury = geometry
+    # +- 1 for rounding problems in the bitmap. This should not capture
+    # extra characters unless they already overlapped (1pt height
+    # characters are probably rare)
+    idxs = np.flatnonzero(
+        (t_llx >= llx - 1) & (t_lly >= lly - 1) &
+        (t_urx <= urx + 1) & (t_ury <= ury + 1)
+    )
 
     btm, y_gaps, top = _gaps(bitmap[lly:ury, llx:urx].max(axis=1), 0, 0, lly)
     mids = [sum(gap)/2 for gap in y_gaps]
-    for btm, top in zip([lly] + mids, mids + [ury]):
-        ts = list(filter(_bbox_filter(llx, btm, urx, top), tokens))
-        if ts:
-            line = Line(ts)
-            line.sort()
-            block.append(line)
+    bounds = np.array([lly] + mids + [ury], dtype=np.float64)
+    # a token is in band k if bounds[k] - 1 <= lly and ury <= bounds[k+1] + 1
+    first = np.searchsorted(bounds[1:] + 1, t_ury[idxs], side='left')
+    last = np.searchsorted(bounds[:-1] - 1, t_lly[idxs], side='right') - 1
+    counts = np.maximum(last - first + 1, 0)
+    if counts.sum() == 0:
+        return []
+    # one (band, token) pair per band a token is in
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    bands = np.repeat(first, counts) + np.arange(counts.sum()) - starts
+    members = np.repeat(idxs, counts)
+    order = np.argsort(bands, kind='mergesort')  # stable: keep token order
+    bands, members = bands[order], members[order]
+    breaks = np.flatnonzero(np.diff(bands)) + 1
+    return [line.tolist() for line in np.split(members, breaks)]
+
+
+def _token_geometry(tokens):
+    """
+    Return arrays of the llx, lly, urx, and ury of *tokens*.
+    """
+    geometry = np.array(
+        [(t.llx, t.lly, t.urx, t.ury) for t in tokens], dtype=np.float64
+    ).reshape((-1, 4))
+    return geometry.T
+
 
+def _make_block(tokens, lines, id, path):
+    block = Block(id=id, label=path)
+    for idxs in lines:
+        line = Line([tokens[i] for i in idxs])
+        line.sort()
+        block.append(line)
     block.sort()
     return block
-
-
-def _bbox_filter(llx, lly, urx, ury):
-    def bbox_filter(t):
-        # +- 1 for rounding problems in the bitmap. This
-        # should not capture extra characters unless they already
-        # overlapped (1pt height characters are probably rare)
-        return (
-            t.llx >= llx - 1 and
-            t.lly >= lly - 1 and
-            t.urx <= urx + 1 and
-            t.ury <= ury + 1
-        )
-    return bbox_filter
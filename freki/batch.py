@@ -0,0 +1,141 @@
+"""
+Helpers for converting many documents in parallel.
+
+A batch is a list of *jobs*, one per document. Jobs are run over a
+process pool, each failure is recorded for its document instead of
+aborting the batch, and the time spent on each document is kept so
+slow documents can be found afterwards.
+"""
+
+import os
+import time
+import logging
+import traceback
+import multiprocessing
+from functools import partial
+
+from freki.fileio import strip_compression_ext
+
+
+def find_inputs(indir, suffixes=None):
+    """
+    Return the paths of files under *indir*, relative to *indir* and
+    in sorted order. If *suffixes* is given, only files ending with
+    one of them are returned.
+    """
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(indir):
+        dirnames.sort()
+        for fn in sorted(filenames):
+            if suffixes and not fn.endswith(tuple(suffixes)):
+                continue
+            path = os.path.join(dirpath, fn)
+            paths.append(os.path.relpath(path, indir))
+    return paths
+
+
+def read_manifest(path):
+    """
+    Read a manifest of inputs, one per line, with tab-separated fields.
+    Blank lines and lines starting with `#` are ignored.
+
+    :return: list of field lists
+    """
+    rows = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            rows.append(line.split('\t'))
+    return rows
+
+
+def output_path(outdir, relpath, ext):
+    """
+    Return the path under *outdir* for input *relpath*, with its
+    extension (and any `.gz`, `.bz2`, or `.xz`) replaced by *ext*.
+    """
+    relpath = strip_compression_ext(relpath)
+    return os.path.join(outdir, os.path.splitext(relpath)[0] + ext)
+
+
+def run_jobs(func, jobs, processes=None, initializer=None, initargs=(),
+             ordered=False):
+    """
+    Call `func(job)` for each of *jobs* and yield a result for each
+    as it finishes, or in the order of *jobs* if *ordered* is `True`.
+
+    Results are dicts with the job's `path` (its first item), a
+    `status` of `ok` or `error`, the `seconds` it took, and either the
+    `info` dict returned by *func* or the `error` message. With
+    *processes* of 1 the jobs are run in this process; otherwise they
+    are run over a pool of *processes* workers (default: one per CPU),
+    each calling `initializer(*initargs)` once when it starts.
+    """
+    guarded = partial(_run_job, func)
+    if processes == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for job in jobs:
+            yield guarded(job)
+    else:
+        pool = multiprocessing.Pool(
+            processes, initializer=initializer, initargs=initargs
+        )
+        imap = pool.imap if ordered else pool.imap_unordered
+        try:
+            for result in imap(guarded, jobs, chunksize=1):
+                yield result
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+def _run_job(func, job):
+    start = time.time()
+    result = {'path': job[0]}
+    try:
+        result['info'] = func(job) or {}
+        result['status'] = 'ok'
+    except Exception as ex:
+        logging.debug(traceback.format_exc())
+        result['status'] = 'error'
+        result['error'] = '{}: {}'.format(type(ex).__name__, ex)
+    result['seconds'] = time.time() - start
+    return result
+
+
+def report(results, timings=None):
+    """
+    Log each failed job in *results* and return the number of failures.
+
+    If *timings* is a path, write a tab-separated table of the results
+    to it, slowest first.
+    """
+    failures = [r for r in results if r['status'] != 'ok']
+    for r in failures:
+        logging.error('{}: {}'.format(r['path'], r['error']))
+    logging.info(
+        '{} documents, {} failed'.format(len(results), len(failures))
+    )
+    if timings is not None:
+        write_timings(timings, results)
+    return len(failures)
+
+
+def write_timings(path, results):
+    keys = sorted(set(k for r in results for k in r.get('info', {})))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\t'.join(['path', 'status', 'seconds'] + keys + ['error']))
+        f.write('\n')
+        for r in sorted(results, key=lambda r: r['seconds'], reverse=True):
+            info = r.get('info', {})
+            fields = [r['path'], r['status'], '{:.3f}'.format(r['seconds'])]
+            fields.extend(str(info.get(k, '')) for k in keys)
+            fields.append(r.get('error', ''))
+            f.write('\t'.join(fields))
+            f.write('\n')
@@ -0,0 +1,165 @@
+"""
+On-disk cache of parsed reader output.
+
+Parsing large TetML or PDFMiner XML files takes far more time than
+analyzing the pages they contain, so repeated runs over the same
+inputs (e.g. while tuning analyzer settings) can skip parsing by
+caching the pages a reader produces. Entries are keyed by a hash of
+the input file's content together with the reader's name, version,
+and options, so renamed or copied files still hit the cache and
+changing the reader invalidates old entries. Pages are stored with
+:func:`freki.packing.pack_pages` in uncompressed `.npz` files, and the
+least recently used entries are removed when the cache grows past its
+size limit.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+
+import numpy as np
+
+from freki.readers.base import FrekiReader
+from freki.packing import FORMAT_VERSION, pack_pages, unpack_pages
+
+DEFAULT_MAX_BYTES = 1 << 30  # 1 GiB
+
+_ENTRY_EXT = '.npz'
+
+
+class ReaderCache(object):
+    """
+    Cache of reader output stored under *directory*, holding at most
+    *max_bytes* of entries.
+    """
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def reader(self, reader_class, name, infile, debug=False, **options):
+        """
+        Return a reader for *infile*, using cached pages if available.
+
+        On a miss, `reader_class(infile, debug=debug, **options)` parses
+        the file and its pages are added to the cache. Open files are
+        not cached and are always read with *reader_class*.
+        """
+        if hasattr(infile, 'read'):
+            return reader_class(infile, debug=debug, **options)
+        key = self.key(infile, name, reader_class.version, options)
+        pages = self.get(key)
+        if pages is not None:
+            logging.info('Using cached pages for {}'.format(infile))
+            return CachedReader(pages, debug=debug)
+        reader = reader_class(infile, debug=debug, **options)
+        self.put(key, reader.pages())
+        return reader
+
+    def key(self, path, name, version, options=None):
+        """
+        Return the cache key for the file at *path* read by the reader
+        *name* at *version* with *options*.
+        """
+        meta = json.dumps(
+            [name, version, FORMAT_VERSION, options or {}],
+            sort_keys=True
+        )
+        h = hashlib.sha1(file_digest(path).encode('ascii'))
+        h.update(meta.encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Return the pages stored for *key*, or `None` if there are none.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as arrays:
+                pages = unpack_pages(arrays)
+        except (IOError, OSError):
+            return None
+        except (KeyError, ValueError) as ex:
+            logging.warning(
+                'Ignoring unreadable cache entry {}: {}'.format(path, ex)
+            )
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass
+        return pages
+
+    def put(self, key, pages):
+        """
+        Store *pages* for *key*, then evict old entries if needed.
+        """
+        path = self._path(key)
+        dirs = os.path.dirname(path)
+        os.makedirs(dirs, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dirs, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **pack_pages(pages))
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache holds at
+        most `max_bytes`.
+        """
+        entries = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for fn in filenames:
+                if not fn.endswith(_ENTRY_EXT):
+                    continue
+                path = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            logging.debug('Evicted cache entry {}'.format(path))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + _ENTRY_EXT)
+
+
+class CachedReader(FrekiReader):
+    """
+    Reader serving pages previously loaded from a :class:`ReaderCache`.
+    """
+    def __init__(self, pages, debug=False):
+        FrekiReader.__init__(self, debug=debug)
+        self._pages = dict((page.id, page) for page in pages)
+
+    def pages(self, *page_ids):
+        if not page_ids:
+            page_ids = sorted(self._pages)
+        return [self._pages[pid] for pid in page_ids]
+
+
+def file_digest(path, blocksize=1 << 20):
+    """
+    Return the hex SHA-1 digest of the content of the file at *path*.
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(blocksize), b''):
+            h.update(chunk)
+    return h.hexdigest()
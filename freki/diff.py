@@ -0,0 +1,287 @@
+"""
+Compare two sets of Freki files.
+
+`freki diff` checks that a change to Freki leaves its output
+unchanged, or changed only in expected ways, over a whole corpus. The
+files of two output trees are paired by their relative paths (ignoring
+compression extensions) and compared over a process pool. The content
+of each pair is hashed first, so identical documents are skipped
+without parsing them. Other documents are compared block by block,
+aligning blocks by `block_id` and lines by their position in the
+block: bounding boxes are compared with a tolerance, and line text and
+all other attributes exactly. Each difference is put in one of these
+categories:
+
+* `blocks_added`, `blocks_removed`: a block_id on one side only
+* `zones_changed`: a block's bbox, page, or label changed
+* `lines_added`, `lines_removed`: a block has more or fewer lines
+* `respaced`: a line's text changed only in its whitespace
+* `text_changed`: a line's text changed otherwise
+* `attributes_changed`: a line's text is the same but its other
+  attributes (except its line number) changed
+
+Documents are `identical`, `equivalent` (different bytes but no
+differences beyond the tolerance, e.g. compact and full output),
+`changed`, `missing_old` or `missing_new` (only in one tree), or
+`error` (unreadable).
+"""
+
+import os
+import sys
+import hashlib
+import logging
+import argparse
+from collections import Counter, OrderedDict
+
+from freki import batch
+from freki.fileio import open_input, strip_compression_ext
+from freki.grep import FREKI_SUFFIXES
+from freki.serialize import read_preamble, _read_fonttable, _expand_fonts
+
+DEFAULT_TOLERANCE = 0.01  # points; compact output rounds to 0.01
+
+CATEGORIES = (
+    'blocks_added', 'blocks_removed', 'zones_changed', 'lines_added',
+    'lines_removed', 'respaced', 'text_changed', 'attributes_changed'
+)
+STATUSES = (
+    'identical', 'equivalent', 'changed', 'missing_old', 'missing_new',
+    'error'
+)
+
+
+def diff_files(old, new, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare the Freki files at *old* and *new* and return a Counter
+    of the differences in each category (empty if there are none).
+    """
+    old_blocks = _read_blocks(old)
+    new_blocks = _read_blocks(new)
+    diffs = Counter()
+    for block_id in old_blocks:
+        if block_id not in new_blocks:
+            diffs['blocks_removed'] += 1
+    for block_id, (attrs, lines) in new_blocks.items():
+        if block_id not in old_blocks:
+            diffs['blocks_added'] += 1
+            continue
+        old_attrs, old_lines = old_blocks[block_id]
+        if not _same_attrs(old_attrs, attrs, tolerance):
+            diffs['zones_changed'] += 1
+        if len(lines) > len(old_lines):
+            diffs['lines_added'] += len(lines) - len(old_lines)
+        elif len(lines) < len(old_lines):
+            diffs['lines_removed'] += len(old_lines) - len(lines)
+        for (a_attrs, a_text), (b_attrs, b_text) in zip(old_lines, lines):
+            if a_text != b_text:
+                if a_text.split() == b_text.split():
+                    diffs['respaced'] += 1
+                else:
+                    diffs['text_changed'] += 1
+            elif not _same_attrs(a_attrs, b_attrs, tolerance):
+                diffs['attributes_changed'] += 1
+    return diffs
+
+
+def _same_attrs(a, b, tolerance):
+    if a.keys() != b.keys():
+        return False
+    for key, value in a.items():
+        if key == 'bbox':
+            if not _same_bbox(value, b[key], tolerance):
+                return False
+        elif value != b[key]:
+            return False
+    return True
+
+
+def _same_bbox(a, b, tolerance):
+    try:
+        a = [float(x) for x in a.split(',')]
+        b = [float(x) for x in b.split(',')]
+    except ValueError:
+        return a == b
+    return len(a) == len(b) and all(
+        abs(x - y) <= tolerance for x, y in zip(a, b)
+    )
+
+
+def _read_blocks(path):
+    """
+    Return an ordered mapping of block_ids to `(attrs, lines)` for the
+    Freki file at *path*, where *lines* is a list of `(attrs, text)`.
+    Block attributes include `bbox`, `page`, and `label` but not
+    `doc_id`, `block_id`, or the line range, and line attributes
+    include expanded fonts but not the line number.
+    """
+    blocks = OrderedDict()
+    lines = None
+    fonttable = None
+    with open_input(path) as f:
+        for line in f:
+            line = line.decode('utf-8').rstrip('\n')
+            if line.startswith('line'):
+                preamble, _, text = line.partition(':')
+                attrs = read_preamble(preamble)
+                attrs.pop('line', None)
+                if fonttable is not None and attrs.get('fonts'):
+                    attrs['fonts'] = _expand_fonts(attrs['fonts'], fonttable)
+                lines.append((attrs, text))
+            elif line.startswith('doc_id'):
+                attrs = dict(
+                    item.split('=', 1) for item in line.split() if '=' in item
+                )
+                attrs.pop('doc_id', None)
+                block_id = attrs.pop('block_id', None)
+                lines = []
+                blocks[block_id] = (attrs, lines)
+            elif line.startswith('fonttable='):
+                fonttable = _read_fonttable(line)
+    return blocks
+
+
+def file_digest(path, blocksize=1 << 20):
+    """
+    Return the SHA-1 digest of the decompressed content of *path*.
+    """
+    h = hashlib.sha1()
+    with open_input(path) as f:
+        for chunk in iter(lambda: f.read(blocksize), b''):
+            h.update(chunk)
+    return h.digest()
+
+
+def diff_trees(old_dir, new_dir, tolerance=DEFAULT_TOLERANCE,
+               processes=None):
+    """
+    Compare the Freki files under *old_dir* and *new_dir* and yield a
+    result for each document as it is compared.
+
+    Results are as for :func:`freki.batch.run_jobs`, with the document's
+    path relative to the trees (without compression extensions) and an
+    `info` dict with its `result` (a status other than `error`) and its
+    counts of differences in each category. If both *old_dir* and
+    *new_dir* are files, they are compared with each other whatever
+    their names.
+    """
+    old_files = _tree_files(old_dir)
+    new_files = _tree_files(new_dir)
+    if not (os.path.isdir(old_dir) or os.path.isdir(new_dir)):
+        # key both files by the new file's name
+        old_files = dict.fromkeys(new_files, old_dir)
+    jobs = [
+        (key, old_files.get(key), new_files.get(key), tolerance)
+        for key in sorted(set(old_files).union(new_files))
+    ]
+    return batch.run_jobs(_diff_job, jobs, processes=processes)
+
+
+def _tree_files(path):
+    if not os.path.isdir(path):
+        return {os.path.basename(strip_compression_ext(path)): path}
+    return dict(
+        (strip_compression_ext(relpath), os.path.join(path, relpath))
+        for relpath in batch.find_inputs(path, FREKI_SUFFIXES)
+    )
+
+
+def _diff_job(job):
+    _, old, new, tolerance = job
+    if old is None:
+        return {'result': 'missing_old'}
+    elif new is None:
+        return {'result': 'missing_new'}
+    if file_digest(old) == file_digest(new):
+        return {'result': 'identical'}
+    diffs = diff_files(old, new, tolerance)
+    info = dict(diffs)
+    info['result'] = 'changed' if diffs else 'equivalent'
+    return info
+
+
+def summarize(results):
+    """
+    Return Counters of the documents with each status and of the
+    differences in each category over all *results*.
+    """
+    statuses = Counter()
+    categories = Counter()
+    for r in results:
+        if r['status'] != 'ok':
+            statuses['error'] += 1
+            continue
+        info = r['info']
+        statuses[info['result']] += 1
+        categories.update(dict((c, info.get(c, 0)) for c in CATEGORIES))
+    return statuses, categories
+
+
+def _write_details(path, results):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\t'.join(('path', 'result') + CATEGORIES + ('error',)))
+        f.write('\n')
+        for r in sorted(results, key=lambda r: r['path']):
+            info = r.get('info', {})
+            result = info.get('result', 'error')
+            if result == 'identical':
+                continue
+            fields = [r['path'], result]
+            fields.extend(str(info.get(c, 0)) for c in CATEGORIES)
+            fields.append(r.get('error', ''))
+            f.write('\t'.join(fields))
+            f.write('\n')
+
+
+def main(arglist=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='Compare two trees (or two files) of Freki output',
+        prog='freki diff',
+        epilog='examples:\n'
+               '    freki diff -j 8 --details changes.tsv out-old/ out-new/'
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='count', dest='verbosity', default=2,
+        help='increase the verbosity (can be repeated: -vvv)'
+    )
+    parser.add_argument(
+        '--tolerance',
+        metavar='PTS', type=float, default=DEFAULT_TOLERANCE,
+        help='maximum difference of bbox coordinates (default: '
+             '%(default)s)'
+    )
+    parser.add_argument(
+        '--details',
+        metavar='FILE',
+        help='write the differences of each non-identical document to '
+             'FILE as a table'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar='N', type=int,
+        help='number of worker processes (default: one per CPU)'
+    )
+    parser.add_argument('old', help='the old Freki file or directory')
+    parser.add_argument('new', help='the new Freki file or directory')
+    args = parser.parse_args(arglist)
+    logging.basicConfig(level=50-(args.verbosity*10))
+
+    results = []
+    for result in diff_trees(args.old, args.new, tolerance=args.tolerance,
+                             processes=args.jobs):
+        if result['status'] != 'ok':
+            logging.error('{}: {}'.format(result['path'], result['error']))
+        results.append(result)
+    statuses, categories = summarize(results)
+    print('documents:')
+    for status in STATUSES:
+        print('  {:<20} {}'.format(status, statuses[status]))
+    print('differences:')
+    for category in CATEGORIES:
+        print('  {:<20} {}'.format(category, categories[category]))
+    if args.details is not None:
+        _write_details(args.details, results)
+    # like diff, exit with 1 if there are differences
+    if any(statuses[s] for s in STATUSES[2:]):
+        sys.exit(1)
@@ -0,0 +1,210 @@
+"""
+Reading and writing possibly compressed files.
+
+Input files are decompressed if they start with the magic bytes of
+gzip, bz2, or xz, whatever their names, and are read through large
+buffers. Output files are compressed according to their extension
+(`.gz`, `.bz2`, or `.xz`) at a configurable level. Gzip output can be
+compressed by several threads at once: the data is cut into chunks
+that are compressed independently and written as consecutive gzip
+members, which `gunzip` and :mod:`gzip` read as one stream.
+"""
+
+import io
+import os
+import bz2
+import gzip
+import lzma
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+BUFFER_SIZE = 1 << 20  # 1 MiB
+DEFAULT_LEVEL = 6  # zlib's default; 9 is much slower for little gain
+CHUNK_SIZE = 1 << 20  # uncompressed bytes per member of parallel gzip
+
+_MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+)
+_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz'}
+
+
+def compression_for(path):
+    """
+    Return the compression (`gzip`, `bz2`, or `xz`) used for a file
+    named *path*, or `None` if it is not compressed.
+    """
+    return _EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def strip_compression_ext(path):
+    """
+    Return *path* without its compression extension, if any.
+    """
+    base, ext = os.path.splitext(path)
+    return base if ext.lower() in _EXTENSIONS else path
+
+
+def open_input(source, buffer_size=BUFFER_SIZE):
+    """
+    Open *source* for reading in binary mode, decompressing it if it
+    is compressed.
+
+    *source* is a path or an open binary file. Open text files are
+    returned as they are, as they cannot be decompressed.
+    """
+    owned = None
+    if hasattr(source, 'read'):
+        if isinstance(source.read(0), str):
+            return source
+        raw = source
+        if not hasattr(raw, 'peek') and not raw.seekable():
+            raw = io.BufferedReader(raw, buffer_size)
+    else:
+        raw = owned = open(source, 'rb', buffering=buffer_size)
+    compression = _sniff(raw)
+    if compression is None:
+        return raw
+    f = _decompressor(compression, raw)
+    return _Reader(f, owned, buffer_size)
+
+
+def _sniff(f):
+    if hasattr(f, 'peek'):
+        head = f.peek(6)[:6]
+    else:
+        pos = f.tell()
+        head = f.read(6)
+        f.seek(pos)
+    for magic, compression in _MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def _decompressor(compression, f):
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    elif compression == 'bz2':
+        return bz2.BZ2File(f, mode='rb')
+    return lzma.LZMAFile(f, mode='rb')
+
+
+class _Reader(io.BufferedReader):
+    """
+    Buffered reader over a decompressed file that also closes the
+    file under it if that file is *owned*.
+    """
+    def __init__(self, f, owned, buffer_size=BUFFER_SIZE):
+        io.BufferedReader.__init__(self, f, buffer_size)
+        self._owned = owned
+
+    def close(self):
+        try:
+            io.BufferedReader.close(self)
+        finally:
+            if self._owned is not None:
+                self._owned.close()
+                self._owned = None
+
+
+def open_output(path, compression='auto', level=DEFAULT_LEVEL, threads=1):
+    """
+    Open the file at *path* for writing in binary mode.
+
+    :param compression: `gzip`, `bz2`, `xz`, `None` for no compression,
+        or `auto` to choose by the extension of *path*
+    :param level: compression level (1-9)
+    :param threads: number of threads compressing gzip output
+    """
+    if compression == 'auto':
+        compression = compression_for(path)
+    if compression is None:
+        return open(path, 'wb', buffering=BUFFER_SIZE)
+    elif compression == 'gzip':
+        if threads > 1:
+            return ParallelGzipWriter(
+                open(path, 'wb'), level=level, threads=threads, owned=True
+            )
+        return gzip.open(path, 'wb', compresslevel=level)
+    elif compression == 'bz2':
+        return bz2.open(path, 'wb', compresslevel=level)
+    elif compression == 'xz':
+        return lzma.open(path, 'wb', preset=level)
+    raise ValueError('unknown compression: {}'.format(compression))
+
+
+class ParallelGzipWriter(io.BufferedIOBase):
+    """
+    Binary file-like object that writes gzip data to the binary file
+    *fileobj*, compressing chunks of *chunk_size* bytes on *threads*
+    threads. Each chunk becomes one gzip member.
+
+    zlib releases the GIL while compressing, so the chunks are
+    compressed in parallel. At most twice *threads* chunks are held
+    in memory. If *owned*, *fileobj* is closed when this file is.
+    """
+    def __init__(self, fileobj, level=DEFAULT_LEVEL, threads=2,
+                 chunk_size=CHUNK_SIZE, owned=False):
+        io.BufferedIOBase.__init__(self)
+        self._fileobj = fileobj
+        self._level = level
+        self._threads = threads
+        self._chunk_size = chunk_size
+        self._owned = owned
+        self._buffer = bytearray()
+        self._empty = True
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(threads)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed file')
+        self._buffer += data
+        while len(self._buffer) >= self._chunk_size:
+            chunk = bytes(self._buffer[:self._chunk_size])
+            del self._buffer[:self._chunk_size]
+            self._submit(chunk)
+        return len(data)
+
+    def flush(self):
+        """
+        Write the chunks that have been compressed so far.
+        """
+        while self._pending and self._pending[0].done():
+            self._fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer or self._empty:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._fileobj.write(self._pending.popleft().result())
+            self._fileobj.flush()
+        finally:
+            self._executor.shutdown()
+            if self._owned:
+                self._fileobj.close()
+            io.BufferedIOBase.close(self)
+
+    def _submit(self, chunk):
+        self._empty = False
+        if len(self._pending) >= 2 * self._threads:
+            self._fileobj.write(self._pending.popleft().result())
+        self._pending.append(
+            self._executor.submit(_gzip_member, chunk, self._level)
+        )
+
+
+def _gzip_member(data, level):
+    # wbits of 16 + MAX_WBITS gives a complete gzip member
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
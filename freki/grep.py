@@ -0,0 +1,184 @@
+"""
+Search the line text of Freki files.
+
+`freki grep` looks for a regular expression in the text of the lines
+of many Freki files (plain or compressed) over a process pool. Files
+are streamed line by line and never loaded as :class:`FrekiDoc`
+objects; a line's attributes are only parsed when its text matches
+and it has to be checked against the `--tag` and `--font` filters or
+reported. Each hit is printed as `doc_id:block_id:line:text`.
+"""
+
+import os
+import re
+import sys
+import logging
+import argparse
+
+from freki import batch
+from freki.fileio import open_input
+from freki.serialize import (
+    FrekiFont, read_preamble, _read_fonttable, _expand_fonts
+)
+
+# suffixes of the files searched in directories
+FREKI_SUFFIXES = ('.freki', '.freki.gz', '.freki.bz2', '.freki.xz')
+
+_search = None  # arguments of grep_file() in pool workers
+
+
+def grep_file(path, regex, tags=None, fonts=None, max_count=None):
+    """
+    Yield `(doc_id, block_id, line, text)` for each line of the Freki
+    file at *path* whose text matches the compiled *regex*.
+
+    :param tags: if given, only lines with one of these tags match
+        (lines without a tag have the tag `O`)
+    :param fonts: if given, only lines using one of these fonts (e.g.,
+        `F1-10.9`, compared as :class:`FrekiFont`) match
+    :param max_count: stop after this many hits
+    """
+    if fonts is not None:
+        fonts = set(FrekiFont.reads(font) for font in fonts)
+    doc_id = block_id = fonttable = None
+    count = 0
+    with open_input(path) as f:
+        for line in f:
+            line = line.decode('utf-8')
+            if line.startswith('line'):
+                preamble, _, text = line.rstrip('\n').partition(':')
+                if regex.search(text) is None:
+                    continue
+                attrs = read_preamble(preamble)
+                if tags is not None and attrs.get('tag', 'O') not in tags:
+                    continue
+                if fonts is not None:
+                    line_fonts = attrs.get('fonts', '')
+                    if fonttable is not None and line_fonts:
+                        line_fonts = _expand_fonts(line_fonts, fonttable)
+                    if not any(FrekiFont.reads(font) in fonts
+                               for font in line_fonts.split(',')):
+                        continue
+                yield doc_id, block_id, int(attrs['line']), text
+                count += 1
+                if max_count is not None and count >= max_count:
+                    break
+            elif line.startswith('doc_id'):
+                attrs = dict(
+                    item.split('=', 1) for item in line.split() if '=' in item
+                )
+                doc_id = attrs.get('doc_id')
+                block_id = attrs.get('block_id')
+            elif line.startswith('fonttable='):
+                fonttable = _read_fonttable(line)
+
+
+def grep(paths, pattern, flags=0, tags=None, fonts=None, max_count=None,
+         processes=None):
+    """
+    Search the Freki files at *paths* for *pattern* and yield the hits
+    as with :func:`grep_file`, in the order of *paths*, up to a total
+    of *max_count*. Files that cannot be read are logged and skipped.
+    """
+    jobs = [(path,) for path in paths]
+    results = batch.run_jobs(
+        _grep_job, jobs, processes=processes, initializer=_init_worker,
+        initargs=(pattern, flags, tags, fonts, max_count), ordered=True
+    )
+    count = 0
+    for result in results:
+        if result['status'] != 'ok':
+            logging.error('{}: {}'.format(result['path'], result['error']))
+            continue
+        for hit in result['info']['hits']:
+            yield tuple(hit)
+            count += 1
+            if max_count is not None and count >= max_count:
+                results.close()  # stops the workers
+                return
+
+
+def _init_worker(pattern, flags, tags, fonts, max_count):
+    global _search
+    # the pattern is compiled once per worker, not once per file
+    _search = (re.compile(pattern, flags), tags, fonts, max_count)
+
+
+def _grep_job(job):
+    regex, tags, fonts, max_count = _search
+    return {'hits': list(grep_file(job[0], regex, tags, fonts, max_count))}
+
+
+def _find_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for relpath in batch.find_inputs(path, FREKI_SUFFIXES):
+                yield os.path.join(path, relpath)
+        else:
+            yield path
+
+
+def main(arglist=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='Search the line text of Freki files',
+        prog='freki grep',
+        epilog='examples:\n'
+               '    freki grep -m 20 "\\b1SG\\b" corpus/\n'
+               '    freki grep --tag I-G --tag B-G "-PST\\b" a.freki.gz'
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='count', dest='verbosity', default=2,
+        help='increase the verbosity (can be repeated: -vvv)'
+    )
+    parser.add_argument(
+        '-i', '--ignore-case',
+        action='store_true', help='ignore case distinctions'
+    )
+    parser.add_argument(
+        '--tag',
+        metavar='TAG', dest='tags', action='append',
+        help='only search lines with tag TAG (repeatable)'
+    )
+    parser.add_argument(
+        '--font',
+        metavar='FONT', dest='fonts', action='append',
+        help='only search lines using FONT, e.g., F1-10.9 (repeatable)'
+    )
+    parser.add_argument(
+        '-m', '--max-count',
+        metavar='N', type=int,
+        help='stop after N hits'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar='N', type=int,
+        help='number of worker processes (default: one per CPU)'
+    )
+    parser.add_argument('pattern', help='regular expression')
+    parser.add_argument(
+        'paths', nargs='+',
+        help='Freki files, or directories searched for *.freki[.gz] files'
+    )
+    args = parser.parse_args(arglist)
+    logging.basicConfig(level=50-(args.verbosity*10))
+
+    flags = re.IGNORECASE if args.ignore_case else 0
+    try:
+        re.compile(args.pattern, flags)
+    except re.error as ex:
+        parser.error('invalid pattern: {}'.format(ex))
+    tags = set(args.tags) if args.tags else None
+    found = False
+    hits = grep(
+        list(_find_files(args.paths)), args.pattern, flags=flags,
+        tags=tags, fonts=args.fonts, max_count=args.max_count,
+        processes=args.jobs
+    )
+    for hit in hits:
+        print('{}:{}:{}:{}'.format(*hit))
+        found = True
+    # like grep, exit with 1 if nothing was found
+    if not found:
+        sys.exit(1)
@@ -1,15 +1,24 @@
 #!/usr/bin/env python3
 
 import os
+import io
+import sys
+import json
 # from collections import defaultdict, Counter
-import gzip
 import argparse
 import logging
 
 from freki.readers import tetml, pdfminer
+from freki.readers.base import parse_page_ranges
+from freki.readers.dedupe import DEFAULT_TOLERANCE
 from freki.analyzers import base as basic_analyzer, xycut
 
 from freki.serialize import FrekiDoc, FrekiBlock, FrekiLine
+from freki.cache import ReaderCache
+from freki.fileio import open_output, strip_compression_ext, DEFAULT_LEVEL
+from freki.analyzers.memo import PageMemo
+from freki.analyzers.templates import LayoutTemplates
+from freki.profiling import Profiler, NULL_PROFILE, aggregate
 
 INTERLINEAR_THRESHOLD = 0.6
 
@@ -21,34 +30,243 @@ analyzers = {
     'xycut': xycut.XYCutAnalyzer
 }
 
+def _sweep_main(arglist):
+    from freki.analyzers import sweep
+    sweep.main(arglist)
+
+def _serve_main(arglist):
+    from freki import serve
+    serve.main(arglist)
+
+def _grep_main(arglist):
+    from freki import grep
+    grep.main(arglist)
+
+def _stats_main(arglist):
+    from freki import stats
+    stats.main(arglist)
+
+def _diff_main(arglist):
+    from freki import diff
+    diff.main(arglist)
+
+def _shards_main(arglist):
+    from freki import shards
+    shards.main(arglist)
+
+# subcommands, given as the first argument (e.g. `freki sweep ...`)
+commands = {
+    'sweep': _sweep_main,
+    'serve': _serve_main,
+    'grep': _grep_main,
+    'stats': _stats_main,
+    'diff': _diff_main,
+    'shards': _shards_main
+}
+
 def run(args):
-    reader = readers[args.reader](args.infile, debug=args.debug)
-    analyzer = analyzers[args.analyzer](debug=args.debug)
+    cache = None
+    if args.cache is not None:
+        cache = ReaderCache(args.cache, max_bytes=args.cache_size * 2**20)
+    memo = None
+    if args.memo or args.memo_store is not None:
+        memo = PageMemo(path=args.memo_store)
+    templates = LayoutTemplates() if args.templates else None
+    params = None
+    if args.xycut_params is not None:
+        params = json.loads(args.xycut_params)
+
+    profile = NULL_PROFILE
+    if args.profile is not None:
+        profiler = Profiler(args.profile, every=args.profile_every)
+        profile = profiler.document(_doc_id_from_path(args.infile))
 
     logging.info('Analyzing {}'.format(args.infile))
-    doc_id = _doc_id_from_path(args.infile)
-    doc = analyzer.analyze(reader, id=doc_id)
+    try:
+        doc = analyze(
+            args.infile, reader=args.reader, analyzer=args.analyzer,
+            debug=args.debug, pages=args.pages,
+            dedupe=args.dedupe_tolerance if args.dedupe else None,
+            cache=cache, memo=memo, xycut_params=params,
+            pyramid=args.pyramid, pyramid_tolerance=args.pyramid_tolerance,
+            templates=templates, profile=profile
+        )
+    finally:
+        if memo is not None:
+            memo.log_stats()
+            memo.close()
+        if templates is not None:
+            templates.log_stats()
+
+    with profile.stage('write'):
+        if args.outfile is None or hasattr(args.outfile, 'write'):
+            if args.gzip:
+                raise Exception('Cannot gzip to an open stream.')
+            process(doc, args.outfile, compact=args.compact)
+        else:
+            write_output(
+                doc, args.outfile, gzipped=args.gzip, compact=args.compact,
+                level=args.compress_level, threads=args.compress_threads
+            )
 
-    if args.outfile is None or hasattr(args.outfile, 'write'):
-        if args.gzip:
-            raise Exception('Cannot gzip to an open stream.')
-        process(doc, args.outfile)
+    if args.profile is not None and args.profile_aggregate:
+        aggregate(args.profile)
+
+
+def analyze(source, reader='tetml', analyzer='xycut', doc_id=None,
+            debug=False, pages=None, dedupe=None, cache=None, memo=None,
+            xycut_params=None, pyramid=False, pyramid_tolerance=0,
+            templates=None, profile=NULL_PROFILE):
+    """
+    Read and analyze *source* and return the analyzed Document.
+
+    *source* is the path of a TetML or PDFMiner XML file, an open
+    (text or binary) file, or the XML itself as bytes. The document
+    id is *doc_id* or, by default, taken from the path.
+
+    :param reader: name of the reader (`tetml` or `pdfminer`)
+    :param analyzer: name of the analyzer (`xycut`)
+    :param pages: if given, only read these page numbers
+    :param dedupe: if given, remove overprinted text with this
+        tolerance in points (`True` for the default tolerance)
+    :param cache: ReaderCache to get the pages of a path from
+    :param memo: PageMemo of earlier page analyses to reuse
+    :param xycut_params: dict of XY-cut parameter overrides
+    :param pyramid: find XY-cut gaps on a downsampled bitmap first
+    :param pyramid_tolerance: as for `--pyramid-tolerance`
+    :param templates: LayoutTemplates to reuse the cuts of earlier
+        pages of the document with
+    :param profile: DocumentProfile to profile the `read` and
+        `analyze` stages in (see :mod:`freki.profiling`)
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    elif doc_id is None and not hasattr(source, 'read'):
+        doc_id = _doc_id_from_path(source)
+    options = {}
+    if dedupe is not None and dedupe is not False:
+        options['dedupe'] = DEFAULT_TOLERANCE if dedupe is True else dedupe
+    if pages is not None:
+        options['page_ids'] = pages
+    with profile.stage('read'):
+        rdr = make_reader(
+            reader, source, debug=debug, cache=cache, **options
+        )
+    with profile.stage('analyze'):
+        anlzr = analyzers[analyzer](
+            debug=debug, memo=memo, params=xycut_params,
+            pyramid=pyramid, tolerance=pyramid_tolerance,
+            templates=templates
+        )
+        return anlzr.analyze(rdr, id=doc_id)
+
+
+def convert(source, reader='tetml', analyzer='xycut', **options):
+    """
+    Convert *source* to a FrekiDoc without writing any files.
+
+    The arguments are as for :func:`analyze`.
+
+    Example:
+
+    >>> fd = convert(tetml_bytes, doc_id='1076941')
+    >>> fd.dump(outfile)
+    """
+    return freki_doc(
+        analyze(source, reader=reader, analyzer=analyzer, **options)
+    )
+
+
+def iter_blocks(source, reader='tetml', analyzer='xycut', **options):
+    """
+    Convert *source* and yield its FrekiBlocks one at a time.
+
+    The pages are analyzed before the first block is yielded, but each
+    block and its lines are only built as it is requested, so a caller
+    handling one block at a time can stop early. The arguments are as
+    for :func:`analyze`.
+    """
+    doc = analyze(source, reader=reader, analyzer=analyzer, **options)
+    return freki_blocks(doc, FrekiDoc())
+
+
+def make_reader(name, infile, debug=False, cache=None, **options):
+    """
+    Return the reader *name* (e.g., `tetml`) for *infile*, getting its
+    pages from the ReaderCache *cache* if one is given. Other *options*
+    (e.g., `page_ids`) are passed to the reader.
+    """
+    if cache is not None:
+        return cache.reader(
+            readers[name], name, infile, debug=debug, **options
+        )
+    return readers[name](infile, debug=debug, **options)
+
+
+def write_output(doc, path, gzipped=False, compact=False,
+                 level=DEFAULT_LEVEL, threads=1):
+    """
+    Write the analyzed *doc* as a Freki file at *path*, creating its
+    directory if needed. The file is compressed if *path* ends with
+    `.gz`, `.bz2`, or `.xz`, or with *gzipped*, which appends `.gz` to
+    *path* if missing. Return the path written.
+
+    :param level: compression level (1-9)
+    :param threads: number of threads compressing gzip output
+    """
+    compression = 'auto'
+    if gzipped:
+        compression = 'gzip'
+        if not path.endswith('.gz'):
+            path += '.gz'
+    dirs = os.path.dirname(path)
+    if dirs:
+        os.makedirs(dirs, exist_ok=True)
+    with open_output(path, compression, level, threads) as outfile:
+        process(doc, outfile, compact=compact)
+    return path
+
+
+def process(doc, outfile, compact=False):
+    if outfile is None:
+        outfile = sys.stdout
     else:
-        if args.gzip:
-            openfile = gzip.open
-            if not args.outfile.endswith('.gz'):
-                args.outfile += '.gz'
-        else:
-            openfile = open
-        dirs = os.path.dirname(args.outfile)
-        if dirs:
-            os.makedirs(dirs, exist_ok=True)
-        with openfile(args.outfile, 'wb') as outfile:
-            process(doc, outfile)
-
-def process(doc, outfile):
+        # write block by block instead of encoding one big string
+        outfile = io.TextIOWrapper(outfile, encoding='utf-8', newline='')
+    if compact:
+        # the font table comes first, so it needs the whole document
+        freki_doc(doc).dump(outfile, compact=True)
+    else:
+        # blocks are not kept together, so they can be freed once
+        # they are written
+        for i, fb in enumerate(freki_blocks(doc)):
+            if i:
+                outfile.write('\n\n')
+            outfile.write(str(fb))
+    if outfile is sys.stdout:
+        outfile.write('\n')
+    else:
+        outfile.detach()
+
+
+def freki_doc(doc):
+    """
+    Return a FrekiDoc with the blocks and respaced lines of the
+    analyzed *doc*.
+    """
     # Initialize the freki document
     fd = FrekiDoc()
+    for _ in freki_blocks(doc, fd):
+        pass
+    return fd
+
+
+def freki_blocks(doc, fd=None):
+    """
+    Add the blocks and respaced lines of the analyzed *doc* to the
+    FrekiDoc *fd*, yielding each FrekiBlock once it is added. If *fd*
+    is `None`, each block is added to a FrekiDoc of its own.
+    """
     line_no = 1
 
     # find minimum left-coordinate if available
@@ -57,12 +275,13 @@ def process(doc, outfile):
 
     for page in doc.pages:
         for blk in page.blocks:
+            block_fd = FrekiDoc() if fd is None else fd
             fb = FrekiBlock(
                 doc_id=doc.id,
                 page=page.id,
                 block_id='{}-{}'.format(page.id, blk.id),
                 bbox='{},{},{},{}'.format(blk.llx, blk.lly, blk.urx, blk.ury),
-                doc=fd,
+                doc=block_fd,
                 label=blk.label
             )
 
@@ -82,13 +301,10 @@ def process(doc, outfile):
                 )
                 fb.add_line(fl)
 
-            fd.add_block(fb)
+            block_fd.add_block(fb)
 
             line_no += len(blk.lines)
-    if outfile is None:
-        print(str(fd))
-    else:
-        outfile.write(str(fd).encode('utf-8'))
+            yield fb
 
 
 def _llx_col(x, dx):
@@ -196,14 +412,26 @@ def respace(block, xoffset=0.0):
     return lines
 
 
+def _page_ranges(spec):
+    try:
+        return parse_page_ranges(spec)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'invalid page ranges: {}'.format(spec)
+        )
+
+
 def _doc_id_from_path(path):
-    bn = os.path.basename(path)
-    if bn.endswith('.gz'):
-        bn = bn[:-3]
+    bn = strip_compression_ext(os.path.basename(path))
     return os.path.splitext(bn)[0]
 
 
 def main(arglist=None):
+    if arglist is None:
+        arglist = sys.argv[1:]
+    if arglist and arglist[0] in commands:
+        return commands[arglist[0]](arglist[1:])
+
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
         description="Analyze the document structure of text in a PDF",
@@ -229,10 +457,101 @@ def main(arglist=None):
         '-a', '--analyzer',
         choices=(['xycut']), default='xycut'
     )
+    parser.add_argument(
+        '--pages',
+        metavar='RANGES', type=_page_ranges,
+        help='only read the given pages (e.g., 1-5,100-120)'
+    )
     parser.add_argument(
         '-z', '--gzip',
         action='store_true', help='gzip output file'
     )
+    parser.add_argument(
+        '--compress-level',
+        metavar='N', type=int, default=DEFAULT_LEVEL,
+        help='compression level (1-9) of compressed output '
+             '(default: %(default)s)'
+    )
+    parser.add_argument(
+        '--compress-threads',
+        metavar='N', type=int, default=1,
+        help='number of threads compressing gzip output (default: 1)'
+    )
+    parser.add_argument(
+        '--dedupe',
+        action='store_true',
+        help='remove overprinted (e.g., fake bold) and duplicated text'
+    )
+    parser.add_argument(
+        '--dedupe-tolerance',
+        metavar='PTS', type=float, default=DEFAULT_TOLERANCE,
+        help='maximum offset of overprinted text (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        help='write a document font table and round bbox coordinates'
+    )
+    parser.add_argument(
+        '--cache',
+        metavar='DIR',
+        help='cache parsed reader output in DIR and reuse it'
+    )
+    parser.add_argument(
+        '--cache-size',
+        metavar='MB', type=int, default=1024,
+        help='maximum size of the reader cache (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--memo',
+        action='store_true',
+        help='reuse the analysis of pages with identical layouts'
+    )
+    parser.add_argument(
+        '--memo-store',
+        metavar='FILE',
+        help='keep page analyses in FILE for reuse across runs '
+             '(implies --memo)'
+    )
+    parser.add_argument(
+        '--xycut-params',
+        metavar='JSON',
+        help='override XY-cut parameters with a JSON object '
+             '(e.g., from `freki sweep`)'
+    )
+    parser.add_argument(
+        '--pyramid',
+        action='store_true',
+        help='find XY-cut gaps on a downsampled bitmap first'
+    )
+    parser.add_argument(
+        '--pyramid-tolerance',
+        metavar='PTS', type=float, default=0,
+        help='allow gaps up to PTS wider than the minimum gap size to be '
+             'missed with --pyramid, for more downsampling (default: 0)'
+    )
+    parser.add_argument(
+        '--templates',
+        action='store_true',
+        help='reuse the XY-cuts of recent pages of a document where they '
+             'give the same zones'
+    )
+    parser.add_argument(
+        '--profile',
+        metavar='DIR',
+        help='write profiles of the read, analyze, and write stages to DIR'
+    )
+    parser.add_argument(
+        '--profile-every',
+        metavar='N', type=int, default=1,
+        help='with --profile, only profile one in N documents, chosen by '
+             'their ids (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--profile-aggregate',
+        action='store_true',
+        help='with --profile, combine all profiles in DIR by stage'
+    )
     parser.add_argument('infile')
     parser.add_argument('outfile')
     args = parser.parse_args(arglist)
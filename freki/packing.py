@@ -0,0 +1,349 @@
+"""
+Compact, array-based representation of pages.
+
+:func:`pack_pages` flattens :class:`freki.structures.Page` objects into
+a few NumPy arrays and :func:`unpack_pages` rebuilds equal pages from
+them. Token coordinates are kept in one float array, token text, fonts,
+and features are indices into a table of unique strings, and the page,
+block, and line structure (with the bounding boxes of pages, blocks,
+and lines, which are not recomputed) is a small JSON header.
+
+The arrays can also be laid out in one buffer (:func:`to_buffer` and
+:func:`from_buffer`), which is far smaller than the pickled pages, and
+placed in shared memory (:class:`SharedPages`), so worker processes
+can read the pages without them being pickled and copied to each
+worker.
+"""
+
+import gc
+import sys
+import json
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+from freki.structures import BBox, Token, Line, Block, Page
+
+# increment when the arrays change in an incompatible way
+FORMAT_VERSION = 2
+
+_MAGIC = b'FREKIPG1'
+_ALIGN = 8
+
+
+def pack_pages(pages):
+    """
+    Return a dict of NumPy arrays representing *pages*.
+    """
+    strings = _StringTable()
+    structure = []
+    bboxes, texts, fonts, features = [], [], [], []
+    for page in pages:
+        blocks = []
+        for block in page.blocks:
+            lines = []
+            for line in block.lines:
+                for token in line.tokens:
+                    bbox = token.bbox
+                    bboxes.append((bbox.llx, bbox.lly, bbox.urx, bbox.ury))
+                    texts.append(strings.index(token.text))
+                    fonts.append(strings.index(token.font))
+                    feats = token.features
+                    features.append(strings.index(
+                        json.dumps(feats, sort_keys=True) if feats else '{}'
+                    ))
+                lines.append([line.id, _bbox(line), len(line.tokens)])
+            blocks.append([block.id, block.label, _bbox(block), lines])
+        structure.append(
+            [page.id, page.page_width, page.page_height, _bbox(page), blocks]
+        )
+    blob, offsets = strings.arrays()
+    return {
+        'version': np.array([FORMAT_VERSION]),
+        'structure': np.frombuffer(
+            json.dumps(structure).encode('utf-8'), dtype=np.uint8
+        ),
+        'strings': blob,
+        'offsets': offsets,
+        'bboxes': np.array(bboxes, dtype=np.float64).reshape((-1, 4)),
+        'texts': np.array(texts, dtype=np.int32),
+        'fonts': np.array(fonts, dtype=np.int32),
+        'features': np.array(features, dtype=np.int32),
+    }
+
+
+def _bbox(box):
+    bbox = box.bbox
+    return [bbox.llx, bbox.lly, bbox.urx, bbox.ury]
+
+
+def unpack_pages(arrays, page_ids=None):
+    """
+    Rebuild the list of pages packed into *arrays* by :func:`pack_pages`,
+    or only those with the ids in *page_ids*.
+    """
+    return _rebuild(arrays, None, page_ids)
+
+
+def _rebuild(arrays, header, page_ids):
+    if header is None:
+        header = _decode_header(arrays)
+    # the rebuilt objects form no reference cycles, so garbage
+    # collection while they are made would only take time
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _unpack_pages(arrays, header, page_ids)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _decode_header(arrays):
+    # the structure and the string table, which are needed for any page
+    if int(arrays['version'][0]) != FORMAT_VERSION:
+        raise ValueError('Unsupported page packing format version.')
+    structure = json.loads(bytes(arrays['structure']).decode('utf-8'))
+    strings = _decode_strings(arrays['strings'], arrays['offsets'])
+    return structure, strings
+
+
+def _unpack_pages(arrays, header, page_ids):
+    structure, strings = header
+    bboxes = arrays['bboxes']
+    texts = arrays['texts']
+    fonts = arrays['fonts']
+    token_features = arrays['features']
+    features = {}
+
+    pages = []
+    i = 0
+    for page_id, width, height, page_bbox, block_data in structure:
+        numtoks = sum(
+            line[2] for block in block_data for line in block[3]
+        )
+        if page_ids is not None and page_id not in page_ids:
+            i += numtoks
+            continue
+        # convert only this page's part of the arrays to lists
+        j = slice(i, i + numtoks)
+        tokens = _unpack_tokens(
+            bboxes[j].tolist(), texts[j].tolist(), fonts[j].tolist(),
+            token_features[j].tolist(), strings, features
+        )
+        i += numtoks
+        blocks = []
+        k = 0
+        for block_id, label, block_bbox, line_data in block_data:
+            lines = []
+            for line_id, line_bbox, numtoks in line_data:
+                line = _container(Line, line_bbox, tokens[k:k + numtoks])
+                line.id = line_id
+                lines.append(line)
+                k += numtoks
+            block = _container(Block, block_bbox, lines)
+            block.id = block_id
+            block.label = label
+            blocks.append(block)
+        page = _container(Page, page_bbox, blocks)
+        page.id = page_id
+        page.page_width = width
+        page.page_height = height
+        pages.append(page)
+    return pages
+
+
+def _unpack_tokens(bboxes, texts, fonts, token_features, strings,
+                   features):
+    tokens = []
+    new = object.__new__
+    for bbox, text, font, feats in zip(bboxes, texts, fonts,
+                                       token_features):
+        token = new(Token)
+        token.text = strings[text]
+        token.bbox = BBox(*bbox)
+        token.font = strings[font]
+        if feats not in features:
+            # decode each distinct features dict once
+            features[feats] = json.loads(strings[feats])
+        token.features = dict(features[feats])
+        tokens.append(token)
+    return tokens
+
+
+def _container(cls, bbox, items):
+    # like cls(items), but keeps the packed bbox instead of merging
+    # the bboxes of the items again
+    container = object.__new__(cls)
+    container.bbox = BBox(*bbox)
+    container._items = items
+    if items:
+        container._width, container._height = None, None
+    return container
+
+
+def to_buffer(arrays):
+    """
+    Return the *arrays* of :func:`pack_pages` laid out in one
+    bytearray, which :func:`from_buffer` reads without copying.
+    """
+    header, layout, size = _layout(arrays)
+    buf = bytearray(size)
+    _write_buffer(arrays, header, layout, memoryview(buf))
+    return buf
+
+
+def from_buffer(buf):
+    """
+    Return the arrays in the buffer *buf* written by :func:`to_buffer`.
+    The arrays are read-only views of *buf*.
+    """
+    buf = memoryview(buf)
+    if bytes(buf[:len(_MAGIC)]) != _MAGIC:
+        raise ValueError('Not a packed pages buffer.')
+    start = len(_MAGIC) + 8
+    hlen = int.from_bytes(buf[len(_MAGIC):start], 'little')
+    header = json.loads(bytes(buf[start:start + hlen]).decode('utf-8'))
+    data_start = _data_start(hlen)
+    arrays = {}
+    for name, dtype, shape, offset in header:
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        offset += data_start
+        arrays[name] = np.frombuffer(
+            buf[offset:offset + count * dtype.itemsize], dtype=dtype
+        ).reshape(shape)
+    return arrays
+
+
+def _layout(arrays):
+    # the header lists the name, dtype, shape, and offset (from the end
+    # of the header) of each array; each array is aligned for its dtype
+    layout = []
+    offset = 0
+    for name in sorted(arrays):
+        a = arrays[name]
+        layout.append([name, a.dtype.str, list(a.shape), offset])
+        offset = _aligned(offset + a.nbytes)
+    header = json.dumps(layout).encode('utf-8')
+    return header, layout, _data_start(len(header)) + offset
+
+
+def _data_start(header_size):
+    return _aligned(len(_MAGIC) + 8 + header_size)
+
+
+def _aligned(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def _write_buffer(arrays, header, layout, buf):
+    buf[:len(_MAGIC)] = _MAGIC
+    start = len(_MAGIC) + 8
+    buf[len(_MAGIC):start] = len(header).to_bytes(8, 'little')
+    buf[start:start + len(header)] = header
+    data_start = _data_start(len(header))
+    for name, _, _, offset in layout:
+        data = np.ascontiguousarray(arrays[name])
+        offset += data_start
+        buf[offset:offset + data.nbytes] = data.view(np.uint8).ravel()
+
+
+class SharedPages(object):
+    """
+    Pages packed into a block of shared memory.
+
+    The process that creates it with the *pages* owns the block and
+    must call :meth:`unlink` when it is no longer needed. Instances
+    are pickled as the name of the block, so they can be sent to pool
+    workers cheaply, and are attached to the block again (without
+    copying it) when unpickled; workers call :meth:`close` when done.
+    """
+    def __init__(self, pages):
+        if shared_memory is None:
+            raise RuntimeError('shared memory requires Python 3.8 or later')
+        arrays = pack_pages(pages)
+        header, layout, size = _layout(arrays)
+        self._shm = shared_memory.SharedMemory(create=True, size=size)
+        _write_buffer(arrays, header, layout, self._shm.buf)
+        self.name = self._shm.name
+        self.page_ids = [page.id for page in pages]
+        self._header = None
+
+    def __getstate__(self):
+        return {'name': self.name, 'page_ids': self.page_ids}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = _attach(self.name)
+        self._header = None
+
+    def pages(self, *page_ids):
+        """
+        Return the pages with the ids in *page_ids*, or all pages.
+        """
+        arrays = from_buffer(self._shm.buf)
+        try:
+            # decoded once, as workers usually ask for one page at a time
+            if self._header is None:
+                self._header = _decode_header(arrays)
+            return _rebuild(
+                arrays, self._header, set(page_ids) if page_ids else None
+            )
+        finally:
+            del arrays  # views must be released before closing
+
+    def close(self):
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.close()
+        self._shm.unlink()
+
+
+def _attach(name):
+    if sys.version_info >= (3, 13):
+        # only the owner removes the block
+        return shared_memory.SharedMemory(name, track=False)
+    return shared_memory.SharedMemory(name)
+
+
+class _StringTable(object):
+    """
+    Table of unique strings. `None` is given the index -1.
+    """
+    def __init__(self):
+        self._index = {None: -1}
+        self._strings = []
+
+    def index(self, s):
+        idx = self._index.get(s)
+        if idx is None:
+            idx = self._index[s] = len(self._strings)
+            self._strings.append(s)
+        return idx
+
+    def arrays(self):
+        """
+        Return the strings as one UTF-8 byte array and the array of
+        their end offsets.
+        """
+        data = [s.encode('utf-8') for s in self._strings]
+        offsets = np.cumsum([0] + [len(b) for b in data], dtype=np.int64)
+        blob = np.frombuffer(b''.join(data), dtype=np.uint8)
+        return blob, offsets
+
+
+def _decode_strings(blob, offsets):
+    data = bytes(blob)
+    offsets = offsets.tolist()
+    strings = [
+        data[start:end].decode('utf-8')
+        for start, end in zip(offsets, offsets[1:])
+    ]
+    strings.append(None)  # index -1
+    return strings
@@ -0,0 +1,225 @@
+"""
+Profiling the stages of document conversion.
+
+A :class:`Profiler` profiles each stage of converting a document
+(e.g., `read`, `analyze`, and `write`) separately and writes, for each
+stage, a :mod:`pstats` file and a file of collapsed stacks that
+flamegraph tools (e.g., `flamegraph.pl`) can draw. The pstats come
+from :mod:`cProfile`; the stacks are sampled with a CPU-time timer
+signal while the stage runs, where signals are available. Neither the
+sampler nor the profiling of the stage itself shows in the pstats.
+
+Only one in *every* documents is profiled, so profiling can stay on
+for large batches. Documents are chosen by a hash of their names, so
+the same documents are profiled in every process and every run. The
+profiles of a batch can be combined with :func:`aggregate`.
+"""
+
+import os
+import glob
+import zlib
+import marshal
+import signal
+import pstats
+import cProfile
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+SAMPLE_INTERVAL = 0.001  # seconds of CPU time between stack samples
+AGGREGATE_DIR = 'aggregate'
+
+
+class Profiler(object):
+    """
+    Profile one in *every* documents, writing the profiles to
+    *directory*.
+    """
+    def __init__(self, directory, every=1, interval=SAMPLE_INTERVAL):
+        self.directory = directory
+        self.every = max(1, every)
+        self.interval = interval
+        os.makedirs(directory, exist_ok=True)
+
+    def sampled(self, name):
+        """
+        Return `True` if the document *name* is profiled.
+        """
+        return zlib.crc32(name.encode('utf-8')) % self.every == 0
+
+    def document(self, name):
+        """
+        Return the DocumentProfile for the document *name*, or
+        `NULL_PROFILE` if it is not profiled.
+        """
+        if not self.sampled(name):
+            return NULL_PROFILE
+        return DocumentProfile(self.directory, name, self.interval)
+
+
+class DocumentProfile(object):
+    """
+    Profiles of the stages of converting the document *name*.
+
+    Each stage is written to *directory* as `<name>.<stage>.pstats`
+    and `<name>.<stage>.folded`.
+    """
+    def __init__(self, directory, name, interval=SAMPLE_INTERVAL):
+        self.directory = directory
+        self.name = name.replace(os.sep, '_')
+        self.interval = interval
+
+    @contextmanager
+    def stage(self, stage):
+        """
+        Profile the code run in this context as *stage*.
+        """
+        profile = cProfile.Profile()
+        sampler = _StackSampler(self.interval)
+        sampler.start()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            sampler.stop()
+            path = os.path.join(
+                self.directory, '{}.{}'.format(self.name, stage)
+            )
+            profile.create_stats()
+            _drop_own_entries(profile.stats)
+            # as Profile.dump_stats(), which would create the stats again
+            with open(path + '.pstats', 'wb') as f:
+                marshal.dump(profile.stats, f)
+            if sampler.stacks:
+                write_folded(path + '.folded', sampler.stacks)
+
+
+class _NullProfile(object):
+    """
+    Stand-in for a DocumentProfile when a document is not profiled.
+    """
+    @contextmanager
+    def stage(self, stage):
+        yield
+
+
+NULL_PROFILE = _NullProfile()
+
+
+def _drop_own_entries(stats):
+    # remove the functions of this module (the stage context and the
+    # sampler's signal handler) and the call disabling the profiler
+    # from the cProfile *stats*, so they only show the profiled code
+    filename = _drop_own_entries.__code__.co_filename
+    own = [
+        func for func in stats
+        if func[0] == filename or "'disable' of '_lsprof" in func[2]
+    ]
+    for func in own:
+        del stats[func]
+    for entry in stats.values():
+        callers = entry[4]
+        for caller in own:
+            callers.pop(caller, None)
+
+
+class _StackSampler(object):
+    """
+    Count the call stacks of the main thread every *interval* seconds
+    of CPU time, using `SIGPROF`. Does nothing where the signal is not
+    available or off the main thread.
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._samples = {}  # tuples of code objects, innermost first
+        self._handler = None
+
+    def start(self):
+        # signal handlers can only be set in the main thread
+        if (not hasattr(signal, 'setitimer') or not isinstance(
+                threading.current_thread(), threading._MainThread)):
+            return
+        self._handler = signal.signal(signal.SIGPROF, self._sample)
+        # restart system calls interrupted by a sample
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        if self._handler is None:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._handler)
+        self._handler = None
+        for codes, count in self._samples.items():
+            stack = ';'.join(
+                '{} ({}:{})'.format(
+                    code.co_name, os.path.basename(code.co_filename),
+                    code.co_firstlineno
+                )
+                for code in reversed(codes)
+            )
+            self.stacks[stack] += count
+        self._samples = {}
+
+    def _sample(self, signum, frame):
+        # this runs within the profiled code, so it makes no calls
+        # that cProfile would record; the stacks are formatted in
+        # stop()
+        codes = ()
+        while frame is not None:
+            codes += (frame.f_code,)
+            frame = frame.f_back
+        if codes in self._samples:
+            self._samples[codes] += 1
+        else:
+            self._samples[codes] = 1
+
+
+def write_folded(path, stacks):
+    """
+    Write the Counter of collapsed *stacks* to *path*, one
+    `frame;frame;... count` line per stack.
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write('{} {}\n'.format(stack, count))
+
+
+def read_folded(path):
+    """
+    Return the Counter of collapsed stacks in the file at *path*.
+    """
+    stacks = Counter()
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack:
+                stacks[stack] += int(count)
+    return stacks
+
+
+def aggregate(directory):
+    """
+    Combine the profiles of all documents in *directory* by stage,
+    writing `<stage>.pstats` and `<stage>.folded` in its `aggregate`
+    subdirectory. Return the names of the stages.
+    """
+    outdir = os.path.join(directory, AGGREGATE_DIR)
+    os.makedirs(outdir, exist_ok=True)
+    by_stage = {}
+    for path in glob.glob(os.path.join(directory, '*.pstats')):
+        base = os.path.basename(path)[:-len('.pstats')]
+        stage = base.rpartition('.')[2]
+        by_stage.setdefault(stage, []).append(path[:-len('.pstats')])
+    for stage, paths in by_stage.items():
+        stats = pstats.Stats(*[p + '.pstats' for p in sorted(paths)])
+        stats.dump_stats(os.path.join(outdir, stage + '.pstats'))
+        stacks = Counter()
+        for p in paths:
+            if os.path.exists(p + '.folded'):
+                stacks.update(read_folded(p + '.folded'))
+        if stacks:
+            write_folded(os.path.join(outdir, stage + '.folded'), stacks)
+    return sorted(by_stage)
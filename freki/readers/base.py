@@ -1,8 +1,17 @@
+import logging
+from xml.etree import ElementTree as ET
+
+from freki.readers.dedupe import Deduplicator
+
 
 class FrekiReader(object):
+    version = 0
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, dedupe=None, page_ids=None):
         self._debug = debug
+        self._dedupe = dedupe
+        # if given, only these pages are read
+        self._page_ids = None if page_ids is None else set(page_ids)
 
     def pages(self, *page_ids):
         '''
@@ -12,3 +21,75 @@ class FrekiReader(object):
         given, all pages are returned in order.
         '''
         raise NotImplementedError()
+
+    def _deduplicator(self):
+        '''
+        Return a new Deduplicator for a page, or `None` if overprinted
+        text is not removed (*dedupe* is `None`).
+        '''
+        if self._dedupe is None:
+            return None
+        return Deduplicator(self._dedupe)
+
+    def _log_duplicates(self, page, deduplicator, items):
+        if deduplicator is not None and deduplicator.count:
+            logging.info(
+                'Page {}: collapsed {} overprinted or duplicate {}'
+                .format(page.id, deduplicator.count, items)
+            )
+
+    def _page_elements(self, source, tag, id_attr):
+        '''
+        Parse the XML in *source* and yield each page element (with
+        name *tag* and page number attribute *id_attr*) that was
+        requested. Namespaces are stripped from element names, the
+        subtrees of other pages are skipped, and parsing stops once
+        all requested pages have been yielded. Each element is cleared
+        after it is yielded.
+
+        The yielded pages are expected to be added to `self._pages`.
+        '''
+        skipping = False
+        # iterparse to strip namespaces (is there a better way?)
+        # thanks: https://bugs.python.org/msg216774
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            name = elem.tag.split('}', 1)[-1]
+            if event == 'start':
+                if name == tag and self._page_ids is not None:
+                    skipping = int(elem.get(id_attr)) not in self._page_ids
+                continue
+            if skipping:
+                if name == tag:
+                    elem.clear()
+                    skipping = False
+                continue
+            elem.tag = name
+            if name == tag:
+                yield elem
+                elem.clear()
+                if (self._page_ids is not None
+                        and self._page_ids.issubset(self._pages)):
+                    break
+        if self._page_ids is not None:
+            missing = self._page_ids.difference(self._pages)
+            if missing:
+                logging.warning(
+                    'Pages not found: {}'
+                    .format(', '.join(map(str, sorted(missing))))
+                )
+
+
+def parse_page_ranges(spec):
+    '''
+    Return the sorted page numbers in *spec*, a comma-separated list of
+    page numbers and ranges (e.g., `1-5,100-120`).
+    '''
+    page_ids = set()
+    for part in spec.split(','):
+        start, sep, end = part.strip().partition('-')
+        start = int(start)
+        end = int(end) if sep else start
+        if start < 1 or end < start:
+            raise ValueError('invalid page range: {}'.format(part))
+        page_ids.update(range(start, end + 1))
+    return sorted(page_ids)
@@ -0,0 +1,56 @@
+"""
+Detection of overprinted and duplicated text.
+
+Some PDFs simulate bold text by printing each glyph two or three times
+at slightly different offsets, and some contain duplicated text
+layers. Readers can use a :class:`Deduplicator` to drop the glyphs or
+tokens that repeat the text of an earlier one at (nearly) the same
+position.
+"""
+
+import math
+
+# maximum offset, in points, of overprinted copies of a glyph
+DEFAULT_TOLERANCE = 0.5
+
+
+class Deduplicator(object):
+    """
+    Detect items that have the same text as an earlier item and whose
+    bounding box coordinates are all within *tolerance* points of it.
+
+    Seen items are kept in a spatial hash of grid cells the size of
+    *tolerance*, so each check only compares items in neighboring
+    cells. Duplicates are also remembered, so an item printed three
+    times at increasing offsets is collapsed even if the third copy is
+    more than *tolerance* from the first.
+    """
+    def __init__(self, tolerance=DEFAULT_TOLERANCE):
+        self.tolerance = tolerance
+        self.count = 0  # number of duplicates found
+        self._cells = {}
+
+    def is_duplicate(self, text, bbox):
+        """
+        Return `True` if *text* at *bbox* duplicates an earlier item,
+        and remember it for later checks either way.
+        """
+        x, y = self._cell(bbox[0]), self._cell(bbox[1])
+        duplicate = any(
+            self._near(other, bbox)
+            for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+            for other in self._cells.get((text, x + dx, y + dy), ())
+        )
+        self._cells.setdefault((text, x, y), []).append(bbox)
+        if duplicate:
+            self.count += 1
+        return duplicate
+
+    def _near(self, a, b):
+        tol = self.tolerance
+        return all(abs(p - q) <= tol for p, q in zip(a, b))
+
+    def _cell(self, coord):
+        if self.tolerance <= 0:
+            return coord
+        return int(math.floor(coord / self.tolerance))
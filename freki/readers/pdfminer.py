@@ -2,38 +2,36 @@
 from __future__ import absolute_import
 
 import re
-from io import StringIO
-from xml.etree import ElementTree as ET
 
+import numpy as np
+
+from freki.fileio import open_input
 from freki.readers.base import FrekiReader
 from freki.structures import Token, Line, Block, Page
 
 max_char_dx = 0.05
 
 class PdfMinerReader(FrekiReader):
-    def __init__(self, xml_file, debug=False):
-        FrekiReader.__init__(self, debug=debug)
+    # increment when the pages produced for the same input change
+    version = 1
+
+    def __init__(self, xml_file, debug=False, dedupe=None, page_ids=None):
+        FrekiReader.__init__(
+            self, debug=debug, dedupe=dedupe, page_ids=page_ids
+        )
         self.file = xml_file
         self._pages = {}
         self._init_pages()
 
     def _init_pages(self):
-        # PDFMiner can return XML with bad characters. First fix those:
-        lines = []
-        f = open(self.file) if not hasattr(self.file, 'readline') else self.file
-        for line in f:
-            lines.append(replace_invalid_xml_chars(line))
-        instream = StringIO(''.join(lines))
-
-        # iterparse to strip namespaces (is there a better way?)
-        # thanks: https://bugs.python.org/msg216774
-        xml_iter = ET.iterparse(instream)
-        for event in xml_iter:
-            _, elem = event
-            elem.tag = elem.tag.split('}', 1)[-1]
-            if elem.tag == 'page':
-                page = _read_page(elem)
-                self._pages[page.id] = page
+        # PDFMiner can return XML with bad characters, so fix those
+        # as the file is read
+        instream = _CleanXMLStream(open_input(self.file))
+        for elem in self._page_elements(instream, 'page', 'id'):
+            deduplicator = self._deduplicator()
+            page = _read_page(elem, deduplicator)
+            self._log_duplicates(page, deduplicator, 'glyphs')
+            self._pages[page.id] = page
 
     def pages(self, *page_ids):
         if not page_ids:
@@ -41,61 +39,38 @@ class PdfMinerReader(FrekiReader):
         return [self._pages[pid] for pid in page_ids]
 
 
-def _read_page(elem):
-    blocks = []
+def _read_page(elem, deduplicator=None):
     p_llx, p_lly, p_urx, p_ury = map(float, elem.get('bbox').split(','))
+    # the attributes of the glyphs of the page, as read; PDFMiner writes
+    # one element per character, so they are grouped into tokens in a
+    # few passes over arrays instead of one glyph at a time
+    texts, fonts, sizes, bboxes = [], [], [], []
+    line_ends = []  # number of glyphs read at the end of each line
+    textboxes = []  # (id, number of lines)
     for textbox in elem.findall('textbox'):
-        lines = []
+        numlines = 0
         for textline in textbox.findall('textline'):
-            tokens, glyphs, features = [], [], {}
-            last_urx = last_fontspec = last_width = last_isalnum = None
             for glyph in textline.findall('text'):
                 text = glyph.text
                 if text.isspace():
                     continue
-                fontspec = (glyph.get('font'), float(glyph.get('size')))
-                bbox = tuple(map(float, glyph.get('bbox').split(',')))
-                llx, lly, urx, ury = bbox
-                dx = 0 if last_urx is None else llx - last_urx
-                width = urx - llx
-                avg_width = width if not last_width else (last_width+width)/2
-                isalnum = text.isalnum()
-                if last_isalnum is None: last_isalnum = isalnum
-                if (not glyphs or
-                    (fontspec == last_fontspec
-                        and (dx / avg_width) <= max_char_dx
-                        and last_isalnum == isalnum)):
-                    glyphs.append((text, fontspec, bbox, features))
-                else:
-                    tokens.append((glyphs, features))
-                    glyphs = [(text, fontspec, bbox, features)]
-                    features = {}
-                last_urx, last_width = urx, width
-                last_fontspec, last_isalnum = fontspec, isalnum
-            if glyphs:
-                tokens.append((glyphs, features))
-
-            lines.append(
-                Line(
-                    [
-                        Token(
-                            ''.join(g[0] for g in glyphs),  # text
-                            (
-                                min(g[2][0] for g in glyphs),  # llx
-                                min(g[2][1] for g in glyphs),  # lly
-                                max(g[2][2] for g in glyphs),  # urx
-                                max(g[2][3] for g in glyphs)   # ury
-                            ),
-                            glyphs[0][1][0],  # font
-                            # glyphs[0][1][1],  # size
-                            features
-                        )
-                        for glyphs, features in tokens
-                    ]
-                )
-            )
-
-        blocks.append(Block(lines, id=int(textbox.get('id'))))
+                texts.append(text)
+                fonts.append(glyph.get('font'))
+                sizes.append(glyph.get('size'))
+                bboxes.append(glyph.get('bbox'))
+            line_ends.append(len(texts))
+            numlines += 1
+        textboxes.append((int(textbox.get('id')), numlines))
+
+    line_tokens = _group_glyphs(
+        texts, fonts, sizes, bboxes, line_ends, deduplicator
+    )
+    blocks = []
+    i = 0
+    for textbox_id, numlines in textboxes:
+        lines = [Line(tokens) for tokens in line_tokens[i:i + numlines]]
+        blocks.append(Block(lines, id=textbox_id))
+        i += numlines
 
     page = Page(
         blocks=blocks,
@@ -106,6 +81,97 @@ def _read_page(elem):
     return page
 
 
+def _group_glyphs(texts, fonts, sizes, bboxes, line_ends, deduplicator=None):
+    """
+    Group the glyphs of a page into tokens and return the list of
+    tokens of each line.
+
+    The glyphs are given as lists of their texts, fonts, sizes, and
+    bboxes (as the strings of the XML attributes), and *line_ends*
+    gives the number of glyphs up to the end of each line. A glyph
+    starts a new token unless it has the same font and size as the
+    previous glyph of its line, is alphanumeric if and only if that one
+    is, and is at most *max_char_dx* of their average width to its
+    right.
+    """
+    n = len(texts)
+    counts = np.diff([0] + line_ends)
+    line_of = np.repeat(np.arange(len(line_ends)), counts)
+    coords = np.zeros((0, 4))
+    if n:
+        coords = np.array(','.join(bboxes).split(','), dtype=np.float64)
+        if len(coords) != 4 * n:
+            raise ValueError('Invalid glyph bbox.')
+        coords = coords.reshape((n, 4))
+    size = np.array(sizes, dtype=np.float64)
+    if deduplicator is not None:
+        keep = [
+            not deduplicator.is_duplicate(text, tuple(bbox))
+            for text, bbox in zip(texts, coords.tolist())
+        ]
+        texts = [t for t, k in zip(texts, keep) if k]
+        fonts = [f for f, k in zip(fonts, keep) if k]
+        coords, size, line_of = coords[keep], size[keep], line_of[keep]
+        n = len(texts)
+
+    font_ids = {}
+    font = np.array(
+        [font_ids.setdefault(f, len(font_ids)) for f in fonts], dtype=int
+    )
+    isalnum = np.array([t.isalnum() for t in texts], dtype=bool)
+    llx, lly, urx, ury = coords.T
+    width = urx - llx
+    # compare each glyph with the previous one
+    prev_width, cur_width = width[:-1], width[1:]
+    avg_width = np.where(
+        prev_width == 0, cur_width, (prev_width + cur_width) / 2
+    )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # glyphs with no width are split from the previous glyph
+        # unless they overlap it
+        close = (llx[1:] - urx[:-1]) / avg_width <= max_char_dx
+    joined = (
+        (line_of[1:] == line_of[:-1])
+        & (font[1:] == font[:-1]) & (size[1:] == size[:-1])
+        & close & (isalnum[1:] == isalnum[:-1])
+    )
+    starts = np.flatnonzero(np.concatenate(([True], ~joined))[:n])
+    ends = np.append(starts[1:], n)
+
+    bounds = zip(
+        _reduce_tokens(min, np.minimum, llx, starts, ends),
+        _reduce_tokens(min, np.minimum, lly, starts, ends),
+        _reduce_tokens(max, np.maximum, urx, starts, ends),
+        _reduce_tokens(max, np.maximum, ury, starts, ends)
+    )
+    tokens = [
+        Token(''.join(texts[a:b]), bbox, fonts[a], {})
+        for a, b, bbox in zip(starts.tolist(), ends.tolist(), bounds)
+    ]
+    line_tokens = []
+    i = 0
+    per_line = np.bincount(line_of[starts], minlength=len(line_ends))
+    for count in per_line.tolist():
+        line_tokens.append(tokens[i:i + count])
+        i += count
+    return line_tokens
+
+
+def _reduce_tokens(func, ufunc, values, starts, ends):
+    """
+    Return the list of *func* (`min` or `max`) of *values* over each
+    token from *starts* to *ends*, computed with *ufunc*.
+    """
+    if not len(starts):
+        return []
+    result = ufunc.reduceat(values, starts)
+    # for 0.0 and -0.0 (or NaN), func() keeps the first glyph's value
+    # but ufunc may not, so these tokens are left to func()
+    for k in np.flatnonzero((result == 0) | np.isnan(result)).tolist():
+        result[k] = func(values[starts[k]:ends[k]].tolist())
+    return result.tolist()
+
+
 invalid_char_re = re.compile(
     '[^\x09\x0A\x0D\u0020-\uD7FF\uE000-\uFFFD'
     #'\U00010000-\U0010FFFF]'
@@ -114,6 +180,30 @@ invalid_char_re = re.compile(
 )
 
 
+class _CleanXMLStream(object):
+    """
+    Read-only file-like object over the lines of *f* (a text or binary
+    file) with invalid XML characters replaced.
+    """
+    def __init__(self, f):
+        self._lines = iter(f)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            if isinstance(line, bytes):
+                # lines of a binary file are complete UTF-8 sequences
+                line = line.decode('utf-8', 'replace')
+            self._buffer += replace_invalid_xml_chars(line)
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
 def replace_invalid_xml_chars(input, replacement_char='\uFFFD'):
     # \uFFFD is the unicode replacement character
     return invalid_char_re.sub(replacement_char, input)
@@ -2,38 +2,31 @@
 from __future__ import absolute_import
 
 from collections import Counter
-from gzip import GzipFile
-from xml.etree import ElementTree as ET
 
+from freki.fileio import open_input
 from freki.readers.base import FrekiReader
 from freki.structures import Token, Line, Block, Page
 
 
 class TetmlReader(FrekiReader):
-    def __init__(self, tetml_file, debug=False):
-        FrekiReader.__init__(self, debug=debug)
-        if hasattr(tetml_file, 'read'):
-            f = tetml_file
-        else:
-            if tetml_file.endswith('.gz'):
-                f = GzipFile(tetml_file)
-            else:
-                f = open(tetml_file, 'r')
+    # increment when the pages produced for the same input change
+    version = 1
 
-        self.file = f
+    def __init__(self, tetml_file, debug=False, dedupe=None, page_ids=None):
+        FrekiReader.__init__(
+            self, debug=debug, dedupe=dedupe, page_ids=page_ids
+        )
+        # paths and binary files may be compressed
+        self.file = open_input(tetml_file)
         self._pages = {}
         self._init_pages()
 
     def _init_pages(self):
-        # iterparse to strip namespaces (is there a better way?)
-        # thanks: https://bugs.python.org/msg216774
-        xml_iter = ET.iterparse(self.file)
-        for event in xml_iter:
-            _, elem = event
-            elem.tag = elem.tag.split('}', 1)[-1]
-            if elem.tag == 'Page':
-                page = _read_page(elem)
-                self._pages[page.id] = page
+        for elem in self._page_elements(self.file, 'Page', 'number'):
+            deduplicator = self._deduplicator()
+            page = _read_page(elem, deduplicator)
+            self._log_duplicates(page, deduplicator, 'tokens')
+            self._pages[page.id] = page
 
     def pages(self, *page_ids):
         if not page_ids:
@@ -41,7 +34,7 @@ class TetmlReader(FrekiReader):
         return [self._pages[pid] for pid in page_ids]
 
 
-def _read_page(elem):
+def _read_page(elem, deduplicator=None):
     blocks = []
     for i, para in enumerate(elem.findall('.//Para')):
         block = Block(id=i+1)
@@ -73,14 +66,18 @@ def _read_page(elem):
                 ).most_common(1)[0][0]
                 if sub_sup[0]: features['sub'] = True
                 if sub_sup[1]: features['sup'] = True
+                bbox = (
+                    float(box.get('llx')),
+                    float(box.get('lly')),
+                    float(box.get('urx')),
+                    float(box.get('ury'))
+                )
+                if (deduplicator is not None
+                        and deduplicator.is_duplicate(boxtext, bbox)):
+                    continue
                 token = Token(
                     boxtext,
-                    (
-                        float(box.get('llx')),
-                        float(box.get('lly')),
-                        float(box.get('urx')),
-                        float(box.get('ury'))
-                    ),
+                    bbox,
                     font=font_info[0],
                     # size=float(font_info[1]),
                     features=features
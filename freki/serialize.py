@@ -16,6 +16,8 @@ the fonts contained on that line, and language ID information.
 """
 
 import copy
+import logging
+import os
 import re
 
 
@@ -25,75 +27,119 @@ import re
 # Representation of a document, consisting of a collection
 # of blocks.
 # -------------------------------------------
-from collections import OrderedDict, Iterable
-from gzip import GzipFile
+from collections import OrderedDict, Iterable, defaultdict
+
+from freki.fileio import open_input, open_output, compression_for
 
 
 class FrekiDoc(object):
     """
     Class to contain unified reading/writing of freki documents.
+
+    Lines are indexed by tag, span_id, and font, and blocks by page,
+    so the `lines_by_*` and `blocks_by_page` queries do not need to
+    scan the document. The indexes are kept current by :meth:`add_line`,
+    :meth:`add_block`, and the `tag`, `span_id`, and `fonts` setters of
+    :class:`FrekiLine`.
     """
     def __init__(self):
         self.blockmap = OrderedDict()
         self.linemap = OrderedDict()
+        self._tags = _Index()
+        self._span_ids = _Index()
+        self._fonts = _Index()
+        self._pages = _Index()
+        self._block_order = {}
+        self._spans = None
 
     def __len__(self):
         return len(self.linemap)
 
     @classmethod
-    def read(cls, path):
+    def read(cls, path, delta=None):
         """
         Read in a Freki Document from a file.
 
-        :param path:
+        :param path: path to the Freki file, which may be compressed
+            with gzip, bz2, or xz
+        :param delta: path to a delta file (see :func:`write_delta`)
+            whose tag and span updates are applied after loading
         :return:
         """
         # Create the blank document that will be returned.
         fd = cls()
 
-        # Load ".gz" files on-the-fly as necessary
-        if path.endswith('.gz'):
-            f = GzipFile(path, 'r')
-        else:
-            f = open(path, 'rb')
-        cur_block = None
-
-        for line in f:
-            line = line.decode(encoding='utf-8')
-            # Skip blank lines
-            if not line.strip():
-                continue
+        f = _open_freki(path)
+        for _ in _read_blocks(f, fd):
+            pass
+        f.close()
 
-            # If the line in the document
-            # is describing a new block,
-            # create the new block...
+        if delta is not None:
+            fd.update_lines(read_delta(delta))
 
-            # both `doc_id` and `block_id` are required attributes
-            pattern = re.compile("(^doc_id.*?block_id.*?)")
-            if pattern.match(line): 
-                doc_preamble = {a.strip():b.strip() for a,b in [item.split('=') for item in line.split()[:-2]]}
-                cur_block = FrekiBlock(**doc_preamble)
+        return fd
 
-                # Make the containing doc accessible
-                # to the block.
-                cur_block.doc = fd
+    def update_lines(self, updates):
+        """
+        Set the tag and span_id of lines in the document.
 
-                # Add this current block to the blockmap.
-                fd.blockmap[cur_block.block_id] = cur_block
+        :param updates: mapping of line numbers to `(tag, span_id)`
+            pairs; a tag of `None` removes the line's tag, so it has
+            the tag `O`, and a span_id of `None` removes the line from
+            its span
+        """
+        for lineno, (tag, span_id) in updates.items():
+            line = self.get_line(lineno)
+            if line is None:
+                logging.warning(
+                    'Cannot update line {}; it is not in the document.'
+                    .format(lineno)
+                )
+                continue
+            line.tag = tag
+            line.span_id = span_id
 
-            # Otherwise, if we are passing a new line
-            # element..
-            elif line.startswith('line'):
-                fl = FrekiLine.reads(line)  # Parse it..
-                cur_block.add_line(fl)
-                fd.add_line(fl)
+    def __str__(self):
+        return '\n\n'.join([str(b) for b in self.blocks])
 
-        f.close()
+    def dumps(self, compact=False, precision=2):
+        """
+        Serialize the document.
 
-        return fd
+        With *compact*, the document begins with a `fonttable` header
+        listing each font once, line preambles refer to fonts by their
+        position in the table (e.g. `fonts=@0,@2`), and bbox coordinates
+        are rounded to *precision* decimal places. :meth:`read` expands
+        the font IDs again.
+        """
+        if not compact:
+            return str(self)
+        return '\n\n'.join(self._compact_parts(precision))
 
-    def __str__(self):
-        return '\n\n'.join([str(b) for b in self.blocks])
+    def dump(self, f, compact=False, precision=2):
+        """
+        Serialize the document to the text file *f*, as with
+        :meth:`dumps`, writing one block at a time instead of building
+        the whole string first.
+        """
+        if compact:
+            parts = self._compact_parts(precision)
+        else:
+            parts = (str(b) for b in self.blocks)
+        for i, part in enumerate(parts):
+            if i:
+                f.write('\n\n')
+            f.write(part)
+
+    def _compact_parts(self, precision):
+        fontids = OrderedDict()
+        for line in self.lines():
+            for font in (line.attrs.get('fonts') or '').split(','):
+                if font and font not in fontids:
+                    fontids[font] = '@{}'.format(len(fontids))
+        yield 'fonttable={}'.format(','.join(fontids))
+        for b in self.blocks:
+            yield b.dumps(fontids, precision)
 
     def get_line(self, lineno):
         """:rtype: FrekiLine"""
@@ -101,7 +147,11 @@ class FrekiDoc(object):
 
     def set_line(self, lineno, line):
         """:type line: FrekiLine """
+        old = self.linemap.get(lineno)
+        if old is not None:
+            self._unindex_line(old)
         self.linemap[lineno] = line
+        self._index_line(line)
 
     def lines(self):
         """
@@ -116,6 +166,11 @@ class FrekiDoc(object):
         Return an ordered dict of the spans in the document, with
         their IDs.
         """
+        if self._spans is None:
+            self._spans = self._find_spans()
+        return OrderedDict(self._spans)
+
+    def _find_spans(self):
         spans = OrderedDict()
         cur_span = None
         cur_span_id = None
@@ -138,6 +193,40 @@ class FrekiDoc(object):
 
         return spans
 
+    def lines_by_tag(self, tag):
+        """
+        Return the lines with tag *tag*, in document order.
+
+        Lines without an explicit tag have the tag `O`.
+        :rtype: list[FrekiLine]
+        """
+        return [self.linemap[ln] for ln in self._tags.get(tag)]
+
+    def lines_by_span(self, span_id):
+        """
+        Return the lines in the span *span_id*, in document order.
+        :rtype: list[FrekiLine]
+        """
+        return [self.linemap[ln] for ln in self._span_ids.get(span_id)]
+
+    def lines_by_font(self, font):
+        """
+        Return the lines using *font*, in document order.
+
+        *font* may be a :class:`FrekiFont` or a string like `F1-10.9`.
+        :rtype: list[FrekiLine]
+        """
+        if not isinstance(font, FrekiFont):
+            font = FrekiFont.reads(font)
+        return [self.linemap[ln] for ln in self._fonts.get(font)]
+
+    def blocks_by_page(self, page):
+        """
+        Return the blocks on page *page*, in document order.
+        :rtype: list[FrekiBlock]
+        """
+        return [self.blockmap[bid]
+                for bid in self._pages.get(int(page), self._block_order.get)]
 
     @property
     def blocks(self):
@@ -157,25 +246,292 @@ class FrekiDoc(object):
 
     @property
     def pages(self):
-        if not hasattr(self, '_pages'):
-            pageset = set([])
-            for block in self.blocks:
-                pageset.add(block.page)
-            self._pages = pageset
-        return self._pages
+        return set(self._pages.keys())
 
     def add_line(self, fl):
         """:type fl: FrekiLine"""
         fl.doc = self
-        self.linemap[fl.lineno] = fl
+        self.set_line(fl.lineno, fl)
 
     def add_block(self, fb):
         """:type fb: FrekiBlock"""
         fb.doc = self
         for line in fb.lines:
-            if line.lineno not in self.linemap.keys():
+            if line.lineno not in self.linemap:
                 self.add_line(line)
+        old = self.blockmap.get(fb.block_id)
+        if old is None:
+            self._block_order[fb.block_id] = len(self._block_order)
+        elif old._attrs.get('page') is not None:
+            self._pages.discard(old.page, fb.block_id)
         self.blockmap[fb.block_id] = fb
+        if fb._attrs.get('page') is not None:
+            self._pages.add(fb.page, fb.block_id)
+
+    def _index_line(self, fl):
+        lineno = fl.lineno
+        self._tags.add(fl.tag, lineno)
+        if fl.span_id is not None:
+            self._span_ids.add(fl.span_id, lineno)
+        for font in fl.fonts:
+            self._fonts.add(font, lineno)
+        self._spans = None
+
+    def _unindex_line(self, fl):
+        lineno = fl.lineno
+        self._tags.discard(fl.tag, lineno)
+        if fl.span_id is not None:
+            self._span_ids.discard(fl.span_id, lineno)
+        for font in fl.fonts:
+            self._fonts.discard(font, lineno)
+
+    def _owns(self, fl):
+        return self.linemap.get(fl.lineno) is fl
+
+
+class _Index(object):
+    """
+    Map keys to sets of items, with lazily sorted views per key.
+    """
+    def __init__(self):
+        self._items = defaultdict(set)
+        self._sorted = {}
+
+    def keys(self):
+        return self._items.keys()
+
+    def add(self, key, item):
+        self._items[key].add(item)
+        self._sorted.pop(key, None)
+
+    def discard(self, key, item):
+        items = self._items.get(key)
+        if items is not None:
+            items.discard(item)
+            if not items:
+                del self._items[key]
+            self._sorted.pop(key, None)
+
+    def get(self, key, sortkey=None):
+        if key not in self._sorted:
+            self._sorted[key] = sorted(self._items.get(key, ()), key=sortkey)
+        return self._sorted[key]
+
+
+def _open_freki(path):
+    # compressed files are detected by their content
+    return open_input(path)
+
+
+_block_re = re.compile("(^doc_id.*?block_id.*?)")
+
+
+def _read_blocks(f, doc=None, header=None):
+    """
+    Yield the blocks of the Freki file *f* (opened in binary mode) as
+    they are read. Blocks are added to *doc*, or if *doc* is `None`,
+    each to its own :class:`FrekiDoc`, so a block can be discarded once
+    it is processed. If *f* is compact, its font table is stored as
+    `header['fonttable']` in the dict *header*, if given, before the
+    first block is yielded.
+    """
+    cur_block = None
+    fonttable = None
+
+    for line in f:
+        line = line.decode(encoding='utf-8')
+        # Skip blank lines
+        if not line.strip():
+            continue
+
+        # Compact documents list their fonts in a header
+        if line.startswith('fonttable='):
+            fonttable = _read_fonttable(line)
+            if header is not None:
+                header['fonttable'] = fonttable
+            continue
+
+        # If the line in the document
+        # is describing a new block,
+        # create the new block...
+
+        # both `doc_id` and `block_id` are required attributes
+        if _block_re.match(line):
+            if cur_block is not None:
+                yield cur_block
+            doc_preamble = {a.strip():b.strip() for a,b in [item.split('=') for item in line.split()[:-2]]}
+            cur_block = FrekiBlock(**doc_preamble)
+
+            # Add this current block to the document, which
+            # also makes the document accessible to the block.
+            (FrekiDoc() if doc is None else doc).add_block(cur_block)
+
+        # Otherwise, if we are passing a new line
+        # element..
+        elif line.startswith('line'):
+            fl = FrekiLine.reads(line)  # Parse it..
+            if fonttable is not None and fl.attrs.get('fonts'):
+                fl.attrs['fonts'] = _expand_fonts(fl.attrs['fonts'], fonttable)
+            cur_block.add_line(fl)  # also adds it to the doc
+
+    if cur_block is not None:
+        yield cur_block
+
+
+def _read_fonttable(line):
+    fonts = line.split('=', 1)[1].strip()
+    return fonts.split(',') if fonts else []
+
+
+def _expand_fonts(fonts, fonttable):
+    """
+    Replace font IDs like `@2` in *fonts* with their entries in
+    *fonttable*.
+    """
+    return ','.join(
+        fonttable[int(f[1:])] if f.startswith('@') else f
+        for f in fonts.split(',')
+    )
+
+
+def _format_bbox(bbox, precision):
+    """
+    Round the coordinates in *bbox* to *precision* decimal places,
+    dropping trailing zeros (e.g. `72.0,302.62000000000001` becomes
+    `72,302.62`).
+    """
+    coords = []
+    for elt in bbox.split(','):
+        try:
+            elt = '{:.{}f}'.format(float(elt), precision)
+        except ValueError:
+            pass
+        else:
+            if '.' in elt:
+                elt = elt.rstrip('0').rstrip('.')
+            if elt == '-0':
+                elt = '0'
+        coords.append(elt)
+    return ','.join(coords)
+
+
+def update_file(inpath, updates, outpath=None):
+    """
+    Set the tag and span_id of lines in the Freki file at *inpath*.
+
+    The file is streamed through one block at a time, and the result is
+    identical to reading the whole document, calling
+    :meth:`FrekiDoc.update_lines` with *updates*, and writing it out
+    again in the same form: a compact file stays compact, with the
+    same font table and bbox coordinates. Only blocks are kept in
+    memory, so block IDs and line numbers are assumed to be unique
+    within the file.
+
+    :param inpath: path to the Freki file
+    :param updates: mapping of line numbers to `(tag, span_id)` pairs
+    :param outpath: path of the updated file; if `None`, *inpath* is
+        replaced
+    """
+    if outpath is None:
+        outpath = inpath
+    dirname, basename = os.path.split(outpath)
+    tmppath = os.path.join(dirname, '.{}.tmp'.format(basename))
+
+    f = _open_freki(inpath)
+    out = open_output(tmppath, compression=compression_for(outpath))
+    header = {}
+    fontids = None
+    try:
+        parts = 0
+        for block in _read_blocks(f, header=header):
+            for line in block.lines:
+                if line.lineno in updates:
+                    line.tag, line.span_id = updates[line.lineno]
+            if fontids is None and 'fonttable' in header:
+                # the coordinates were already rounded when the file
+                # was made compact, so only the font IDs are restored
+                fontids = _write_fonttable(out, header['fonttable'])
+                parts += 1
+            if parts:
+                out.write(b'\n\n')
+            out.write(block.dumps(fontids).encode('utf-8'))
+            parts += 1
+        if fontids is None and 'fonttable' in header:
+            _write_fonttable(out, header['fonttable'])
+    except Exception:
+        out.close()
+        os.remove(tmppath)
+        raise
+    else:
+        out.close()
+        os.replace(tmppath, outpath)
+    finally:
+        f.close()
+
+
+def _write_fonttable(out, fonttable):
+    """
+    Write the `fonttable` header listing *fonttable* to the binary
+    file *out* and return the mapping of its fonts to their IDs.
+    """
+    out.write('fonttable={}'.format(','.join(fonttable)).encode('utf-8'))
+    fontids = {}
+    for i, font in enumerate(fonttable):
+        fontids.setdefault(font, '@{}'.format(i))
+    return fontids
+
+
+def write_delta(path, updates):
+    """
+    Write *updates* to a delta file at *path*.
+
+    A delta file records tag and span_id changes without rewriting the
+    Freki file they apply to; pass it as the *delta* argument of
+    :meth:`FrekiDoc.read` to apply the changes when loading. Each line
+    of the file has the same form as a line preamble, e.g.:
+
+        line=366 tag=B-L span_id=s13
+
+    A missing span_id means the line is in no span.
+
+    :param updates: mapping of line numbers to `(tag, span_id)` pairs
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        for lineno in sorted(updates):
+            tag, span_id = updates[lineno]
+            attrs = [('line', lineno), ('tag', tag), ('span_id', span_id)]
+            f.write(' '.join('{}={}'.format(k, v) for k, v in attrs if v))
+            f.write('\n')
+
+
+def read_delta(path):
+    """
+    Read the updates in the delta file at *path*.
+
+    :return: an ordered mapping of line numbers to `(tag, span_id)` pairs
+    """
+    updates = OrderedDict()
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            attrs = dict(item.split('=', 1) for item in line.split())
+            updates[int(attrs['line'])] = (
+                attrs.get('tag'), attrs.get('span_id')
+            )
+    return updates
+
+
+_preamble_re = re.compile(r'\S+=[^=]+(?=(?:\s+\S+)|\s*$)')
+
+
+def read_preamble(preamble):
+    """
+    Return the attributes in a line *preamble* (the part of a line
+    before the first `:`) as a dict.
+    """
+    items = _preamble_re.findall(preamble)
+    return {k.strip(): v.strip() for k, v in (i.split('=') for i in items)}
 
 
 def linesort(a):
@@ -259,24 +615,41 @@ class FrekiBlock(object):
     def label(self): return self._attrs.get('label')
 
     def __str__(self):
-        start_line = self.lines[0].lineno if self.lines else 0  # Get the starting line number
-        stop_line = self.lines[-1].lineno if self.lines else 0 # Get the ending line number
+        return self.dumps()
+
+    def dumps(self, fontids=None, precision=None):
+        """
+        Serialize the block.
+
+        :param fontids: mapping of font strings to short font IDs used
+            in place of the fonts in line preambles
+        :param precision: if given, round bbox coordinates to this many
+            decimal places
+        """
+        lines = self.lines
+        start_line = lines[0].lineno if lines else 0  # Get the starting line number
+        stop_line = lines[-1].lineno if lines else 0 # Get the ending line number
+
+        bbox_str = self.bbox_str
+        if precision is not None:
+            bbox_str = _format_bbox(bbox_str, precision)
 
         ret_str = (
             'doc_id={} page={} block_id={} bbox={} label={} {} {}\n'.format(
                 self.doc_id,
                 self.page,
                 self.block_id,
-                self.bbox_str,
+                bbox_str,
                 self.label,
                 start_line,
                 stop_line
             )
         )
 
-        max_pre_len = max([len(l.preamble()) for l in self.lines]) if len(self.lines) else 0
+        preambles = [l.preamble(fontids, precision) for l in lines]
+        max_pre_len = max([len(p) for p in preambles]) if preambles else 0
 
-        ret_str += '\n'.join(['{{:<{}}}:{{}}'.format(max_pre_len).format(line.preamble(), line) for line in self.lines])
+        ret_str += '\n'.join(['{{:<{}}}:{{}}'.format(max_pre_len).format(pre, line) for pre, line in zip(preambles, lines)])
 
         return ret_str
 
@@ -304,7 +677,7 @@ class FrekiLine(str):
     def tag(self): return self.attrs.get('tag', 'O')
 
     @tag.setter
-    def tag(self, v): self.attrs['tag'] = v
+    def tag(self, v): self._update('tag', v)
 
     @property
     def lineno(self): return int(self.attrs.get('line'))
@@ -313,7 +686,7 @@ class FrekiLine(str):
     def span_id(self): return self.attrs.get('span_id')
 
     @span_id.setter
-    def span_id(self, v): self.attrs['span_id'] = v
+    def span_id(self, v): self._update('span_id', v)
 
     @property
     def fonts(self):
@@ -329,8 +702,26 @@ class FrekiLine(str):
     @fonts.setter
     def fonts(self, fonts):
         """:type fonts: list[FrekiFont]"""
-        self.attrs['fonts'] = ','.join([str(f) for f in fonts])
+        self._update('fonts', ','.join([str(f) for f in fonts]))
+
+    def _update(self, key, value):
+        """
+        Set attribute *key* (or remove it if *value* is `None`), keeping
+        the containing doc's indexes current.
+        """
+        doc = self.doc
+        if doc is not None and doc._owns(self):
+            doc._unindex_line(self)
+            self._set_attr(key, value)
+            doc._index_line(self)
+        else:
+            self._set_attr(key, value)
 
+    def _set_attr(self, key, value):
+        if value is None:
+            self.attrs.pop(key, None)
+        else:
+            self.attrs[key] = value
 
     @property
     def block(self):
@@ -349,13 +740,25 @@ class FrekiLine(str):
     @doc.setter
     def doc(self, d): self._doc = d
 
-    def preamble(self):
+    def preamble(self, fontids=None, precision=None):
         """
         Returns the preamble metadata
 
+        :param fontids: mapping of font strings to short font IDs
+        :param precision: if given, round bbox coordinates to this many
+            decimal places
         :return:
         """
-        pre_data = ['{}={}'.format(k, v) for k, v in sorted(self.attrs.items(), key=lambda x: linesort(x[0])) if
+        attrs = self.attrs
+        if fontids is not None or precision is not None:
+            attrs = attrs.copy()
+            if fontids is not None and attrs.get('fonts'):
+                attrs['fonts'] = ','.join(
+                    fontids.get(f, f) for f in attrs['fonts'].split(',')
+                )
+            if precision is not None and attrs.get('bbox'):
+                attrs['bbox'] = _format_bbox(attrs['bbox'], precision)
+        pre_data = ['{}={}'.format(k, v) for k, v in sorted(attrs.items(), key=lambda x: linesort(x[0])) if
                     k != 'str_' and v]
         return ' '.join(pre_data)
 
@@ -369,9 +772,7 @@ class FrekiLine(str):
         :rtype: FrekiLine
         """
         preamble, text = re.search('(line.*?):(.*)', line).groups()
-        preamble_data = re.findall('\S+=[^=]+(?=(?:\s+\S+)|\s*$)', preamble)
-        line_preamble = {k.strip():v.strip() for k, v in [item.split('=') for item in preamble_data]}
-        return cls(text, **line_preamble)
+        return cls(text, **read_preamble(preamble))
 
     def search(self, regex, flags=0):
         return re.search(regex, self, flags=flags)
@@ -0,0 +1,432 @@
+"""
+Conversion server for long-running use.
+
+Starting `freki` for each document pays for the Python start-up,
+module imports, and a cold reader cache and page memo every time.
+`freki serve` instead keeps a pool of warm worker processes and reads
+conversion jobs as JSON lines, either on stdin or from clients of a
+UNIX domain socket, and writes one JSON response line per job as it
+finishes.
+
+A job is an object with either an `infile` path or the XML itself as
+an `xml` string, and optionally:
+
+* `id`: returned unchanged in the response
+* `doc_id`: the document id (default: from `infile`, else `id`)
+* `outfile`: write the Freki file here instead of returning it
+* `reader`, `analyzer`: as for `freki` (default: `tetml`, `xycut`)
+* `pages`: page ranges (e.g., `"1-5,9"`) or a list of page numbers
+* `dedupe`: `true` or the dedupe tolerance in points
+* `compact`, `gzip`, `pyramid`: `true` to enable
+* `pyramid_tolerance`: as for `--pyramid-tolerance`
+* `templates`: `true` to reuse XY-cuts across pages, as `--templates`
+* `xycut_params`: an object of XY-cut parameter overrides
+
+The response has the job's `id`, a `status` of `ok` or `error`, the
+`outfile` written or the Freki text as `freki` (or the `error`
+message), and the `seconds` spent reading, analyzing, writing, in
+total in the worker, and in total since the job was received
+(`wall`, which includes waiting for a free worker).
+
+At most *max_pending* jobs are queued, running, or waiting for their
+response to be written at once; further jobs are not read until the
+response of one is written, so a client that sends fast or reads
+slowly is slowed to the pace of the workers and of its own reading
+instead of filling memory.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import queue
+import socket
+import signal
+import stat
+import logging
+import argparse
+import threading
+import traceback
+import socketserver
+import multiprocessing
+
+from freki.main import (
+    analyzers, make_reader, write_output, freki_doc, _doc_id_from_path
+)
+from freki.readers.base import parse_page_ranges
+from freki.readers.dedupe import DEFAULT_TOLERANCE
+from freki.cache import ReaderCache
+from freki.analyzers.memo import PageMemo
+from freki.analyzers.templates import LayoutTemplates
+
+# the reader cache and page memo of a worker; see _init_worker()
+_cache = None
+_memo = None
+
+
+class Server(object):
+    """
+    Pool of *processes* workers (default: one per CPU) running jobs,
+    with at most *max_pending* jobs (default: twice the number of
+    workers) submitted at once.
+
+    Each worker keeps its own in-memory page memo if *memo* is `True`,
+    and uses a reader cache in the directory *cache* if given.
+    """
+    def __init__(self, processes=None, max_pending=None, cache=None,
+                 cache_size=1024, memo=False):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if max_pending is None:
+            max_pending = 2 * processes
+        self.pool = multiprocessing.Pool(
+            processes, initializer=_init_worker,
+            initargs=(cache, cache_size, memo)
+        )
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, job, respond):
+        """
+        Run *job* on a worker and call `respond(response, release)`
+        with its response. The job keeps its place among the
+        *max_pending* until `release()` is called, e.g., once the
+        response is written. Blocks while *max_pending* jobs are
+        pending.
+
+        :return: the pool's AsyncResult for the job
+        """
+        received = time.time()
+        self._slots.acquire()
+
+        def done(response):
+            # this runs on the pool's result thread, which must not die
+            try:
+                response['seconds']['wall'] = round(
+                    time.time() - received, 4
+                )
+                respond(response, self._slots.release)
+            except Exception:
+                logging.error(traceback.format_exc())
+                self._slots.release()
+
+        def failed(ex):
+            response = _error_response(job, ex)
+            response['seconds'] = {}
+            done(response)
+
+        try:
+            return self.pool.apply_async(
+                handle, (job,), callback=done, error_callback=failed
+            )
+        except Exception:
+            self._slots.release()
+            raise
+
+    def serve_stream(self, infile, outfile):
+        """
+        Run the jobs read as JSON lines from the binary file *infile*
+        and write their responses to the binary file *outfile*. Return
+        once all responses have been written, or dropped if *outfile*
+        can no longer be written (e.g., the client disconnected).
+        """
+        writer = _ResponseWriter(outfile)
+        try:
+            for line in infile:
+                line = line.decode('utf-8').strip()
+                if not line:
+                    continue
+                writer.add()
+                job = {}
+                try:
+                    parsed = json.loads(line)
+                    if not isinstance(parsed, dict):
+                        raise ValueError('a job must be a JSON object')
+                    job = parsed
+                    self.submit(job, writer.put)
+                except Exception as ex:
+                    response = _error_response(job, ex)
+                    response['seconds'] = {}
+                    writer.put(response)
+        finally:
+            writer.close()
+
+    def serve_socket(self, path):
+        """
+        Listen on a UNIX domain socket at *path* and serve the jobs of
+        each client connection as with :meth:`serve_stream`, until
+        interrupted.
+        """
+        _remove_stale_socket(path)
+        server = _UnixServer(path, _StreamHandler)
+        server.freki_server = self
+        logging.info('Listening on {}'.format(path))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(path)
+
+    def close(self):
+        """
+        Wait for pending jobs to finish and stop the workers.
+        """
+        self.pool.close()
+        self.pool.join()
+
+
+class _ResponseWriter(object):
+    """
+    Thread writing the responses of a stream to the binary file
+    *outfile* as they are put, so that a slow or closed client cannot
+    block or break the pool's result thread.
+
+    Call :meth:`add` for each response to expect before it is put, and
+    :meth:`close` to wait until all of them are written. Once a write
+    fails (e.g., the client disconnected), the remaining responses are
+    dropped.
+    """
+    def __init__(self, outfile):
+        self._outfile = outfile
+        self._queue = queue.Queue()
+        self._expected = 0
+        self._written = threading.Condition()
+        self._broken = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self):
+        with self._written:
+            self._expected += 1
+
+    def put(self, response, release=None):
+        """
+        Queue *response* for writing and call *release* once it is
+        written or dropped.
+        """
+        self._queue.put((response, release))
+
+    def close(self):
+        with self._written:
+            while self._expected:
+                self._written.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            response, release = item
+            try:
+                self._write(response)
+            except Exception:
+                logging.error(traceback.format_exc())
+            finally:
+                if release is not None:
+                    release()
+                with self._written:
+                    self._expected -= 1
+                    self._written.notify_all()
+
+    def _write(self, response):
+        if self._broken:
+            return
+        data = json.dumps(response, sort_keys=True) + '\n'
+        try:
+            self._outfile.write(data.encode('utf-8'))
+            self._outfile.flush()
+        except OSError as ex:
+            logging.warning(
+                'Dropping responses to a closed stream: {}'.format(ex)
+            )
+            self._broken = True
+
+
+def _remove_stale_socket(path):
+    """
+    Remove the socket file at *path* if no server is listening on it,
+    e.g., one left by a server that was killed.
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except ConnectionRefusedError:
+        logging.info('Removing stale socket {}'.format(path))
+        os.remove(path)
+    finally:
+        sock.close()
+
+
+class _UnixServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _StreamHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.freki_server.serve_stream(self.rfile, self.wfile)
+
+
+def _init_worker(cache, cache_size, memo):
+    global _cache, _memo
+    # let the parent process handle interrupts
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if cache is not None:
+        _cache = ReaderCache(cache, max_bytes=cache_size * 2**20)
+    if memo:
+        _memo = PageMemo()
+
+
+def handle(job):
+    """
+    Run the conversion *job* (a dict as described above) and return
+    its response.
+    """
+    start = time.time()
+    seconds = {}
+    try:
+        response = _convert(job, seconds)
+    except Exception as ex:
+        logging.debug(traceback.format_exc())
+        response = _error_response(job, ex)
+    seconds['total'] = time.time() - start
+    response['seconds'] = dict((k, round(v, 4)) for k, v in seconds.items())
+    return response
+
+
+def _convert(job, seconds):
+    infile = job.get('infile')
+    xml = job.get('xml')
+    if (infile is None) == (xml is None):
+        raise ValueError('a job needs one of "infile" or "xml"')
+    doc_id = job.get('doc_id')
+    if doc_id is None:
+        doc_id = _doc_id_from_path(infile) if infile else job.get('id')
+    if doc_id is not None:
+        doc_id = str(doc_id)
+    source = infile if xml is None else io.StringIO(xml)
+
+    options = {}
+    dedupe = job.get('dedupe')
+    if dedupe:
+        options['dedupe'] = (
+            DEFAULT_TOLERANCE if dedupe is True else float(dedupe)
+        )
+    pages = job.get('pages')
+    if pages is not None:
+        if not isinstance(pages, list):
+            pages = parse_page_ranges(str(pages))
+        options['page_ids'] = pages
+    cache = _cache if xml is None else None
+
+    t = time.time()
+    reader = make_reader(
+        job.get('reader', 'tetml'), source, cache=cache, **options
+    )
+    seconds['read'] = time.time() - t
+
+    t = time.time()
+    analyzer = analyzers[job.get('analyzer', 'xycut')](
+        memo=_memo, params=job.get('xycut_params'),
+        pyramid=bool(job.get('pyramid')),
+        tolerance=job.get('pyramid_tolerance', 0),
+        templates=LayoutTemplates() if job.get('templates') else None
+    )
+    doc = analyzer.analyze(reader, id=doc_id)
+    seconds['analyze'] = time.time() - t
+
+    t = time.time()
+    response = {'id': job.get('id'), 'status': 'ok'}
+    compact = bool(job.get('compact'))
+    outfile = job.get('outfile')
+    if outfile is not None:
+        response['outfile'] = write_output(
+            doc, outfile, gzipped=bool(job.get('gzip')), compact=compact
+        )
+    else:
+        response['freki'] = freki_doc(doc).dumps(compact=compact)
+    seconds['write'] = time.time() - t
+    return response
+
+
+def _error_response(job, ex):
+    return {
+        'id': job.get('id'),
+        'status': 'error',
+        'error': '{}: {}'.format(type(ex).__name__, ex)
+    }
+
+
+def main(arglist=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='Convert documents given as JSON-lines jobs on a pool '
+                    'of warm workers',
+        prog='freki serve',
+        epilog='examples:\n'
+               '    freki serve -j 4 < jobs.jsonl > responses.jsonl\n'
+               '    freki serve --socket /tmp/freki.sock --memo'
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='count', dest='verbosity', default=2,
+        help='increase the verbosity (can be repeated: -vvv)'
+    )
+    parser.add_argument(
+        '--socket',
+        metavar='PATH',
+        help='listen on a UNIX domain socket at PATH instead of reading '
+             'jobs on stdin'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar='N', type=int,
+        help='number of worker processes (default: one per CPU)'
+    )
+    parser.add_argument(
+        '--max-pending',
+        metavar='N', type=int,
+        help='maximum number of jobs queued, running, or with responses '
+             'not yet written at once (default: twice the number of '
+             'workers)'
+    )
+    parser.add_argument(
+        '--cache',
+        metavar='DIR',
+        help='cache parsed reader output in DIR and reuse it'
+    )
+    parser.add_argument(
+        '--cache-size',
+        metavar='MB', type=int, default=1024,
+        help='maximum size of the reader cache (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--memo',
+        action='store_true',
+        help='reuse the analysis of pages with identical layouts across '
+             'the jobs of each worker'
+    )
+    args = parser.parse_args(arglist)
+    logging.basicConfig(level=50-(args.verbosity*10))
+
+    server = Server(
+        processes=args.jobs, max_pending=args.max_pending,
+        cache=args.cache, cache_size=args.cache_size, memo=args.memo
+    )
+    try:
+        if args.socket is not None:
+            server.serve_socket(args.socket)
+        else:
+            server.serve_stream(sys.stdin.buffer, sys.stdout.buffer)
+    except KeyboardInterrupt:
+        server.pool.terminate()
+    finally:
+        server.close()
@@ -0,0 +1,337 @@
+"""
+Splitting a batch across machines.
+
+Several machines sharing a filesystem can convert one batch without a
+coordinator: each is given `--shard I/N` and converts shard *I* (from
+0) of *N*. The inputs are ordered by a hash of their relative paths and
+the order is cut into *N* runs of about the same total size, so the
+shards take about the same time. As the runs depend on the sizes of
+all inputs, the first shard to start writes this assignment to the
+directory shared by the shards (`assignment-of-N.tsv`), and every
+shard, including a restarted one, reads it from there, so that all
+shards use the same assignment even if inputs change in between.
+Inputs added after it was written are assigned by their hash alone.
+
+Each shard appends the result of every finished input to its
+checkpoint file, which it reads again when restarted to skip the
+inputs already converted, and writes a metrics file when it is done.
+Both are kept in a directory shared by the shards (`shard-I-of-N.tsv`
+and `shard-I-of-N.json`). `freki shards DIR` merges the metrics of
+all shards and checks that every input was converted exactly once.
+"""
+
+import os
+import sys
+import json
+import time
+import glob
+import hashlib
+import logging
+import argparse
+from collections import Counter
+
+# version of the metrics format
+METRICS_VERSION = 1
+
+
+def parse_shard(spec):
+    """
+    Parse a shard spec `I/N` and return `(I, N)`.
+
+    >>> parse_shard('2/8')
+    (2, 8)
+    """
+    try:
+        index, count = [int(x) for x in spec.split('/')]
+    except ValueError:
+        raise ValueError('invalid shard: {} (expected I/N)'.format(spec))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(
+            'invalid shard: {} (I must be from 0 to N-1)'.format(spec)
+        )
+    return index, count
+
+
+def assign_shards(items, count):
+    """
+    Return the shard (0 to *count*-1) of each of *items*, a list of
+    `(key, size)`, so that the shards have about the same total size.
+    """
+    order = sorted(
+        range(len(items)), key=lambda i: (_key_hash(items[i][0]), items[i][0])
+    )
+    # empty inputs still take some time
+    sizes = [max(1, size) for _, size in items]
+    total = sum(sizes)
+    shards = [0] * len(items)
+    pos = 0
+    for i in order:
+        # an input goes to the shard where its middle falls
+        mid = pos + sizes[i] / 2
+        shards[i] = min(int(mid * count / total), count - 1)
+        pos += sizes[i]
+    return shards
+
+
+def _key_hash(key):
+    # unlike hash(), the same on every machine and in every process
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def select_shard(rows, indir, index, count, directory=None):
+    """
+    Return the manifest *rows* (field lists starting with a path
+    relative to *indir*) in shard *index* of *count*, weighted by the
+    sizes of the input files.
+
+    If *directory* is given, the assignment of the inputs to shards is
+    read from it, or written there if it is not yet (see
+    :func:`load_assignment`).
+    """
+    items = []
+    for row in rows:
+        try:
+            size = os.path.getsize(os.path.join(indir, row[0]))
+        except OSError:
+            size = 0  # it will fail, but still needs a shard
+        items.append((row[0], size))
+    if directory is None:
+        shards = assign_shards(items, count)
+    else:
+        assignment = load_assignment(directory, count, items)
+        shards = [assignment[key] for key, _ in items]
+    return [row for row, shard in zip(rows, shards) if shard == index]
+
+
+def load_assignment(directory, count, items):
+    """
+    Return the shard of each input of *items* (a list of `(key, size)`)
+    as `{key: shard}`, using the assignment of the batch to *count*
+    shards in *directory*.
+
+    The first call for a batch writes the assignment of *items* (as
+    from :func:`assign_shards`) there; later calls read it, so that
+    they give the same shards even if the sizes of the inputs have
+    changed. Inputs not in the assignment are assigned by their hash.
+    """
+    path = os.path.join(directory, 'assignment-of-{}.tsv'.format(count))
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        shards = assign_shards(items, count)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for (key, _), shard in zip(items, shards):
+                f.write('{}\t{}\n'.format(key, shard))
+        try:
+            # fails if another shard wrote its assignment first
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+    assignment = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            key, shard = line.rstrip('\n').rsplit('\t', 1)
+            assignment[key] = int(shard)
+    for key, _ in items:
+        if key not in assignment:
+            assignment[key] = int(_key_hash(key), 16) % count
+    return assignment
+
+
+class ShardLog(object):
+    """
+    Checkpoint and metrics of shard *index* of *count* in *directory*.
+
+    :param inputs: the relative paths of the inputs of the shard
+    :param total: the number of inputs of all shards
+    """
+    def __init__(self, directory, index, count, inputs, total):
+        self.index = index
+        self.count = count
+        self.inputs = list(inputs)
+        self.total = total
+        base = os.path.join(
+            directory, 'shard-{}-of-{}'.format(index, count)
+        )
+        self.checkpoint_path = base + '.tsv'
+        self.metrics_path = base + '.json'
+        os.makedirs(directory, exist_ok=True)
+        self.results = read_checkpoint(self.checkpoint_path)
+        self.started = time.time()
+        self._checkpoint = open(self.checkpoint_path, 'a', encoding='utf-8')
+
+    def pending(self):
+        """
+        Return the inputs that have not been converted yet.
+        """
+        return [
+            path for path in self.inputs
+            if self.results.get(path, {}).get('status') != 'ok'
+        ]
+
+    def add(self, path, result):
+        """
+        Record the *result* (as from :func:`freki.batch.run_jobs`) of
+        the input *path* in the checkpoint.
+        """
+        self.results[path] = {
+            'status': result['status'], 'seconds': result['seconds'],
+            'bytes': result.get('info', {}).get('bytes', 0)
+        }
+        self._checkpoint.write('{}\t{}\t{:.3f}\t{}\n'.format(
+            path, result['status'], result['seconds'],
+            self.results[path]['bytes']
+        ))
+        # flushed so a killed shard loses at most the current input
+        self._checkpoint.flush()
+
+    def close(self):
+        """
+        Close the checkpoint and write the metrics of the shard.
+        """
+        self._checkpoint.close()
+        tmp = self.metrics_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.metrics(), f, indent=2, sort_keys=True)
+        os.replace(tmp, self.metrics_path)
+
+    def metrics(self):
+        results = [self.results[p] for p in self.inputs if p in self.results]
+        statuses = Counter(r['status'] for r in results)
+        return {
+            'version': METRICS_VERSION,
+            'shard': [self.index, self.count],
+            'total_inputs': self.total,
+            'inputs': self.inputs,
+            'documents': len(results),
+            'ok': statuses['ok'],
+            'failed': statuses['error'],
+            'bytes': sum(r['bytes'] for r in results),
+            'seconds': round(sum(r['seconds'] for r in results), 3),
+            'wall_seconds': round(time.time() - self.started, 3),
+        }
+
+
+def read_checkpoint(path):
+    """
+    Return the last result of each input in the checkpoint at *path*
+    as `{path: {'status': ..., 'seconds': ..., 'bytes': ...}}`.
+    """
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 4:
+                continue  # a line cut off when the shard was killed
+            results[fields[0]] = {
+                'status': fields[1], 'seconds': float(fields[2]),
+                'bytes': int(fields[3])
+            }
+    return results
+
+
+def merge_shards(directory):
+    """
+    Merge the metrics of the shards in *directory* and check that
+    every input was converted exactly once.
+
+    :return: `(metrics, problems)`, where *metrics* sums the metrics
+        of the shards and *problems* lists what is missing or wrong
+    """
+    problems = []
+    shards = {}
+    for path in sorted(glob.glob(os.path.join(directory, 'shard-*.json'))):
+        with open(path, encoding='utf-8') as f:
+            m = json.load(f)
+        if m.get('version') != METRICS_VERSION:
+            problems.append('{}: unsupported version'.format(path))
+            continue
+        m['path'] = path[:-len('.json')] + '.tsv'
+        shards[tuple(m['shard'])] = m
+    counts = set(count for _, count in shards)
+    totals = set(m['total_inputs'] for m in shards.values())
+    if not shards:
+        problems.append('no shard metrics in {}'.format(directory))
+    elif len(counts) > 1 or len(totals) > 1:
+        problems.append('the shards are of different batches')
+    else:
+        count = counts.pop()
+        for index in range(count):
+            if (index, count) not in shards:
+                problems.append('shard {}/{} is missing'.format(index, count))
+
+    merged = Counter()
+    owners = {}
+    for (index, count), m in sorted(shards.items()):
+        for key in ('documents', 'ok', 'failed', 'bytes'):
+            merged[key] += m[key]
+        merged['seconds'] += m['seconds']
+        merged['wall_seconds'] = max(merged['wall_seconds'],
+                                     m['wall_seconds'])
+        results = read_checkpoint(m['path'])
+        for path in m['inputs']:
+            owners.setdefault(path, []).append('{}/{}'.format(index, count))
+            status = results.get(path, {}).get('status')
+            if status is None:
+                problems.append('{}: not converted'.format(path))
+            elif status != 'ok':
+                problems.append('{}: failed'.format(path))
+    for path, shard_ids in sorted(owners.items()):
+        if len(shard_ids) > 1:
+            problems.append('{}: in shards {}'.format(
+                path, ', '.join(shard_ids)
+            ))
+    if len(totals) == 1:
+        total = totals.pop()
+        if len(owners) != total:
+            problems.append('{} of {} inputs are in a shard'.format(
+                len(owners), total
+            ))
+    merged['shards'] = len(shards)
+    merged['inputs'] = len(owners)
+    merged['seconds'] = round(merged['seconds'], 3)
+    return dict(merged), problems
+
+
+def main(arglist=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='Merge the metrics of the shards of a batch and check '
+                    'that every input was converted exactly once',
+        prog='freki shards',
+        epilog='examples:\n'
+               '    text-to-freki --batch --shard 0/4 txt/ freki/\n'
+               '    freki shards freki/.shards'
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='count', dest='verbosity', default=2,
+        help='increase the verbosity (can be repeated: -vvv)'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        metavar='FILE',
+        help='write the merged metrics to FILE instead of stdout'
+    )
+    parser.add_argument(
+        'directory', help='the directory of the shard checkpoints'
+    )
+    args = parser.parse_args(arglist)
+    logging.basicConfig(level=50-(args.verbosity*10))
+
+    metrics, problems = merge_shards(args.directory)
+    for problem in problems:
+        logging.error(problem)
+    metrics['complete'] = not problems
+    if args.output is None:
+        json.dump(metrics, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(metrics, f, indent=2, sort_keys=True)
+    if problems:
+        sys.exit(1)
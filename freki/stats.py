@@ -0,0 +1,258 @@
+"""
+Corpus statistics over Freki files.
+
+`freki stats` counts documents, pages, blocks, lines, and IGT spans
+and the distributions of fonts, line tags, block labels, interlinear
+scores (iscores), block sizes, and span sizes over many Freki files.
+Files are streamed without building :class:`FrekiDoc` objects. Each
+job of a process pool counts a group of files into a
+:class:`CorpusStats`, and these partial results are merged into one
+summary, which is written as JSON.
+
+The summary also lists the files it counts, with their sizes and
+modification times, so it can be updated with new files later
+without counting the old ones again.
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+from collections import Counter
+
+from freki import batch
+from freki.fileio import open_input
+from freki.grep import _find_files
+from freki.serialize import read_preamble, _read_fonttable, _expand_fonts
+
+# version of the summary format
+SUMMARY_VERSION = 1
+# number of files counted by each job
+FILES_PER_JOB = 32
+
+
+class CorpusStats(object):
+    """
+    Mergeable counts over a set of Freki files.
+    """
+    totals = ('documents', 'pages', 'blocks', 'lines', 'spans')
+    distributions = (
+        'fonts',        # lines using each font
+        'tags',         # lines with each tag
+        'labels',       # blocks with each label
+        'iscores',      # lines by iscore, in bins of 0.1
+        'block_lines',  # blocks by their number of lines
+        'span_lines',   # IGT spans by their number of lines
+    )
+
+    def __init__(self):
+        for name in self.totals:
+            setattr(self, name, 0)
+        for name in self.distributions:
+            setattr(self, name, Counter())
+        self.files = {}  # path: [size, mtime]
+
+    def add_file(self, path):
+        """
+        Count the Freki file at *path*.
+        """
+        st = os.stat(path)
+        pages = set()
+        spans = Counter()
+        fonttable = None
+        with open_input(path) as f:
+            for line in f:
+                line = line.decode('utf-8')
+                if line.startswith('line'):
+                    preamble = line.partition(':')[0]
+                    attrs = read_preamble(preamble)
+                    self._add_line(attrs, fonttable)
+                    if attrs.get('span_id'):
+                        spans[attrs['span_id']] += 1
+                elif line.startswith('doc_id'):
+                    attrs = line.split()
+                    start, stop = int(attrs[-2]), int(attrs[-1])
+                    attrs = dict(a.split('=', 1) for a in attrs if '=' in a)
+                    pages.add(attrs.get('page'))
+                    self.blocks += 1
+                    self.labels[attrs.get('label', 'None')] += 1
+                    size = stop - start + 1 if stop else 0
+                    self.block_lines[str(size)] += 1
+                elif line.startswith('fonttable='):
+                    fonttable = _read_fonttable(line)
+        self.documents += 1
+        self.pages += len(pages)
+        self.spans += len(spans)
+        self.span_lines.update(str(n) for n in spans.values())
+        self.files[os.path.abspath(path)] = [st.st_size, st.st_mtime]
+
+    def _add_line(self, attrs, fonttable):
+        self.lines += 1
+        self.tags[attrs.get('tag', 'O')] += 1
+        fonts = attrs.get('fonts')
+        if fonts:
+            if fonttable is not None:
+                fonts = _expand_fonts(fonts, fonttable)
+            self.fonts.update(fonts.split(','))
+        iscore = attrs.get('iscore')
+        if iscore is not None:
+            # a score of 1.0 goes in the top bin
+            b = min(int(float(iscore) * 10), 9)
+            self.iscores['{:.1f}'.format(b / 10)] += 1
+
+    def merge(self, other):
+        """
+        Add the counts of the CorpusStats *other* to these counts.
+        """
+        for name in self.totals:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for name in self.distributions:
+            getattr(self, name).update(getattr(other, name))
+        self.files.update(other.files)
+        return self
+
+    def is_current(self, path):
+        """
+        Return `True` if the file at *path* is counted and has not
+        changed since.
+        """
+        entry = self.files.get(os.path.abspath(path))
+        if entry is None:
+            return False
+        st = os.stat(path)
+        return entry == [st.st_size, st.st_mtime]
+
+    def to_dict(self):
+        d = {'version': SUMMARY_VERSION, 'files': self.files}
+        for name in self.totals:
+            d[name] = getattr(self, name)
+        for name in self.distributions:
+            d[name] = dict(getattr(self, name))
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        if d.get('version') != SUMMARY_VERSION:
+            raise ValueError(
+                'unsupported summary version: {}'.format(d.get('version'))
+            )
+        stats = cls()
+        for name in cls.totals:
+            setattr(stats, name, d[name])
+        for name in cls.distributions:
+            setattr(stats, name, Counter(d[name]))
+        stats.files = d['files']
+        return stats
+
+    def dump(self, f):
+        json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, f):
+        return cls.from_dict(json.load(f))
+
+
+def corpus_stats(paths, stats=None, processes=None):
+    """
+    Count the Freki files at *paths* over a pool of *processes* and
+    return their merged CorpusStats.
+
+    If *stats* is given, the counts are added to it, and files it
+    already counts are skipped. Files that cannot be read are logged
+    and not counted.
+    """
+    if stats is None:
+        stats = CorpusStats()
+    new, seen = [], set()
+    for path in paths:
+        abspath = os.path.abspath(path)
+        if abspath in seen:
+            continue
+        seen.add(abspath)
+        if abspath not in stats.files:
+            new.append(path)
+        elif not stats.is_current(path):
+            logging.warning(
+                '{} changed since it was counted; recount the corpus '
+                'without --update to count it again'.format(path)
+            )
+    jobs = [
+        (new[i], new[i:i+FILES_PER_JOB])
+        for i in range(0, len(new), FILES_PER_JOB)
+    ]
+    results = batch.run_jobs(_count_job, jobs, processes=processes)
+    for result in results:
+        if result['status'] == 'ok':
+            stats.merge(result['info']['stats'])
+    return stats
+
+
+def _count_job(job):
+    stats = CorpusStats()
+    for path in job[1]:
+        # count each file separately so a bad file adds no counts
+        file_stats = CorpusStats()
+        try:
+            file_stats.add_file(path)
+        except Exception as ex:
+            logging.error('{}: {}: {}'.format(path, type(ex).__name__, ex))
+        else:
+            stats.merge(file_stats)
+    return {'stats': stats}
+
+
+def main(arglist=None):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='Compute corpus statistics over Freki files',
+        prog='freki stats',
+        epilog='examples:\n'
+               '    freki stats -o stats.json corpus/\n'
+               '    freki stats -o stats.json --update corpus/ new-batch/'
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        action='count', dest='verbosity', default=2,
+        help='increase the verbosity (can be repeated: -vvv)'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        metavar='FILE',
+        help='write the JSON summary to FILE instead of stdout'
+    )
+    parser.add_argument(
+        '--update',
+        action='store_true',
+        help='add files not yet counted to the summary in --output'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar='N', type=int,
+        help='number of worker processes (default: one per CPU)'
+    )
+    parser.add_argument(
+        'paths', nargs='+',
+        help='Freki files, or directories searched for *.freki[.gz] files'
+    )
+    args = parser.parse_args(arglist)
+    logging.basicConfig(level=50-(args.verbosity*10))
+
+    stats = None
+    if args.update:
+        if args.output is None:
+            parser.error('--update requires --output')
+        if os.path.exists(args.output):
+            with open(args.output, encoding='utf-8') as f:
+                stats = CorpusStats.load(f)
+    paths = list(_find_files(args.paths))
+    stats = corpus_stats(paths, stats=stats, processes=args.jobs)
+    logging.info('{} documents, {} lines'.format(stats.documents, stats.lines))
+    if args.output is None:
+        stats.dump(sys.stdout)
+        print()
+    else:
+        tmp = args.output + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            stats.dump(f)
+        os.replace(tmp, args.output)
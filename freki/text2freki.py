@@ -1,15 +1,128 @@
 from freki.serialize import FrekiDoc, FrekiBlock, FrekiLine
-import codecs
+from freki import batch
+from freki.fileio import open_input, strip_compression_ext
+from freki.profiling import Profiler, NULL_PROFILE, aggregate
+from freki.shards import parse_shard, select_shard, ShardLog
+import io
+import os
 import re
-import chardet
+import sys
+from chardet.universaldetector import UniversalDetector
 import logging
 import argparse
 
+# maximum number of bytes examined when detecting an encoding
+DETECT_BUDGET = 1 << 20
+
 
 def run(args):
-    frek = read_and_convert(args.infile, args.igtfile, args.encoding, args.detect)
-    out = open(args.outfile, 'w', encoding='utf8')
-    out.write(str(frek))
+    with open(args.outfile, 'w', encoding='utf8') as out:
+        stream_and_convert(
+            args.infile, out, args.igtfile, args.encoding, args.detect,
+            args.detect_budget or None
+        )
+
+
+def run_batch(args):
+    """
+    Convert the text files in the directory *args.infile* (or those
+    listed in *args.manifest*) to Freki files in *args.outfile* over a
+    pool of *args.jobs* processes.
+
+    Text files are paired with the file of the same relative path in
+    the *args.igtfile* directory, if there is one, or with the IGT file
+    in the second field of the manifest. If *args.profile* is given,
+    one in *args.profile_every* documents is profiled there. With
+    *args.shard*, only that shard of the inputs is converted, skipping
+    those already converted according to its checkpoint in
+    *args.shard_dir* (see :mod:`freki.shards`). Return the number of
+    failed documents.
+    """
+    if args.manifest:
+        rows = batch.read_manifest(args.manifest)
+    else:
+        rows = [[path] for path in batch.find_inputs(args.infile)]
+
+    shard_log = None
+    if args.shard is not None:
+        index, count = args.shard
+        total = len(rows)
+        shard_dir = args.shard_dir or os.path.join(args.outfile, '.shards')
+        rows = select_shard(rows, args.infile, index, count, shard_dir)
+        shard_log = ShardLog(
+            shard_dir, index, count, [row[0] for row in rows], total
+        )
+        pending = set(shard_log.pending())
+        logging.info('Shard {}/{}: {} of {} inputs, {} to convert'.format(
+            index, count, len(rows), total, len(pending)
+        ))
+        rows = [row for row in rows if row[0] in pending]
+
+    jobs = []
+    relpaths = {}
+    for row in rows:
+        relpath = row[0]
+        relpaths[os.path.join(args.infile, relpath)] = relpath
+        profile = None
+        if args.profile is not None:
+            # profiles are named after the relative path
+            name = os.path.splitext(strip_compression_ext(relpath))[0]
+            profile = (args.profile, args.profile_every, name)
+        igt_path = row[1] if len(row) > 1 and row[1] else None
+        if igt_path is None and args.igtfile:
+            igt_path = os.path.join(args.igtfile, relpath)
+            if not os.path.isfile(igt_path):
+                igt_path = None
+        jobs.append((
+            os.path.join(args.infile, relpath),
+            batch.output_path(args.outfile, relpath, '.freki'),
+            igt_path,
+            args.encoding,
+            args.detect,
+            args.detect_budget or None,
+            profile
+        ))
+
+    results = []
+    try:
+        for result in batch.run_jobs(_convert_job, jobs,
+                                     processes=args.jobs):
+            logging.debug(
+                '{path}: {status} ({seconds:.2f}s)'.format(**result)
+            )
+            results.append(result)
+            if shard_log is not None:
+                shard_log.add(relpaths[result['path']], result)
+    finally:
+        if shard_log is not None:
+            shard_log.close()
+    if args.profile is not None and args.profile_aggregate:
+        aggregate(args.profile)
+    return batch.report(results, args.timings)
+
+
+def _convert_job(job):
+    path, outpath, igt_path, encoding, detect, detect_budget, profile = job
+    dirs = os.path.dirname(outpath)
+    if dirs:
+        os.makedirs(dirs, exist_ok=True)
+    if profile is None:
+        profile = NULL_PROFILE
+    else:
+        directory, every, name = profile
+        profile = Profiler(directory, every=every).document(name)
+    # opened outside the try, so an error creating the file is not
+    # hidden by the failure to remove it
+    out = open(outpath, 'w', encoding='utf8')
+    try:
+        with out, profile.stage('convert'):
+            used = stream_and_convert(
+                path, out, igt_path, encoding, detect, detect_budget
+            )
+    except Exception:
+        os.remove(outpath)  # don't leave partial output behind
+        raise
+    return {'bytes': os.path.getsize(path), 'encoding': used}
 
 
 def convert_text(doc_id, text, span_text=None):
@@ -20,99 +133,355 @@ def convert_text(doc_id, text, span_text=None):
     :param span_text: text identifying IGT spans, if available
     :return: freki object
     """
-    w_index = 1
-    wo_index = 1
-    pre2post = {}
-    for line in re.split('\r\n|\n', text):
-        if not re.match('^\s*$', line):
-            pre2post[w_index] = wo_index
-            wo_index += 1
-        w_index += 1
-    line_dict = {}
-    s_index = 0
-    if span_text:
-        for line in span_text.split('\n'):
-            if len(line):
-                parts = line.split()
-                tags = parts[2:]
-                start = int(parts[0])
-                for i in range(start, int(parts[1]) + 1):
-                    try:
-                        num = pre2post[i]
-                    except KeyError:
-                        print("Warning: a line specified in the igt file is a blank line in the document. "
-                         "Check the line numbers in the igt file. Skipping the problem line.")
-                        break
-                    line_dict[num] = (tags[num - start], 's' + str(s_index))
-            s_index += 1
     frek = FrekiDoc()
-    text = re.sub(r'(\r\n|\n){2,}', '\n\n', text)
-    blocks = re.split('\n\n', text)
+    for _ in convert_lines(doc_id, [text], span_text, doc=frek):
+        pass  # blocks are added to frek
+    return frek
+
+
+def convert_lines(doc_id, chunks, span_text=None, doc=None):
+    """
+    Convert text to Freki blocks incrementally.
+
+    The result is the same as that of :func:`convert_text` on the
+    concatenated *chunks*, but blocks are yielded as soon as they are
+    complete, so only the current paragraph (and any lines waiting on
+    an unfinished IGT span) is held in memory. IGT spans are merged as
+    the text goes by, so spans in *span_text* are expected to be in
+    order.
+
+    :param doc_id: name of document
+    :param chunks: iterable of strings, e.g. pieces of a file
+    :param span_text: text identifying IGT spans, if available
+    :param doc: :class:`FrekiDoc` the blocks are added to; if `None`,
+        each block gets its own document
+    :return: iterator of :class:`FrekiBlock`
+    """
+    merger = _SpanMerger(_read_spans(span_text) if span_text else [])
     index = 1
     b_index = 1
-    for para in blocks:
-        lines = re.split('\r\n|\n', para)
-        linenos = []
-        for line in lines:
-            f_line = FrekiLine(line)
-            f_line.attrs['line'] = index
-            linenos.append(index)
-            if index in line_dict:
-                f_line.attrs['tag'] = line_dict[index][0]
-                f_line.attrs['span_id'] = line_dict[index][1]
-            frek.add_line(f_line)
-            index += 1
-        block = FrekiBlock(linenos, linenos[0], linenos[-1], frek)
-        block._attrs['page'] = '1'
-        block._attrs['block_id'] = 'b' + str(b_index)
-        block._attrs['doc_id'] = doc_id
+    para = []
+    pending = []  # closed paragraphs waiting for IGT span info
+    for line, is_last in _lookahead(_split_lines(chunks)):
+        merger.see(line)
+        # runs of 2+ line breaks separate paragraphs
+        if not line and merger.lineno > 1 and not is_last:
+            if para:
+                pending.append(para)
+                para = []
+            continue
+        para.append((index, line))
+        index += 1
+        while pending and pending[0][-1][0] < merger.min_lineno():
+            yield _make_block(doc_id, b_index, pending.pop(0), merger, doc)
+            b_index += 1
+    merger.finish()
+    if para:
+        pending.append(para)
+    for para in pending:
+        yield _make_block(doc_id, b_index, para, merger, doc)
         b_index += 1
-        frek.add_block(block)
-    return frek
 
 
-def read_and_convert(path, igt_path=None, encoding='utf-8', detect_encoding=False):
+def _make_block(doc_id, b_index, para, merger, doc):
+    frek = FrekiDoc() if doc is None else doc
+    linenos = []
+    for index, line in para:
+        f_line = FrekiLine(line)
+        f_line.attrs['line'] = index
+        linenos.append(index)
+        span = merger.pop(index)
+        if span is not None:
+            f_line.attrs['tag'] = span[0]
+            f_line.attrs['span_id'] = span[1]
+        frek.add_line(f_line)
+    block = FrekiBlock(linenos, linenos[0], linenos[-1], frek)
+    block._attrs['page'] = '1'
+    block._attrs['block_id'] = 'b' + str(b_index)
+    block._attrs['doc_id'] = doc_id
+    frek.add_block(block)
+    return block
+
+
+def _split_lines(chunks):
+    """
+    Yield the lines in *chunks* without their CRLF or LF line endings.
+    """
+    rest = ''
+    for chunk in chunks:
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line[:-1] if line.endswith('\r') else line
+    yield rest
+
+
+def _lookahead(iterable):
+    """
+    Yield pairs of items in *iterable* and whether they are the last.
+    """
+    it = iter(iterable)
+    prev = next(it)
+    for item in it:
+        yield prev, False
+        prev = item
+    yield prev, True
+
+
+def _read_spans(span_text):
+    """
+    Return `(start, end, tags, span_id)` for the IGT spans in
+    *span_text*.
+    """
+    spans = []
+    s_index = 0
+    for line in span_text.split('\n'):
+        if len(line):
+            parts = line.split()
+            spans.append(
+                (int(parts[0]), int(parts[1]), parts[2:], 's' + str(s_index))
+            )
+        s_index += 1
+    return spans
+
+
+class _SpanMerger(object):
+    """
+    Assign IGT span tags to output lines as the input lines go by.
+
+    Spans give line numbers of the input text, where only non-blank
+    lines count toward the tagged (output) line numbers. A span is
+    applied once all its input lines have been seen, and an output line
+    can be written once no unapplied span can tag it.
+    """
+    def __init__(self, spans):
+        self.spans = spans
+        self.next_span = 0
+        self.lineno = 0  # current input line number
+        self.nonblank = 0  # non-blank input lines seen so far
+        self.seen = {}  # input line number : (non-blanks before, blank?)
+        self.tags = {}  # output line number : (tag, span_id)
+        # smallest start line of each span and those after it
+        self.min_starts = []
+        min_start = float('inf')
+        for start, _, _, _ in reversed(spans):
+            min_start = min(min_start, start)
+            self.min_starts.append(min_start)
+        self.min_starts.reverse()
+
+    def see(self, line):
+        self.lineno += 1
+        blank = re.match('^\s*$', line) is not None
+        if self.next_span < len(self.spans):
+            self.seen[self.lineno] = (self.nonblank, blank)
+        if not blank:
+            self.nonblank += 1
+        self._apply()
+
+    def finish(self):
+        self._apply(final=True)
+
+    def min_lineno(self):
+        """
+        Return the smallest output line number an unapplied span may tag.
+        """
+        if self.next_span >= len(self.spans):
+            return float('inf')
+        start = self.min_starts[self.next_span]
+        if start in self.seen:
+            return self.seen[start][0] + 1
+        elif start > self.lineno:
+            return self.nonblank + 1
+        return 1
+
+    def pop(self, lineno):
+        return self.tags.pop(lineno, None)
+
+    def _apply(self, final=False):
+        while self.next_span < len(self.spans):
+            start, end, tags, span_id = self.spans[self.next_span]
+            # apply lines until the end or the first blank line
+            stop = None
+            for i in range(start, end + 1):
+                if i > self.lineno and not final:
+                    return  # wait for more input
+                if i not in self.seen or self.seen[i][1]:
+                    stop = i
+                    break
+            for i in range(start, end + 1 if stop is None else stop):
+                num = self.seen[i][0] + 1
+                self.tags[num] = (tags[num - start], span_id)
+            if stop is not None:
+                print("Warning: a line specified in the igt file is a blank line in the document. "
+                      "Check the line numbers in the igt file. Skipping the problem line.")
+            self.next_span += 1
+            # forget input lines no remaining span refers to
+            if self.next_span < len(self.spans):
+                min_start = self.min_starts[self.next_span]
+                for i in [i for i in self.seen if i < min_start]:
+                    del self.seen[i]
+            else:
+                self.seen.clear()
+
+
+def stream_and_convert(path, out, igt_path=None, encoding='utf-8', detect_encoding=False,
+                       detect_budget=DETECT_BUDGET):
+    """
+    Convert a text file to freki, writing blocks to *out* as they are
+    converted. The arguments are as for :func:`read_and_convert`. If
+    the file cannot be decoded with *encoding*, *out* is rewound and
+    the conversion starts over with a detected encoding.
+    :param out: open, writable text file
+    :return: the encoding of the text file
+    """
+    pos = out.tell()
+
+    def write(name, f, igt_text):
+        out.seek(pos)
+        out.truncate()
+        blocks = convert_lines(name, iter(lambda: f.read(65536), ''), igt_text)
+        for i, block in enumerate(blocks):
+            if i:
+                out.write('\n\n')
+            out.write(str(block))
+        return f.encoding
+
+    return _convert_file(path, igt_path, encoding, detect_encoding, write, detect_budget)
+
+
+def read_and_convert(path, igt_path=None, encoding='utf-8', detect_encoding=False,
+                     detect_budget=DETECT_BUDGET):
     """
     Read in a text file and convert it to freki. igt_path file format: startline endline tag1 tag2 ... tagN\n
     :param path: path to the text file
     :param igt_path: path to the text file containing IGT span info
     :param encoding: name of the encoding of the file
     :param detect_encoding: setting to true will first detect an encoding rather than using the default.
+    :param detect_budget: maximum number of bytes examined when detecting an encoding (`None` for no limit)
     :return: freki object
     """
+    def convert(name, f, igt_text):
+        return convert_text(name, f.read(), igt_text)
+
+    return _convert_file(path, igt_path, encoding, detect_encoding, convert, detect_budget)
+
+
+def detect_file_encoding(f, budget=DETECT_BUDGET):
+    """
+    Detect the encoding of binary file *f* with Chardet.
+
+    The file is fed to the detector incrementally until the detector is
+    confident, the file ends, or *budget* bytes have been read (`None`
+    for no limit). *f* is read from the beginning and rewound
+    afterwards.
+
+    :return: `(encoding, complete)`, where *encoding* is `None` if it
+        could not be detected and *complete* is `True` if the whole
+        file was examined
+    """
+    f.seek(0)
+    detector = UniversalDetector()
+    size = 0
+    complete = False
+    while not detector.done:
+        chunk_size = 65536
+        if budget:
+            if size >= budget:
+                break
+            chunk_size = min(chunk_size, budget - size)
+        chunk = f.read(chunk_size)
+        if not chunk:
+            complete = True
+            break
+        detector.feed(chunk)
+        size += len(chunk)
+    detector.close()
+    f.seek(0)
+    return detector.result['encoding'], complete
+
+
+def _convert_file(path, igt_path, encoding, detect_encoding, convert, detect_budget=DETECT_BUDGET):
+    """
+    Decode the text and IGT files with *encoding* (or a detected one)
+    and return `convert(name, textfile, igt_text)`. Each file is opened
+    once; detection and decoding rewind the same stream.
+    """
     name = path.split('/')[-1].split('.')[0]
-    igt_text = None
-    if detect_encoding:
-        bytes = open(path, 'rb').read()
-        p_predict = chardet.detect(bytes)
-        text = codecs.open(path, encoding=p_predict['encoding'], errors='strict').read()
-        if igt_path:
-            i_predict = chardet.detect(open(igt_path, 'rb').read())
-            igt_text = codecs.open(igt_path, encoding=i_predict['encoding']).read()
-        logging.info('Using encoding: ' + p_predict['encoding'])
-        logging.info('Encoding detection uses the Chardet library: https://pypi.python.org/pypi/chardet')
-    else:
+    igt_bytes = igt_key = None
+    if igt_path:
+        with open_input(igt_path) as f:
+            igt_key = _file_key(igt_path, f)
+            igt_bytes = f.read()
+
+    with open_input(path) as raw:
+        key = _file_key(path, raw)
+        if detect_encoding:
+            return _convert_detected(name, raw, key, igt_bytes, igt_key, convert, detect_budget)
         try:
-            text = codecs.open(path, encoding=encoding, errors='strict').read()
-            if igt_path:
-                igt_text = codecs.open(igt_path, encoding=encoding).read()
+            return _convert_with(name, raw, encoding, igt_bytes, encoding, convert)
         except UnicodeDecodeError:
-            bytes = open(path, 'rb').read()
-            p_predict = chardet.detect(bytes)
-            text = codecs.open(path, encoding=p_predict['encoding'], errors='strict').read()
-            if igt_path:
-                i_predict = chardet.detect(open(igt_path, 'rb').read())
-                igt_text = codecs.open(igt_path, encoding=i_predict['encoding']).read()
-            logging.info('The file cannot be read using encoding ' + encoding + '. Instead using ' + p_predict['encoding'])
-            logging.info('Encoding detection uses the Chardet library: https://pypi.python.org/pypi/chardet\n')
-            logging.info("If encoding " + p_predict['encoding'] + ' is not correct please specify the encoding as an argument')
+            logging.info('The file cannot be read using encoding ' + encoding + '. Detecting the encoding instead.')
             logging.info('For a detailed list of encodings available in Python visit https://docs.python.org/2.4/lib/standard-encodings.html')
+            return _convert_detected(name, raw, key, igt_bytes, igt_key, convert, detect_budget)
         except LookupError:
             print('Unknown encoding. If you want the system to automatically detect an encoding set detect_encoding=True')
             print('For a detailed list of encodings available in Python visit https://docs.python.org/2.4/lib/standard-encodings.html')
             raise
-    frek = convert_text(name, text, igt_text)
-    return frek
+
+
+def _convert_detected(name, raw, key, igt_bytes, igt_key, convert, detect_budget):
+    """
+    Convert with detected encodings. Detection results are cached by
+    the file keys *key* and *igt_key*.
+    """
+    p_encoding, complete = _detect_cached(key, raw, detect_budget)
+    i_encoding = None
+    if igt_bytes is not None:
+        i_encoding, _ = _detect_cached(
+            igt_key, io.BytesIO(igt_bytes), detect_budget
+        )
+    logging.info('Using encoding: {}'.format(p_encoding))
+    logging.info('Encoding detection uses the Chardet library: https://pypi.python.org/pypi/chardet')
+    logging.info('If encoding {} is not correct please specify the encoding as an argument'.format(p_encoding))
+    try:
+        return _convert_with(name, raw, p_encoding, igt_bytes, i_encoding, convert)
+    except UnicodeDecodeError:
+        if complete:
+            raise
+        # the sample was misleading; look at the whole file
+        logging.info('The file cannot be read using encoding {}. Detecting the encoding from the whole file.'.format(p_encoding))
+        p_encoding, complete = detect_file_encoding(raw, None)
+        _detected[key] = (p_encoding, complete)
+        logging.info('Using encoding: {}'.format(p_encoding))
+        return _convert_with(name, raw, p_encoding, igt_bytes, i_encoding, convert)
+
+
+# detected encodings, by file key (see _file_key())
+_detected = {}
+
+
+def _file_key(path, f):
+    st = os.fstat(f.fileno())
+    return (os.path.abspath(path), st.st_size, st.st_mtime)
+
+
+def _detect_cached(key, f, budget):
+    if key not in _detected:
+        _detected[key] = detect_file_encoding(f, budget)
+    return _detected[key]
+
+
+def _convert_with(name, raw, encoding, igt_bytes, igt_encoding, convert):
+    igt_text = None
+    if igt_bytes is not None:
+        igt_text = igt_bytes.decode(igt_encoding or 'utf-8')
+    raw.seek(0)
+    # newline='' keeps line endings as they are
+    f = io.TextIOWrapper(raw, encoding=encoding or 'utf-8', errors='strict', newline='')
+    try:
+        return convert(name, f, igt_text)
+    finally:
+        f.detach()  # leave *raw* open so it can be rewound
 
 
 def main(arglist=None):
@@ -121,23 +490,85 @@ def main(arglist=None):
         description="Convert a plain text file to Freki format",
         prog='text-to-freki',
         epilog='examples:\n'
-               '    text-to-freki in.txt out.freki --igtfile=igts.txt --detect-encoding=true'
+               '    text-to-freki in.txt out.freki --igtfile=igts.txt --detect-encoding=true\n'
+               '    text-to-freki --batch txt/ freki/ --igtfile=igts/ -j 8 --timings=times.tsv'
+    )
+    parser.add_argument('infile', help='plain text file, optionally compressed (or directory with --batch)')
+    parser.add_argument('outfile', help='path to freki output file (or directory with --batch)')
+    parser.add_argument(
+        '--igtfile',
+        help='plain text file containing igt span info (or directory '
+             'of files named like the text files with --batch)'
     )
-    parser.add_argument('infile', help='plain text file')
-    parser.add_argument('outfile', help='path to freki output file')
-    parser.add_argument('--igtfile', help='plain text file containing igt span info')
     parser.add_argument('--encoding', default='utf-8', help='encoding of the input file')
     parser.add_argument(
         '-d', '--detect-encoding', dest='detect', default=False, help='automatically detects encoding when set to true'
     )
+    parser.add_argument(
+        '--detect-budget', type=int, default=DETECT_BUDGET, metavar='BYTES',
+        help='maximum number of bytes examined when detecting an encoding '
+             '(0 for the whole file; default: %(default)s)'
+    )
     parser.add_argument(
         '-v', '--verbose',
         action='count', dest='verbosity', default=2,
         help='increase the verbosity (can be repeated: -vvv)'
     )
+    parser.add_argument(
+        '--batch', action='store_true',
+        help='convert all files in the infile directory'
+    )
+    parser.add_argument(
+        '--manifest', metavar='FILE',
+        help='with --batch, convert the files listed in FILE (one per '
+             'line, relative to infile, optionally followed by a tab '
+             'and an igt file path) instead of all files'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, metavar='N',
+        help='with --batch, number of worker processes '
+             '(default: one per CPU)'
+    )
+    parser.add_argument(
+        '--timings', metavar='FILE',
+        help='with --batch, write per-document timings to FILE'
+    )
+    parser.add_argument(
+        '--profile', metavar='DIR',
+        help='with --batch, write profiles of the conversion of each '
+             'document to DIR'
+    )
+    parser.add_argument(
+        '--profile-every', metavar='N', type=int, default=1,
+        help='with --profile, only profile one in N documents, chosen by '
+             'their paths (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--profile-aggregate', action='store_true',
+        help='with --profile, combine the profiles in DIR after the batch'
+    )
+    parser.add_argument(
+        '--shard', metavar='I/N',
+        help='with --batch, only convert shard I (from 0) of N shards of '
+             'the inputs, of about the same total size'
+    )
+    parser.add_argument(
+        '--shard-dir', metavar='DIR',
+        help='with --shard, keep the checkpoint and metrics of the shard '
+             'in DIR (default: .shards in outfile)'
+    )
     args = parser.parse_args(arglist)
     logging.basicConfig(level=50-(args.verbosity*10))
-    run(args)
+    if args.shard is not None:
+        try:
+            args.shard = parse_shard(args.shard)
+        except ValueError as ex:
+            parser.error(str(ex))
+    if args.batch:
+        if run_batch(args):
+            sys.exit(1)
+    else:
+        run(args)
 
 
 if __name__ == '__main__':
@@ -2,8 +2,10 @@
 # Serialization Testcases
 # =============================================================================
 import os
+import shutil
+import tempfile
 from collections import namedtuple
-from io import StringIO
+from io import BytesIO, StringIO
 from unittest import TestCase
 from freki.serialize import *
 import run_freki
@@ -36,6 +38,1011 @@ class ReadTest(TestCase):
         str(fd)
 
 
+class IndexTest(TestCase):
+    def setUp(self):
+        self.fd = FrekiDoc.read(
+            os.path.join(os.path.dirname(__file__), '16.txt')
+        )
+
+    def test_pages(self):
+        fd = self.fd
+        self.assertEqual(fd.pages, set(b.page for b in fd.blocks))
+        self.assertEqual(
+            fd.blocks_by_page(2),
+            [b for b in fd.blocks if b.page == 2]
+        )
+
+    def test_tag_updates(self):
+        fd = self.fd
+        line = fd.get_line(3)
+        self.assertIn(line, fd.lines_by_tag('O'))
+        line.tag = 'B-L'
+        self.assertNotIn(line, fd.lines_by_tag('O'))
+        self.assertEqual(fd.lines_by_tag('B-L'), [line])
+        self.assertEqual(
+            [l.lineno for l in fd.lines_by_tag('O')],
+            [l.lineno for l in fd.lines() if l.tag == 'O']
+        )
+
+    def test_span_updates(self):
+        fd = self.fd
+        fd.get_line(4).span_id = 'x1'
+        fd.get_line(3).span_id = 'x1'
+        self.assertEqual([l.lineno for l in fd.lines_by_span('x1')], [3, 4])
+        self.assertEqual(fd.spans()['x1'], (3, 4))
+        fd.get_line(4).span_id = None
+        self.assertEqual(fd.spans()['x1'], (3, 3))
+
+    def test_fonts(self):
+        fd = self.fd
+        font = FrekiFont('F0', 10.91)
+        self.assertEqual(
+            fd.lines_by_font(font),
+            [l for l in fd.lines() if font in l.fonts]
+        )
+        self.assertEqual(fd.lines_by_font('F0-10.91'), fd.lines_by_font(font))
+
+
+class CompactTest(TestCase):
+    def setUp(self):
+        self.fd_path = os.path.join(os.path.dirname(__file__), '16.txt')
+
+    def test_roundtrip(self):
+        fd = FrekiDoc.read(self.fd_path)
+        compact = fd.dumps(compact=True)
+        self.assertTrue(compact.startswith('fonttable=F0-10.91,'))
+        self.assertLess(len(compact), len(str(fd)))
+
+        f = tempfile.NamedTemporaryFile(suffix='.txt', delete=False)
+        try:
+            f.write(compact.encode('utf-8'))
+            f.close()
+            fd2 = FrekiDoc.read(f.name)
+        finally:
+            os.remove(f.name)
+        self.assertEqual(list(fd2.lines()), list(fd.lines()))
+        self.assertEqual(
+            [l.attrs.get('fonts') for l in fd2.lines()],
+            [l.attrs.get('fonts') for l in fd.lines()]
+        )
+
+    def test_format_bbox(self):
+        from freki.serialize import _format_bbox
+        self.assertEqual(
+            _format_bbox('72.0,302.62000000000001,-0.001,x', 2),
+            '72,302.62,0,x'
+        )
+
+
+class UpdateTest(TestCase):
+    def setUp(self):
+        self.fd_path = os.path.join(os.path.dirname(__file__), '16.txt')
+        self.tmpdir = tempfile.mkdtemp()
+        self.updates = {3: ('B-L', 's1'), 4: ('I-G', 's1'), 37: ('O', None)}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def rewritten(self):
+        fd = FrekiDoc.read(self.fd_path)
+        fd.update_lines(self.updates)
+        return str(fd)
+
+    def test_update_file(self):
+        outpath = os.path.join(self.tmpdir, 'out.txt')
+        update_file(self.fd_path, self.updates, outpath)
+        with open(outpath, encoding='utf-8') as f:
+            self.assertEqual(f.read(), self.rewritten())
+
+    def test_update_compact_file(self):
+        fd = FrekiDoc.read(self.fd_path)
+        inpath = os.path.join(self.tmpdir, 'compact.txt')
+        with open(inpath, 'w', encoding='utf-8') as f:
+            f.write(fd.dumps(compact=True))
+        outpath = os.path.join(self.tmpdir, 'out.txt')
+        update_file(inpath, {}, outpath)
+        with open(inpath, 'rb') as f, open(outpath, 'rb') as g:
+            self.assertEqual(g.read(), f.read())
+        update_file(inpath, self.updates, outpath)
+        fd = FrekiDoc.read(inpath)
+        fd.update_lines(self.updates)
+        with open(outpath, encoding='utf-8') as f:
+            self.assertEqual(f.read(), fd.dumps(compact=True))
+
+    def test_delta(self):
+        delta_path = os.path.join(self.tmpdir, 'out.delta')
+        write_delta(delta_path, self.updates)
+        self.assertEqual(read_delta(delta_path), self.updates)
+        fd = FrekiDoc.read(self.fd_path, delta=delta_path)
+        self.assertEqual(str(fd), self.rewritten())
+
+    def test_delta_without_tag(self):
+        fd = FrekiDoc.read(self.fd_path)
+        tagged = next(l for l in fd.lines() if l.tag != 'O')
+        o_lines = len(fd.lines_by_tag('O'))
+        delta_path = os.path.join(self.tmpdir, 'out.delta')
+        write_delta(delta_path, {tagged.lineno: (None, None)})
+        fd = FrekiDoc.read(self.fd_path, delta=delta_path)
+        line = fd.get_line(tagged.lineno)
+        self.assertEqual((line.tag, line.span_id), ('O', None))
+        self.assertIn(line, fd.lines_by_tag('O'))
+        self.assertEqual(len(fd.lines_by_tag('O')), o_lines + 1)
+
+
+class TextConversionTest(TestCase):
+    text = (
+        'Title\r\n\r\n\n1. ni-ka ba-ta\n   \n'
+        'I-ERG go-PST\n"I went."\n\n\nTail\n'
+    )
+    spans = '1 1 M\n4 4 L G T\n'
+
+    def test_convert_lines(self):
+        from freki.text2freki import convert_text, convert_lines
+        fd = convert_text('doc', self.text, self.spans)
+        chunks = [self.text[i:i+3] for i in range(0, len(self.text), 3)]
+        blocks = list(convert_lines('doc', chunks, self.spans))
+        self.assertEqual('\n\n'.join(str(b) for b in blocks), str(fd))
+        self.assertEqual(
+            [b.block_id for b in fd.blocks], ['b1', 'b2', 'b3']
+        )
+        self.assertEqual(fd.get_line(1).span_id, 's0')
+
+    def test_detect_budget(self):
+        from io import BytesIO
+        from freki.text2freki import detect_file_encoding
+        data = BytesIO(b'plain text\n' * 1000 + 'café\n'.encode('utf-8'))
+        data.seek(50)
+        encoding, complete = detect_file_encoding(data, 1024)
+        self.assertFalse(complete)
+        self.assertEqual(data.tell(), 0)
+        encoding, complete = detect_file_encoding(data, None)
+        self.assertTrue(complete)
+        self.assertEqual(encoding.lower(), 'utf-8')
+
+
+class BatchTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for relpath, data in [('a.txt', b'one\n\ntwo\n'),
+                              ('sub/b.txt', b'three\n'),
+                              ('sub/c.txt', b'\xff\xfe\x00')]:
+            path = os.path.join(self.tmpdir, 'in', relpath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_text_batch(self):
+        from freki import batch
+        from freki.text2freki import main
+        indir = os.path.join(self.tmpdir, 'in')
+        outdir = os.path.join(self.tmpdir, 'out')
+        timings = os.path.join(self.tmpdir, 'timings.tsv')
+        self.assertEqual(
+            batch.find_inputs(indir), ['a.txt', 'sub/b.txt', 'sub/c.txt']
+        )
+        with self.assertRaises(SystemExit):
+            main(['--batch', indir, outdir, '-j', '1',
+                  '--timings', timings])
+        self.assertEqual(
+            batch.find_inputs(outdir), ['a.freki', 'sub/b.freki']
+        )
+        with open(timings) as f:
+            rows = [line.split('\t') for line in f.read().splitlines()]
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(
+            sorted(row[1] for row in rows[1:]), ['error', 'ok', 'ok']
+        )
+
+
+class ReaderCacheTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tetml_path = os.path.join(
+            os.path.dirname(__file__), '1076941.tetml'
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cached_pages(self):
+        from freki.cache import ReaderCache, CachedReader
+        from freki.readers.tetml import TetmlReader
+        cache = ReaderCache(self.tmpdir)
+        reader = cache.reader(TetmlReader, 'tetml', self.tetml_path)
+        self.assertIsInstance(reader, TetmlReader)
+        cached = cache.reader(TetmlReader, 'tetml', self.tetml_path)
+        self.assertIsInstance(cached, CachedReader)
+
+        def dump(pages):
+            return [
+                (p.id, p.page_width, p.page_height, b.id, b.label,
+                 [[(t.text, t.font, t.features, t.llx, t.lly, t.urx, t.ury)
+                   for t in l.tokens] for l in b.lines])
+                for p in pages for b in p.blocks
+            ]
+        self.assertEqual(dump(cached.pages()), dump(reader.pages()))
+        self.assertEqual(dump(cached.pages(1)), dump(reader.pages(1)))
+
+    def test_eviction(self):
+        from freki.cache import ReaderCache
+        from freki.readers.tetml import TetmlReader
+        cache = ReaderCache(self.tmpdir, max_bytes=0)
+        cache.reader(TetmlReader, 'tetml', self.tetml_path)
+        key = cache.key(self.tetml_path, 'tetml', TetmlReader.version)
+        self.assertIsNone(cache.get(key))
+
+
+class PageMemoTest(TestCase):
+    def setUp(self):
+        self.tetml_path = os.path.join(
+            os.path.dirname(__file__), '1076941.tetml'
+        )
+
+    def test_memo_hit(self):
+        from freki.analyzers.memo import PageMemo
+        from freki.analyzers.xycut import XYCutAnalyzer
+        from freki.readers.tetml import TetmlReader
+
+        def dump(doc):
+            return [
+                (p.id, b.id, b.label, b.llx, b.lly, b.urx, b.ury,
+                 [[t.text for t in l.tokens] for l in b.lines])
+                for p in doc.pages for b in p.blocks
+            ]
+        memo = PageMemo(maxsize=4)
+        analyzer = XYCutAnalyzer(memo=memo)
+        expected = dump(XYCutAnalyzer().analyze(TetmlReader(self.tetml_path)))
+        for _ in range(2):
+            doc = analyzer.analyze(TetmlReader(self.tetml_path))
+            self.assertEqual(dump(doc), expected)
+        self.assertEqual(memo.stats()['hits'], 1)
+        self.assertEqual(memo.stats()['misses'], 1)
+        self.assertEqual(memo.hit_rate, 0.5)
+
+
+class SweepTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tetml_path = os.path.join(
+            os.path.dirname(__file__), '1076941.tetml'
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sweep(self):
+        from freki.main import main
+        from freki.analyzers import sweep
+        from freki.readers.tetml import TetmlReader
+        ref = os.path.join(self.tmpdir, '1076941.freki')
+        main([self.tetml_path, ref])
+        doc = sweep.load_document(
+            TetmlReader(self.tetml_path), reference=ref
+        )
+        configs = sweep.grid({'y_gap_scale': [1, 8], 'x_gap_scale': [1]})
+        self.assertEqual(len(configs), 2)
+        results = dict(
+            (r['path'], r) for r in sweep.sweep([doc], configs, processes=1)
+        )
+        default = results['{"x_gap_scale": 1, "y_gap_scale": 1}']['info']
+        self.assertEqual(default['f1'], 1.0)
+        self.assertEqual(default['lost_tokens'], 0)
+        coarse = results['{"x_gap_scale": 1, "y_gap_scale": 8}']['info']
+        self.assertLess(coarse['zones'], default['zones'])
+        with self.assertRaises(ValueError):
+            sweep.evaluate(doc, {'min_gap': 1})
+
+
+class PyramidTest(TestCase):
+    def test_same_zones(self):
+        from freki.analyzers.xycut import (
+            _make_bitmap, _parameters, _zones, _Pyramid
+        )
+        from freki.readers.tetml import TetmlReader
+        path = os.path.join(os.path.dirname(__file__), '1076941.tetml')
+        page = TetmlReader(path).pages()[0]
+        bitmap = _make_bitmap(page)
+        params = _parameters([(page, bitmap)])
+        pyramid = _Pyramid.for_params(bitmap, params)
+        pyramid.min_area = 0  # use the coarse level for every zone
+        self.assertGreater(pyramid.factor, 1)
+        self.assertEqual(
+            list(_zones(bitmap, params, pyramid=pyramid)),
+            list(_zones(bitmap, params))
+        )
+
+
+class LineSegmentationTest(TestCase):
+    def test_zone_lines(self):
+        import numpy as np
+        from freki.analyzers.xycut import _zone_lines
+        from freki.structures import Token
+        bitmap = np.zeros((20, 20))
+        bitmap[2:5, 1:5] = 1
+        bitmap[10:14, 1:5] = 1  # line bands are split at y=7.5
+        tokens = [
+            Token('a', (1, 2, 5, 5)),
+            Token('straddling', (1, 6, 5, 9)),
+            Token('tiny', (1, 6.6, 2, 8.4)),
+            Token('d', (1, 11, 5, 14)),
+            Token('outside', (15, 11, 30, 14)),
+        ]
+        self.assertEqual(
+            _zone_lines(tokens, bitmap, (0, 0, 20, 20)), [[0, 2], [2, 3]]
+        )
+        self.assertEqual(_zone_lines(tokens, bitmap, (10, 0, 12, 20)), [])
+
+
+class DeduplicatorTest(TestCase):
+    def test_overprint(self):
+        from freki.readers.dedupe import Deduplicator
+        d = Deduplicator(0.5)
+        self.assertFalse(d.is_duplicate('a', (10.0, 10.0, 15.0, 18.0)))
+        self.assertTrue(d.is_duplicate('a', (10.3, 10.0, 15.3, 18.0)))
+        # a third copy further away is collapsed through the second
+        self.assertTrue(d.is_duplicate('a', (10.6, 10.0, 15.6, 18.0)))
+        self.assertFalse(d.is_duplicate('b', (10.0, 10.0, 15.0, 18.0)))
+        self.assertFalse(d.is_duplicate('a', (16.0, 10.0, 21.0, 18.0)))
+        self.assertFalse(d.is_duplicate('a', (10.0, 10.0, 17.0, 18.0)))
+        self.assertEqual(d.count, 2)
+
+    def test_exact(self):
+        from freki.readers.dedupe import Deduplicator
+        d = Deduplicator(0)
+        self.assertFalse(d.is_duplicate('a', (1.5, 2.0, 3.0, 4.0)))
+        self.assertTrue(d.is_duplicate('a', (1.5, 2.0, 3.0, 4.0)))
+        self.assertFalse(d.is_duplicate('a', (1.6, 2.0, 3.0, 4.0)))
+
+
+class PageSelectionTest(TestCase):
+    def test_parse_page_ranges(self):
+        from freki.readers.base import parse_page_ranges
+        self.assertEqual(parse_page_ranges('3,1-2, 2-4'), [1, 2, 3, 4])
+        self.assertRaises(ValueError, parse_page_ranges, '4-2')
+        self.assertRaises(ValueError, parse_page_ranges, '0')
+
+    def test_stop_after_last_page(self):
+        from xml.etree.ElementTree import ParseError
+        from freki.readers.tetml import TetmlReader
+        path = os.path.join(os.path.dirname(__file__), '1076941.tetml')
+        with open(path) as f:
+            xml = f.read()
+        # a second page that is cut off is never parsed
+        end = xml.index('</Page>') + len('</Page>')
+        page2 = xml[xml.index('<Page '):end].replace(
+            'number="1"', 'number="2"', 1
+        )
+        truncated = xml[:end] + page2 + page2[:len(page2) // 2]
+        reader = TetmlReader(StringIO(truncated), page_ids=[1, 2])
+        self.assertEqual([p.id for p in reader.pages()], [1, 2])
+        self.assertEqual(
+            len(reader.pages(2)[0].tokens), len(reader.pages(1)[0].tokens)
+        )
+        reader = TetmlReader(StringIO(truncated), page_ids=[2])
+        self.assertEqual([p.id for p in reader.pages()], [2])
+        self.assertRaises(
+            ParseError, TetmlReader, StringIO(truncated), page_ids=[3]
+        )
+
+
+class ServeTest(TestCase):
+    def setUp(self):
+        self.tetml_path = os.path.join(
+            os.path.dirname(__file__), '1076941.tetml'
+        )
+
+    def test_handle(self):
+        from freki.serve import handle
+        with open(self.tetml_path) as f:
+            xml = f.read()
+        inline = handle({'id': 'a', 'xml': xml, 'doc_id': '1076941'})
+        self.assertEqual(inline['status'], 'ok')
+        self.assertEqual(
+            set(inline['seconds']), {'read', 'analyze', 'write', 'total'}
+        )
+        path = handle({'id': 'b', 'infile': self.tetml_path})
+        self.assertEqual(path['freki'], inline['freki'])
+        error = handle({'id': 'c'})
+        self.assertEqual(error['status'], 'error')
+        self.assertEqual(error['id'], 'c')
+
+    def test_serve_stream(self):
+        import json
+        from io import BytesIO
+        from freki.serve import Server
+        jobs = [{'id': i, 'infile': self.tetml_path, 'pages': '1'}
+                for i in range(3)]
+        infile = BytesIO(
+            ''.join(json.dumps(job) + '\n' for job in jobs).encode('utf-8')
+            + b'not json\n'
+        )
+        outfile = BytesIO()
+        server = Server(processes=2, max_pending=1)
+        try:
+            server.serve_stream(infile, outfile)
+        finally:
+            server.close()
+        responses = [json.loads(line) for line in
+                     outfile.getvalue().decode('utf-8').splitlines()]
+        self.assertEqual(
+            sorted((r['id'], r['status']) for r in responses
+                   if r['id'] is not None),
+            [(0, 'ok'), (1, 'ok'), (2, 'ok')]
+        )
+        self.assertEqual(len(responses), 4)
+        self.assertTrue(all('wall' in r['seconds'] for r in responses
+                            if r['status'] == 'ok'))
+
+    def test_closed_client(self):
+        import json
+        from io import BytesIO
+        from freki.serve import Server
+
+        class ClosedFile(object):
+            def write(self, data):
+                raise BrokenPipeError(32, 'Broken pipe')
+
+            def flush(self):
+                pass
+
+        def jobs(n):
+            return BytesIO(''.join(
+                json.dumps({'id': i, 'infile': self.tetml_path,
+                            'pages': '1'}) + '\n'
+                for i in range(n)
+            ).encode('utf-8'))
+
+        server = Server(processes=1, max_pending=1)
+        try:
+            server.serve_stream(jobs(3), ClosedFile())
+            # the pool and its slots survive the closed client
+            outfile = BytesIO()
+            server.serve_stream(jobs(2), outfile)
+        finally:
+            server.close()
+        self.assertEqual(len(outfile.getvalue().splitlines()), 2)
+
+    def test_slow_client(self):
+        import json
+        import time
+        from io import BytesIO
+        from freki.serve import Server
+        written = []
+        lagging = []
+
+        class SlowFile(BytesIO):
+            def write(self, data):
+                time.sleep(0.2)
+                written.append(data)
+                return BytesIO.write(self, data)
+
+        def jobs(n):
+            for i in range(n):
+                # the jobs before this one have been submitted, so all
+                # but max_pending of them have had their responses
+                # written
+                if len(written) < i - 1:
+                    lagging.append(i)
+                yield (json.dumps({'id': i, 'infile': self.tetml_path,
+                                   'pages': '1'}) + '\n').encode('utf-8')
+
+        server = Server(processes=2, max_pending=1)
+        try:
+            server.serve_stream(jobs(5), SlowFile())
+        finally:
+            server.close()
+        self.assertEqual(lagging, [])
+        self.assertEqual(len(written), 5)
+
+    def test_stale_socket(self):
+        import socket
+        from freki.serve import _remove_stale_socket
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'freki.sock')
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(path)
+            sock.listen(1)
+            _remove_stale_socket(path)  # still listening
+            self.assertTrue(os.path.exists(path))
+            sock.close()
+            _remove_stale_socket(path)
+            self.assertFalse(os.path.exists(path))
+            other = os.path.join(tmpdir, 'other')
+            open(other, 'w').close()
+            _remove_stale_socket(other)  # not a socket
+            self.assertTrue(os.path.exists(other))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class ConvertTest(TestCase):
+    def setUp(self):
+        self.tetml_path = os.path.join(
+            os.path.dirname(__file__), '1076941.tetml'
+        )
+
+    def test_convert_sources(self):
+        import freki
+        fd = freki.convert(self.tetml_path)
+        with open(self.tetml_path, 'rb') as f:
+            data = f.read()
+        from_bytes = freki.convert(data, doc_id='1076941')
+        self.assertEqual(from_bytes.dumps(), fd.dumps())
+        with open(self.tetml_path) as f:
+            from_file = freki.convert(f, doc_id='1076941')
+        self.assertEqual(from_file.dumps(), fd.dumps())
+        self.assertEqual(fd.blocks[0].doc_id, '1076941')
+        blocks = list(freki.iter_blocks(data, doc_id='1076941'))
+        self.assertEqual([str(b) for b in blocks],
+                         [str(b) for b in fd.blocks])
+
+    def test_dump(self):
+        import freki
+        fd = freki.convert(self.tetml_path)
+        for compact in (False, True):
+            out = StringIO()
+            fd.dump(out, compact=compact)
+            self.assertEqual(out.getvalue(), fd.dumps(compact=compact))
+
+    def test_process(self):
+        from io import BytesIO
+        from freki.main import analyze, process, freki_doc
+        doc = analyze(self.tetml_path)
+        for compact in (False, True):
+            out = BytesIO()
+            process(doc, out, compact=compact)
+            self.assertEqual(out.getvalue().decode('utf-8'),
+                             freki_doc(doc).dumps(compact=compact))
+
+
+class FileIOTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = b''.join(
+            'line {}\n'.format(i).encode('ascii') for i in range(20000)
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sniffed_input(self):
+        from freki.fileio import open_input, open_output
+        for compression in (None, 'gzip', 'bz2', 'xz'):
+            # no extension, so only the content tells the compression
+            path = os.path.join(self.tmpdir, str(compression))
+            with open_output(path, compression=compression) as f:
+                f.write(self.data)
+            with open_input(path) as f:
+                self.assertEqual(f.read(), self.data)
+
+    def test_parallel_gzip(self):
+        import gzip
+        from io import BytesIO
+        from freki.fileio import ParallelGzipWriter
+        out = BytesIO()
+        writer = ParallelGzipWriter(out, threads=3, chunk_size=1000)
+        for i in range(0, len(self.data), 777):
+            writer.write(self.data[i:i+777])
+        writer.close()
+        self.assertEqual(gzip.decompress(out.getvalue()), self.data)
+        out = BytesIO()
+        ParallelGzipWriter(out).close()
+        self.assertEqual(gzip.decompress(out.getvalue()), b'')
+
+
+class GrepTest(TestCase):
+    def setUp(self):
+        self.fd_path = os.path.join(os.path.dirname(__file__), '16.txt')
+
+    def test_grep_file(self):
+        import re
+        from freki.grep import grep_file
+        fd = FrekiDoc.read(self.fd_path)
+        regex = re.compile(r'NOM|FUT')
+        expected = [(l.block.doc_id, l.block.block_id, l.lineno, str(l))
+                    for l in fd.lines_by_tag('G') if l.search(regex)]
+        self.assertTrue(expected)
+        self.assertEqual(
+            list(grep_file(self.fd_path, regex, tags={'G'})), expected
+        )
+        by_font = list(grep_file(self.fd_path, regex, fonts=['F0-10.9']))
+        self.assertEqual(
+            [hit[2] for hit in by_font],
+            [l.lineno for l in fd.lines_by_font('F0-10.9')
+             if l.search(regex)]
+        )
+
+    def test_max_count(self):
+        from freki.grep import grep
+        hits = list(grep([self.fd_path] * 3, 'the', max_count=5,
+                         processes=1))
+        self.assertEqual(len(hits), 5)
+
+
+class StatsTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths = []
+        src = os.path.join(os.path.dirname(__file__), '16.txt')
+        for name in ('a.freki', 'b.freki'):
+            path = os.path.join(self.tmpdir, name)
+            shutil.copy(src, path)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_counts(self):
+        from collections import Counter
+        from freki.stats import CorpusStats
+        stats = CorpusStats()
+        stats.add_file(self.paths[0])
+        fd = FrekiDoc.read(self.paths[0])
+        lines = list(fd.lines())
+        self.assertEqual(stats.lines, len(lines))
+        self.assertEqual(stats.blocks, len(fd.blocks))
+        self.assertEqual(stats.pages, len(fd.pages))
+        self.assertEqual(stats.spans, len(fd.spans()))
+        self.assertEqual(stats.tags, Counter(l.tag for l in lines))
+        self.assertEqual(
+            stats.fonts,
+            Counter(f for l in lines
+                    for f in l.attrs.get('fonts', '').split(',') if f)
+        )
+
+    def test_update(self):
+        from io import StringIO
+        from freki.stats import CorpusStats, corpus_stats
+        full = corpus_stats(self.paths, processes=1)
+        self.assertEqual(full.documents, 2)
+        out = StringIO()
+        corpus_stats(self.paths[:1], processes=1).dump(out)
+        out.seek(0)
+        updated = corpus_stats(
+            self.paths, stats=CorpusStats.load(out), processes=1
+        )
+        self.assertEqual(updated.to_dict(), full.to_dict())
+
+
+class DiffTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        src = os.path.join(os.path.dirname(__file__), '16.txt')
+        with open(src) as f:
+            text = f.read()
+        changed = (
+            text.replace('TENSE AS A', 'TENSE  AS A', 1)
+                .replace('line=2  tag=O', 'line=2  tag=L', 1)
+                .replace('Melbourne University', 'Melbourne Univ', 1)
+        )
+        for tree, files in [('old', {'a.freki': text, 'b.freki': text,
+                                     'c.freki': text}),
+                            ('new', {'a.freki': text, 'b.freki': changed})]:
+            os.makedirs(os.path.join(self.tmpdir, tree))
+            for name, content in files.items():
+                path = os.path.join(self.tmpdir, tree, name)
+                with open(path, 'w') as f:
+                    f.write(content)
+        # the same document in compact form is equivalent
+        self.full = os.path.join(self.tmpdir, 'full.freki')
+        self.compact = os.path.join(self.tmpdir, 'compact.freki')
+        fd = FrekiDoc.read(os.path.join(
+            os.path.dirname(__file__), '1076941.freki'
+        ))
+        for path, compact in [(self.full, False), (self.compact, True)]:
+            with open(path, 'w') as f:
+                f.write(fd.dumps(compact=compact))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_diff_files(self):
+        from freki.diff import diff_files
+        old = os.path.join(self.tmpdir, 'old', 'b.freki')
+        new = os.path.join(self.tmpdir, 'new', 'b.freki')
+        self.assertEqual(
+            diff_files(old, new),
+            {'respaced': 1, 'text_changed': 1, 'attributes_changed': 1}
+        )
+        self.assertEqual(diff_files(self.full, self.compact), {})
+
+    def test_diff_trees(self):
+        from freki.diff import diff_trees, summarize
+        results = list(diff_trees(
+            os.path.join(self.tmpdir, 'old'),
+            os.path.join(self.tmpdir, 'new'),
+            processes=1
+        ))
+        statuses, categories = summarize(results)
+        self.assertEqual(
+            statuses, {'identical': 1, 'changed': 1, 'missing_new': 1}
+        )
+        self.assertEqual(categories['text_changed'], 1)
+
+    def test_diff_renamed_file(self):
+        from freki.diff import diff_trees
+        results = list(diff_trees(self.full, self.compact, processes=1))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['path'], 'compact.freki')
+        self.assertEqual(results[0]['info']['result'], 'equivalent')
+
+
+class ProfileTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tetml_path = os.path.join(
+            os.path.dirname(__file__), '1076941.tetml'
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_stages(self):
+        from freki.main import main
+        from freki.profiling import read_folded
+        import pstats
+        profdir = os.path.join(self.tmpdir, 'prof')
+        outfile = os.path.join(self.tmpdir, 'out.freki')
+        main(['--profile', profdir, '--profile-aggregate',
+              self.tetml_path, outfile])
+        for stage in ('read', 'analyze', 'write'):
+            path = os.path.join(profdir, '1076941.{}.pstats'.format(stage))
+            self.assertTrue(pstats.Stats(path).total_calls > 0)
+            path = os.path.join(profdir, 'aggregate', stage + '.pstats')
+            self.assertTrue(os.path.exists(path))
+        folded = os.path.join(profdir, '1076941.analyze.folded')
+        if os.path.exists(folded):  # there may be no samples
+            for stack, count in read_folded(folded).items():
+                self.assertIn('(', stack.split(';')[-1])
+                self.assertTrue(count > 0)
+
+    def test_no_profiler_entries(self):
+        import time
+        import pstats
+        from freki.profiling import Profiler
+        profile = Profiler(self.tmpdir, interval=0.001).document('doc')
+        with profile.stage('busy'):
+            start = time.process_time()
+            while time.process_time() - start < 0.2:
+                sum(range(1000))
+        stats = pstats.Stats(os.path.join(self.tmpdir, 'doc.busy.pstats'))
+        self.assertEqual(
+            [func for func in stats.stats
+             if os.path.basename(func[0]) == 'profiling.py'], []
+        )
+        self.assertTrue(any(
+            'sum' in func[2] for func in stats.stats
+        ))
+
+    def test_sampling(self):
+        from freki.profiling import Profiler, NULL_PROFILE
+        profiler = Profiler(self.tmpdir, every=4)
+        names = ['doc{}'.format(i) for i in range(100)]
+        sampled = [n for n in names if profiler.sampled(n)]
+        self.assertTrue(0 < len(sampled) < 50)
+        self.assertEqual(sampled, [n for n in names if profiler.sampled(n)])
+        skipped = [n for n in names if n not in sampled][0]
+        self.assertIs(profiler.document(skipped), NULL_PROFILE)
+
+
+class ShardTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.indir = os.path.join(self.tmpdir, 'in')
+        os.makedirs(self.indir)
+        for i in range(20):
+            path = os.path.join(self.indir, 'd{}.txt'.format(i))
+            with open(path, 'w') as f:
+                f.write('line {}\n'.format(i) * (i * 10 + 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_assign_shards(self):
+        from freki.shards import assign_shards
+        items = [('doc{}'.format(i), 100 + i * 10) for i in range(200)]
+        shards = assign_shards(items, 4)
+        # the order of the inputs does not matter
+        self.assertEqual(shards, assign_shards(items[::-1], 4)[::-1])
+        sizes = [0] * 4
+        for (_, size), shard in zip(items, shards):
+            sizes[shard] += size
+        largest = max(size for _, size in items)
+        self.assertTrue(max(sizes) - min(sizes) <= 2 * largest)
+
+    def test_shards(self):
+        from freki.text2freki import main
+        from freki.shards import merge_shards
+        outdir = os.path.join(self.tmpdir, 'out')
+        shard_dir = os.path.join(outdir, '.shards')
+        main(['--batch', self.indir, outdir, '-j', '1', '--shard', '0/2'])
+        metrics, problems = merge_shards(shard_dir)
+        self.assertIn('shard 1/2 is missing', problems)
+        main(['--batch', self.indir, outdir, '-j', '1', '--shard', '1/2'])
+        metrics, problems = merge_shards(shard_dir)
+        self.assertEqual(problems, [])
+        self.assertEqual((metrics['inputs'], metrics['ok']), (20, 20))
+        self.assertEqual(len(os.listdir(outdir)), 21)
+        # a restarted shard skips the inputs it already converted
+        checkpoint = os.path.join(shard_dir, 'shard-0-of-2.tsv')
+        with open(checkpoint) as f:
+            converted = len(f.readlines())
+        main(['--batch', self.indir, outdir, '-j', '1', '--shard', '0/2'])
+        with open(checkpoint) as f:
+            self.assertEqual(len(f.readlines()), converted)
+
+    def test_assignment_kept(self):
+        from freki.shards import select_shard
+        shard_dir = os.path.join(self.tmpdir, 'shards')
+        rows = [['d{}.txt'.format(i)] for i in range(20)]
+
+        def shards():
+            return [select_shard(rows, self.indir, i, 3, shard_dir)
+                    for i in range(3)]
+
+        before = shards()
+        # resizing, adding, and removing inputs moves no other input
+        with open(os.path.join(self.indir, 'd0.txt'), 'w') as f:
+            f.write('line\n' * 10000)
+        rows.append(['new.txt'])
+        del rows[5]
+        after = shards()
+        for old, new in zip(before, after):
+            self.assertEqual(
+                [r for r in old if r != ['d5.txt']],
+                [r for r in new if r != ['new.txt']]
+            )
+        self.assertEqual(sum(['new.txt'] in rs for rs in after), 1)
+
+
+class PackingTest(TestCase):
+    def setUp(self):
+        from freki.readers.tetml import TetmlReader
+        self.pages = TetmlReader(os.path.join(
+            os.path.dirname(__file__), '1076941.tetml'
+        )).pages()
+
+    def dump(self, pages):
+        def box(x):
+            return (x.llx, x.lly, x.urx, x.ury)
+        return [
+            (p.id, p.page_width, p.page_height, box(p), b.id, b.label,
+             box(b), [(l.id, box(l), [(t.text, t.font, t.features, box(t))
+                                      for t in l.tokens]) for l in b.lines])
+            for p in pages for b in p.blocks
+        ]
+
+    def test_buffer(self):
+        from freki.packing import (
+            pack_pages, unpack_pages, to_buffer, from_buffer
+        )
+        buf = to_buffer(pack_pages(self.pages))
+        pages = unpack_pages(from_buffer(bytes(buf)))
+        self.assertEqual(self.dump(pages), self.dump(self.pages))
+        with self.assertRaises(ValueError):
+            from_buffer(b'not pages')
+
+    def test_shared_pages(self):
+        import pickle
+        from freki.packing import SharedPages
+        shared = SharedPages(self.pages)
+        try:
+            attached = pickle.loads(pickle.dumps(shared))
+            self.assertEqual(attached.page_ids, shared.page_ids)
+            page_id = self.pages[-1].id
+            self.assertEqual(
+                self.dump(attached.pages(page_id)),
+                self.dump([self.pages[-1]])
+            )
+            self.assertEqual(
+                self.dump(attached.pages()), self.dump(self.pages)
+            )
+            attached.close()
+        finally:
+            shared.unlink()
+
+
+class TemplateTest(TestCase):
+    def setUp(self):
+        self.tetml_path = os.path.join(
+            os.path.dirname(__file__), '1076941.tetml'
+        )
+
+    def reader(self):
+        from freki.readers.tetml import TetmlReader
+        from freki.structures import Page
+
+        class Reader(object):
+            # copies of the page, some missing blocks so the layout
+            # changes from page to page
+            def pages(reader):
+                pages = []
+                for i, k in enumerate([None, None, 1, None, -1]):
+                    page = TetmlReader(self.tetml_path).pages()[0]
+                    pages.append(Page(
+                        page.blocks[:k], id=i+1,
+                        page_width=page.page_width,
+                        page_height=page.page_height
+                    ))
+                return pages
+        return Reader()
+
+    def test_same_zones(self):
+        from freki.analyzers.templates import LayoutTemplates
+        from freki.analyzers.xycut import XYCutAnalyzer
+
+        def dump(doc):
+            return [
+                (p.id, b.id, b.label, b.llx, b.lly, b.urx, b.ury,
+                 [[t.text for t in l.tokens] for l in b.lines])
+                for p in doc.pages for b in p.blocks
+            ]
+        expected = dump(XYCutAnalyzer().analyze(self.reader()))
+        for pyramid in (False, True):
+            templates = LayoutTemplates()
+            analyzer = XYCutAnalyzer(templates=templates, pyramid=pyramid)
+            doc = analyzer.analyze(self.reader())
+            self.assertEqual(dump(doc), expected)
+            stats = templates.stats()
+            self.assertEqual(
+                stats['hits'] + stats['partial'] + stats['misses'], 5
+            )
+            self.assertTrue(stats['hits'] >= 2)
+            self.assertTrue(stats['zones_reused'] < stats['zones_checked'])
+
+    def test_cut_tree(self):
+        from freki.analyzers.xycut import _cut_tree
+        zones = [
+            ((0, 400, 300, 800), 'lt'), ((0, 0, 300, 400), 'lb'),
+            ((300, 0, 600, 800), 'r')
+        ]
+        self.assertEqual(_cut_tree(zones), {'': (1, 300), 'l': (0, 400)})
+
+
+class PdfMinerTest(TestCase):
+    def xml(self, lines):
+        out = ['<pages><page id="1" bbox="0,0,100,100"><textbox id="0">']
+        for glyphs in lines:
+            out.append('<textline>')
+            for text, font, llx, urx in glyphs:
+                out.append(
+                    '<text font="{}" bbox="{},-0.000,{},10.000" size="10.0">'
+                    '{}</text>'.format(font, llx, urx, text)
+                )
+            out.append('<text>\n</text></textline>')
+        out.append('</textbox></page></pages>')
+        return ''.join(out).encode('utf-8')
+
+    def test_tokens(self):
+        from freki.readers.pdfminer import PdfMinerReader
+        xml = self.xml([
+            [('a', 'F', 0, 5), ('b', 'F', 5.1, 10), ('c', 'G', 10, 15),
+             (',', 'G', 15, 17), (' ', 'G', 17, 20), ('d', 'G', 20, 25),
+             ('e', 'G', 25.5, 30), ('e', 'G', 25.6, 30.1)],
+            [],
+            [('f', 'F', 1, 6)]
+        ])
+        reader = PdfMinerReader(BytesIO(xml))
+        lines = reader.pages()[0].blocks[0].lines
+        self.assertEqual(
+            [[(t.text, t.font, t.llx, t.lly, t.urx, t.ury) for t in l.tokens]
+             for l in lines],
+            [[('ab', 'F', 0, -0.0, 10, 10), ('c', 'G', 10, -0.0, 15, 10),
+              (',', 'G', 15, -0.0, 17, 10), ('d', 'G', 20, -0.0, 25, 10),
+              ('ee', 'G', 25.5, -0.0, 30.1, 10)],
+             [],
+             [('f', 'F', 1, -0.0, 6, 10)]]
+        )
+        # the overprinted copy of "e" is dropped
+        reader = PdfMinerReader(BytesIO(xml), dedupe=0.5)
+        tokens = reader.pages()[0].blocks[0].lines[0].tokens
+        self.assertEqual([t.text for t in tokens], ['ab', 'c', ',', 'd', 'e'])
+
+
 # =============================================================================
 # Freki Tests
 # =============================================================================